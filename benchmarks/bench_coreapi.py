@@ -0,0 +1,172 @@
+'''
+Benchmarks of the public functions of coreAPI.py against the in-process fake coreAPI server.
+
+Usage:
+    python -m benchmarks.bench_coreapi [--iterations N] [--threads N] [--latency S] [--error-rate R]
+                                       [--record-padding B] [--token-lifetime S] [--only NAME ...]
+                                       [--output results.json] [--baseline benchmarks/baseline.json]
+                                       [--save-baseline] [--tolerance 0.2]
+
+Each case reports throughput (calls/s), p50/p99 latency and peak traced memory. With '--baseline' the results are
+compared to a saved run and the command exits with status 1 when a case lost more than 'tolerance' of its
+throughput, or its p99 latency or peak memory grew by more than 'tolerance'.
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+from config import config  # noqa: E402
+from benchmarks.fake_coreapi import FakeCoreAPI, FakeSettings  # noqa: E402
+
+
+def _cases(coreAPI):
+    client_ids = list(range(1, 101))
+    return {
+        'get_coreapi': lambda i: coreAPI.get_coreapi(),
+        'check_token_avaiable': lambda i: coreAPI.check_token_avaiable(),
+        'generate_jwt_token': lambda i: coreAPI.generate_jwt_token(),
+        'coreapi_clients_get': lambda i: coreAPI.coreapi_clients_get(i % 1000 + 1),
+        'coreapi_clients_search': lambda i: coreAPI.coreapi_clients_search(),
+        'coreapi_accounts_search': lambda i: coreAPI.coreapi_accounts_search(i % 1000 + 1),
+        'coreapi_accounts_search_list': lambda i: coreAPI.coreapi_accounts_search_list(),
+        'coreapi_accounts_get': lambda i: coreAPI.coreapi_accounts_get(i % 5000 + 1),
+        'coreapi_batch_call': lambda i: coreAPI.coreapi_batch_call([('clients.get', {'id': c}) for c in client_ids]),
+        'coreapi_clients_get_many': lambda i: coreAPI.coreapi_clients_get_many(client_ids),
+        'coreapi_accounts_get_many': lambda i: coreAPI.coreapi_accounts_get_many(client_ids),
+        'iter_clients': lambda i: sum(1 for _ in coreAPI.iter_clients()),
+        'iter_accounts': lambda i: sum(1 for _ in coreAPI.iter_accounts()),
+        'coreapi_clients_authenticate': lambda i: coreAPI.coreapi_clients_authenticate('bench', 'bench'),
+        'request_token': lambda i: coreAPI.request_token(),
+        'get_xdrs': lambda i: coreAPI.get_xdrs(),
+    }
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_case(function, iterations, threads):
+    '''
+    Run 'function(i)' 'iterations' times on 'threads' threads and return its throughput, latency percentiles and peak memory.
+    '''
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def timed(i):
+        start = time.perf_counter()
+        function(i)
+        elapsed = time.perf_counter() - start
+        with latencies_lock:
+            latencies.append(elapsed)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # warm up connections, tokens and caches before measuring
+        function(0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(timed, range(iterations)))
+        wall = time.perf_counter() - start
+
+        # peak memory is measured in a separate pass, tracemalloc slows the calls down
+        tracemalloc.start()
+        function(1)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'iterations': iterations,
+        'throughput': iterations / wall if wall else 0.0,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the list of regressions of 'results' against 'baseline' as human readable strings.
+    '''
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {result['throughput']:.1f}/s < baseline {previous['throughput']:.1f}/s")
+        if result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {result['p99_ms']:.2f}ms > baseline {previous['p99_ms']:.2f}ms")
+        if result['peak_memory_kb'] > previous['peak_memory_kb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {result['peak_memory_kb']:.0f}KB > baseline {previous['peak_memory_kb']:.0f}KB")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark coreAPI.py against a local fake coreAPI server.')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.001, help='server latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra server latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--record-padding', type=int, default=64, help='filler bytes per record')
+    parser.add_argument('--token-lifetime', type=int, default=3600)
+    parser.add_argument('--only', nargs='*', help='only run these cases')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(__file__), 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    settings = FakeSettings(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            token_lifetime=args.token_lifetime, record_padding=args.record_padding)
+    with FakeCoreAPI(settings) as server, tempfile.TemporaryDirectory() as tmp_dir:
+        config.COREAPI_SERVER = server.url
+        config.VCS_COREAPI = server.url
+        config.XDR_COREAPI_SERVER = server.url
+        config.VCS_ADMIN_ROLES_NAME = settings.roles_name
+        config.COREAPI_TOKEN_STORE_PATH = os.path.join(tmp_dir, 'token.json')
+        config.XDR_TOKEN_STORE_PATH = os.path.join(tmp_dir, 'xdr_token.json')
+        import coreAPI
+
+        results = {}
+        for name, function in _cases(coreAPI).items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_case(function, args.iterations, args.threads)
+            result = results[name]
+            print(f"{name:32} {result['throughput']:10.1f}/s  p50 {result['p50_ms']:8.2f}ms  "
+                  f"p99 {result['p99_ms']:8.2f}ms  peak {result['peak_memory_kb']:10.1f}KB")
+        print('server calls:', dict(server.calls))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'baseline saved to {args.baseline}')
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
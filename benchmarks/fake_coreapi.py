@@ -0,0 +1,268 @@
+import datetime
+import gzip
+import json
+import random
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+_SECRET = 'fake-coreapi'
+
+
+class FakeSettings:
+    '''
+    Behaviour of the fake coreAPI server. Every attribute can be changed while the server runs.
+
+    Attributes:
+        latency (float): Seconds added to every request.
+        jitter (float): Maximum random seconds added on top of 'latency'.
+        error_rate (float): Fraction of calls answered with a JSON-RPC error.
+        unavailable_rate (float): Fraction of requests answered with HTTP 503.
+        tail_rate (float): Fraction of requests delayed by 'tail_latency' more seconds, for a heavy latency tail.
+        tail_latency (float): The extra delay of the slow requests.
+        token_lifetime (int): Lifetime in seconds of the issued JWT tokens.
+        clients (int): Number of clients served by 'clients.search' / 'clients.get'.
+        accounts (int): Number of accounts served by 'clients.accounts.search' / 'clients.accounts.get'.
+        record_padding (int): Size in bytes of a filler field added to every record, to tune payload size.
+        xdr_interval (int): Seconds between two generated XDRs of a billed client.
+        roles_name (str): Role returned by 'iam.users.search'.
+        compress (bool): Gzip the response body when the request sends 'Accept-Encoding: gzip'.
+        capacity (int): Requests processed at the same time, the others queue, so latency grows with load.
+                        0 for no limit. Read when the server is created.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, token_lifetime=3600, clients=1000, accounts=5000,
+                 record_padding=0, xdr_interval=60, roles_name='Administrator', compress=False,
+                 capacity=0, unavailable_rate=0.0, tail_rate=0.0, tail_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.unavailable_rate = unavailable_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self.token_lifetime = token_lifetime
+        self.clients = clients
+        self.accounts = accounts
+        self.record_padding = record_padding
+        self.xdr_interval = xdr_interval
+        self.roles_name = roles_name
+        self.compress = compress
+        self.capacity = capacity
+
+
+class _JSONRPCError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+class FakeCoreAPI:
+    '''
+    In-process stand-in for the coreAPI JSON-RPC server, for benchmarks and local runs.
+
+    Implements 'iam.auth.jwt.authenticate', 'clients.search', 'clients.get', 'clients.accounts.search',
+    'clients.accounts.get', 'iam.users.search' and 'reports.xdrs_list.query', single and batch requests.
+    Logins with the password 'invalid' are rejected; other methods require an unexpired token.
+
+    Example:
+        with FakeCoreAPI(FakeSettings(latency=0.002)) as server:
+            config.COREAPI_SERVER = server.url
+    '''
+
+    def __init__(self, settings=None, host='127.0.0.1', port=0):
+        self.settings = settings or FakeSettings()
+        self.calls = Counter()
+        self._calls_lock = threading.Lock()
+        self._capacity = threading.Semaphore(self.settings.capacity) if self.settings.capacity else None
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                # headers and body are written separately, avoid the Nagle / delayed ACK stall between them
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                token = self.headers.get('Authorization', '')[len('Bearer '):]
+                if fake.settings.unavailable_rate and random.random() < fake.settings.unavailable_rate:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if fake._capacity is not None:
+                    with fake._capacity:
+                        response = fake._process(body, token)
+                else:
+                    response = fake._process(body, token)
+                data = json.dumps(response).encode('utf-8')
+                compress = fake.settings.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+                if compress:
+                    data = gzip.compress(data, compresslevel=1)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                if compress:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://%s:%d' % self._httpd.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-coreapi', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _process(self, body, token):
+        self._sleep()
+        try:
+            request = json.loads(body)
+            if isinstance(request, list):
+                return [self._handle(item, token) for item in request]
+            return self._handle(request, token)
+        except ValueError:
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error'}}
+
+    def _sleep(self):
+        delay = self.settings.latency + random.uniform(0, self.settings.jitter)
+        if self.settings.tail_rate and random.random() < self.settings.tail_rate:
+            delay += self.settings.tail_latency
+        if delay > 0:
+            time.sleep(delay)
+
+    def _handle(self, request, token):
+        method_name = request.get('method')
+        params = request.get('params') or {}
+        with self._calls_lock:
+            self.calls[method_name] += 1
+        try:
+            if self.settings.error_rate and random.random() < self.settings.error_rate:
+                raise _JSONRPCError(-32000, 'Injected error')
+            if method_name == 'iam.auth.jwt.authenticate':
+                result = self._authenticate(params)
+            else:
+                self._check_token(token)
+                handler = self._methods.get(method_name)
+                if handler is None:
+                    raise _JSONRPCError(-32601, 'Method not found')
+                result = handler(self, params)
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+        except _JSONRPCError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': {'code': e.code, 'message': e.message}}
+
+    def _authenticate(self, params):
+        if params.get('password') == 'invalid':
+            raise _JSONRPCError(-32001, 'Invalid login or password')
+        payload = {'uid': abs(hash(params.get('login'))) % 1000, 'exp': int(time.time()) + self.settings.token_lifetime}
+        return {'token': jwt.encode(payload, _SECRET, algorithm='HS256')}
+
+    @staticmethod
+    def _check_token(token):
+        try:
+            jwt.decode(token, _SECRET, algorithms=['HS256'])
+        except jwt.exceptions.PyJWTError:
+            raise _JSONRPCError(-32002, 'Authorization required')
+
+    def _padding(self):
+        return 'x' * self.settings.record_padding
+
+    def _client(self, client_id):
+        return {'id': client_id, 'name': 'client-%d' % client_id, 'is_active': True, 'balance': client_id * 1.5,
+                'padding': self._padding()}
+
+    def _account(self, account_id):
+        return {'id': account_id, 'clients_id': account_id % self.settings.clients + 1,
+                'login': 'account-%d' % account_id, 'is_active': True, 'padding': self._padding()}
+
+    @staticmethod
+    def _page(params, ids):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', len(ids)))
+        return ids[offset:offset + limit]
+
+    def _clients_search(self, params):
+        return [self._client(client_id) for client_id in self._page(params, range(1, self.settings.clients + 1))]
+
+    def _clients_get(self, params):
+        client_id = int(params.get('id', 0))
+        if not 1 <= client_id <= self.settings.clients:
+            raise _JSONRPCError(-32004, 'Client not found')
+        return self._client(client_id)
+
+    def _accounts_search(self, params):
+        account_ids = range(1, self.settings.accounts + 1)
+        if 'clients_id' in params:
+            # accounts are spread over the clients with clients_id = id % clients + 1
+            clients_id = int(params['clients_id'])
+            first = clients_id - 1 if clients_id > 1 else self.settings.clients
+            account_ids = range(first, self.settings.accounts + 1, self.settings.clients)
+        return [self._account(account_id) for account_id in self._page(params, account_ids)]
+
+    def _accounts_get(self, params):
+        account_id = int(params.get('id', 0))
+        if not 1 <= account_id <= self.settings.accounts:
+            raise _JSONRPCError(-32004, 'Account not found')
+        return [self._account(account_id)]
+
+    def _users_search(self, params):
+        return [{'login': params.get('login'), 'roles_name': self.settings.roles_name}]
+
+    def _xdrs_query(self, params):
+        filters = params.get('filters') or {}
+        date_from, date_to = (datetime.datetime.strptime(value, DATE_FORMAT) for value in filters['date'])
+        limit = int(params.get('limit', 100))
+        clients_id = filters.get('billed_clients_id', 1)
+        return_fields = params.get('return_fields')
+        xdrs = []
+        start = date_from
+        while start <= date_to and len(xdrs) < limit:
+            stop = start + datetime.timedelta(seconds=30)
+            xdr = {
+                'src_party_id_ext': '8490%07d' % (clients_id * 1000 + len(xdrs) % 1000),
+                'dst_party_id_ext': '8428%07d' % (len(xdrs) % 10000),
+                'start_time': start.strftime(DATE_FORMAT),
+                'stop_time': stop.strftime(DATE_FORMAT),
+                'volume': 30,
+                'subscriber_host': '10.0.0.%d' % (clients_id % 250),
+                'subscriber_id': clients_id,
+                'billed_clients_id': clients_id,
+                'padding': self._padding(),
+            }
+            if return_fields:
+                xdr = {field: xdr.get(field) for field in return_fields}
+            xdrs.append(xdr)
+            start += datetime.timedelta(seconds=self.settings.xdr_interval)
+        return xdrs
+
+    _methods = {
+        'clients.search': _clients_search,
+        'clients.get': _clients_get,
+        'clients.accounts.search': _accounts_search,
+        'clients.accounts.get': _accounts_get,
+        'iam.users.search': _users_search,
+        'reports.xdrs_list.query': _xdrs_query,
+    }
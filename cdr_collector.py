@@ -0,0 +1,430 @@
+import abc
+import fnmatch
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import paramiko
+except ImportError:  # SFTPSource is then unavailable, LocalDirectorySource still works
+    paramiko = None
+
+from config import config
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class RemoteFile:
+    '''
+    A CDR file listed by a source.
+    '''
+
+    __slots__ = ('name', 'size', 'mtime')
+
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+
+    def __repr__(self):
+        return f'RemoteFile(name={self.name!r}, size={self.size}, mtime={self.mtime})'
+
+
+class CDRSource(abc.ABC):
+    '''
+    Where the CDR files of the SBCs are read from. Sources must be usable from several threads at once.
+    '''
+
+    @abc.abstractmethod
+    def list_files(self, host):
+        '''
+        Return the RemoteFile list of a host.
+        '''
+
+    @abc.abstractmethod
+    def open(self, host, name, offset=0):
+        '''
+        Return a readable binary file object positioned at 'offset'. The caller closes it.
+        '''
+
+    def close(self):
+        pass
+
+
+class LocalDirectorySource(CDRSource):
+    '''
+    Source reading the files of each host from '<root>/<host>', for tests and for SBCs whose CDRs are already mounted.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_files(self, host):
+        directory = os.path.join(self.root, host)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                info = entry.stat()
+                files.append(RemoteFile(entry.name, info.st_size, info.st_mtime))
+        return files
+
+    def open(self, host, name, offset=0):
+        f = open(os.path.join(self.root, host, name), 'rb')
+        f.seek(offset)
+        return f
+
+
+class SFTPSource(CDRSource):
+    '''
+    Source reading REMOTE_PATH of each SBC over SFTP (requires paramiko).
+
+    Connections are pooled per host and reused across polls; the collector's per-host limit bounds how many are open.
+    Host keys are checked against the system known_hosts and 'known_hosts'; an SBC whose key is unknown is rejected
+    (paramiko.SSHException) unless 'trust_unknown_hosts' is set.
+
+    Parameters:
+        username (str, optional): Default is USERNAME.
+        password (str, optional): Default is PASSWORD.
+        port (int, optional): Default is SBC_PORT.
+        remote_path (str, optional): Default is REMOTE_PATH.
+        known_hosts (str, optional): A known_hosts file of the SBC keys. Default is SBC_KNOWN_HOSTS.
+        trust_unknown_hosts (bool, optional): Accept and remember unknown host keys. Default is SBC_TRUST_UNKNOWN_HOSTS.
+    '''
+
+    def __init__(self, username=None, password=None, port=None, remote_path=None, timeout=30, known_hosts=None,
+                 trust_unknown_hosts=None):
+        if paramiko is None:
+            raise ImportError('SFTPSource requires paramiko')
+        self.username = username or config.USERNAME
+        self.password = password or config.PASSWORD
+        self.port = port or config.SBC_PORT
+        self.remote_path = remote_path or config.REMOTE_PATH or '.'
+        self.timeout = timeout
+        self.known_hosts = config.SBC_KNOWN_HOSTS if known_hosts is None else known_hosts
+        self.trust_unknown_hosts = (config.SBC_TRUST_UNKNOWN_HOSTS if trust_unknown_hosts is None
+                                    else trust_unknown_hosts)
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _acquire(self, host):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            while idle:
+                client, sftp = idle.pop()
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    return client, sftp
+                client.close()
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        if self.known_hosts:
+            client.load_host_keys(self.known_hosts)
+        policy = paramiko.AutoAddPolicy() if self.trust_unknown_hosts else paramiko.RejectPolicy()
+        client.set_missing_host_key_policy(policy)
+        client.connect(host, port=self.port, username=self.username, password=self.password, timeout=self.timeout)
+        return client, client.open_sftp()
+
+    def _release(self, host, connection):
+        with self._lock:
+            self._idle.setdefault(host, []).append(connection)
+
+    def list_files(self, host):
+        connection = self._acquire(host)
+        try:
+            attributes = connection[1].listdir_attr(self.remote_path)
+        except BaseException:
+            connection[0].close()
+            raise
+        self._release(host, connection)
+        return [RemoteFile(a.filename, a.st_size, a.st_mtime) for a in attributes if stat.S_ISREG(a.st_mode or 0)]
+
+    def open(self, host, name, offset=0):
+        connection = self._acquire(host)
+        try:
+            f = connection[1].open(f'{self.remote_path.rstrip("/")}/{name}', 'rb')
+            f.seek(offset)
+            f.prefetch()
+        except BaseException:
+            connection[0].close()
+            raise
+        source = self
+
+        class _File:
+            def read(self, size=-1):
+                return f.read(size)
+
+            def close(self):
+                f.close()
+                source._release(host, connection)
+
+        return _File()
+
+    def close(self):
+        with self._lock:
+            for connections in self._idle.values():
+                for client, _ in connections:
+                    client.close()
+            self._idle.clear()
+
+
+class Manifest:
+    '''
+    Append-only JSON lines record of the fetched files.
+
+    Every fetch appends {'host', 'name', 'size', 'mtime', 'sha256', 'path', 'fetched_at'}; the last line of a
+    (host, name) pair is its current state. The file is replayed once at start-up and kept in memory afterwards.
+
+    Parameters:
+        path (str, optional): The manifest file. Default is METADATA_PATH.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or config.METADATA_PATH or 'cdr_manifest.jsonl'
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.entries[(entry['host'], entry['name'])] = entry
+
+    def get(self, host, name):
+        return self.entries.get((host, name))
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[(entry['host'], entry['name'])] = entry
+
+    def compact(self):
+        '''
+        Rewrite the manifest with only the current entry of every file.
+        '''
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                for entry in self.entries.values():
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+
+def _sha256(path, size=None):
+    # hash state of the first 'size' bytes of the file, or of the whole file
+    digest = hashlib.sha256()
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            block = f.read(COPY_BUFFER_SIZE if remaining is None else min(COPY_BUFFER_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest
+
+
+class CDRCollector:
+    '''
+    Fetch new and grown CDR files from every SBC concurrently.
+
+    Each poll lists every host, compares the listing with the manifest and only transfers what changed:
+    - a new file is downloaded to '<name>.part', then renamed. '<name>.part.meta' records the listed size and mtime
+      the download was started for: after an interruption the '.part' is resumed from its size only if the file is
+      still listed with them, otherwise it is downloaded again rather than splicing two versions;
+    - a grown file only has its new bytes appended, from the size the local copy already has;
+    - exactly the listed size is copied, so a file still being written is recorded with the size and mtime of the
+      same listing, and the bytes written after it are fetched by the next poll;
+    - a file which shrank or was rewritten (same size, new mtime) is downloaded again.
+    Transfers run on a thread pool, with at most 'per_host' concurrent transfers per SBC, and are retried
+    RETRY_ATTEMPS times, RETRY_DELAY seconds apart.
+    The sha256 of a file is computed from the bytes as they are written. The hash state of every local file is kept
+    between polls, so an append only hashes the new bytes; the local file is read again only when no state matches
+    its size, e.g. after a restart.
+
+    Parameters:
+        source (CDRSource): Where the files are read from, e.g. SFTPSource() or LocalDirectorySource(root).
+        hosts (list, optional): The SBC hosts. Default is SBC_HOSTS.
+        local_path (str, optional): Files are stored in '<local_path>/<host>/'. Default is LOCAL_PATH.
+        manifest (Manifest, optional): Default is Manifest() on METADATA_PATH.
+        per_host (int, optional): Concurrent transfers per host. Default is SBC_MAX_CONNECTIONS_PER_HOST.
+        workers (int, optional): Total concurrent transfers. Default is CDR_COLLECTOR_WORKERS.
+        pattern (str, optional): Only fetch names matching this glob. Default is CDR_FILENAME_FORMAT.
+    '''
+
+    def __init__(self, source, hosts=None, local_path=None, manifest=None, per_host=None, workers=None, pattern=None,
+                 retry_attempts=None, retry_delay=None):
+        self.source = source
+        self.hosts = list(hosts if hosts is not None else config.SBC_HOSTS)
+        self.local_path = local_path or config.LOCAL_PATH or '.'
+        self.manifest = manifest or Manifest()
+        self.per_host = per_host or config.SBC_MAX_CONNECTIONS_PER_HOST
+        self.workers = workers or config.CDR_COLLECTOR_WORKERS
+        self.pattern = pattern or config.CDR_FILENAME_FORMAT or '*'
+        self.retry_attempts = int(retry_attempts if retry_attempts is not None else config.RETRY_ATTEMPS or 3)
+        self.retry_delay = float(retry_delay if retry_delay is not None else config.RETRY_DELAY or 5)
+        self._host_limits = {host: threading.Semaphore(self.per_host) for host in self.hosts}
+        # local path -> (size, hashlib state of its first 'size' bytes)
+        self._digests = {}
+        self._digests_lock = threading.Lock()
+
+    def _changed(self, host, remote):
+        entry = self.manifest.get(host, remote.name)
+        if entry is None:
+            return True
+        return entry['size'] != remote.size or entry['mtime'] != remote.mtime
+
+    def pending(self, host):
+        '''
+        Return the RemoteFile list of a host that is new or changed since the last fetch.
+        '''
+        with self._host_limits[host]:
+            files = self.source.list_files(host)
+        return [f for f in files if fnmatch.fnmatch(f.name, self.pattern) and self._changed(host, f)]
+
+    def _digest(self, path, size):
+        # hash state of the first 'size' bytes of a local file, reading the file only when no kept state matches
+        if size <= 0:
+            return hashlib.sha256()
+        with self._digests_lock:
+            known = self._digests.get(path)
+        if known is not None and known[0] == size:
+            return known[1].copy()
+        return _sha256(path, size)
+
+    def _copy(self, host, name, offset, length, target, mode, digest):
+        # copy the 'length' bytes of the remote file which follow 'offset'
+        with open(target, mode) as out:
+            reader = self.source.open(host, name, offset)
+            try:
+                remaining = length
+                while remaining > 0:
+                    block = reader.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not block:
+                        raise OSError(f'{host}:{name} ended {remaining} bytes before its listed size')
+                    out.write(block)
+                    digest.update(block)
+                    remaining -= len(block)
+            finally:
+                reader.close()
+            out.flush()
+            os.fsync(out.fileno())
+
+    @staticmethod
+    def _resume_offset(part, remote):
+        # size of a '.part' left by an interrupted download of the same listed version of the file, else 0
+        meta = part + '.meta'
+        try:
+            with open(meta, 'r') as f:
+                started_for = json.load(f)
+        except (FileNotFoundError, ValueError):
+            started_for = None
+        if started_for == {'size': remote.size, 'mtime': remote.mtime} and os.path.exists(part):
+            offset = os.path.getsize(part)
+            if offset <= remote.size:
+                return offset
+        with open(meta, 'w') as f:
+            json.dump({'size': remote.size, 'mtime': remote.mtime}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return 0
+
+    def fetch(self, host, remote):
+        '''
+        Transfer one file and append its manifest entry.
+
+        Returns:
+            dict: The manifest entry of the file.
+        '''
+        directory = os.path.join(self.local_path, host)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, remote.name)
+        part = target + '.part'
+        entry = self.manifest.get(host, remote.name)
+        local_size = os.path.getsize(target) if os.path.exists(target) else -1
+
+        with self._host_limits[host]:
+            if entry is not None and entry['size'] < remote.size and entry['size'] <= local_size <= remote.size:
+                # the file grew: append the new bytes (a previous interrupted append resumes from the local size)
+                digest = self._digest(target, local_size)
+                self._copy(host, remote.name, local_size, remote.size - local_size, target, 'ab', digest)
+            else:
+                offset = self._resume_offset(part, remote)
+                digest = self._digest(part, offset)
+                self._copy(host, remote.name, offset, remote.size - offset, part, 'ab' if offset else 'wb', digest)
+                os.replace(part, target)
+                os.remove(part + '.meta')
+
+        size = os.path.getsize(target)
+        with self._digests_lock:
+            self._digests.pop(part, None)
+            self._digests[target] = (size, digest.copy())
+        entry = {
+            'host': host,
+            'name': remote.name,
+            'size': size,
+            'mtime': remote.mtime,
+            'sha256': digest.hexdigest(),
+            'path': target,
+            'fetched_at': time.time(),
+        }
+        self.manifest.append(entry)
+        return entry
+
+    def _fetch_with_retry(self, host, remote):
+        for attempt in range(self.retry_attempts):
+            try:
+                return self.fetch(host, remote)
+            except Exception as e:
+                if attempt + 1 >= self.retry_attempts:
+                    return e
+                time.sleep(self.retry_delay)
+
+    def _pending_with_retry(self, host):
+        for attempt in range(self.retry_attempts):
+            try:
+                return self.pending(host)
+            except Exception as e:
+                if attempt + 1 >= self.retry_attempts:
+                    return e
+                time.sleep(self.retry_delay)
+
+    def poll(self):
+        '''
+        List every host and fetch its new and grown files.
+
+        Returns:
+            list: One manifest entry per fetched file, or the exception of a file or host that failed after every retry.
+        '''
+        results = []
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            listings = dict(zip(self.hosts, executor.map(self._pending_with_retry, self.hosts)))
+            futures = []
+            for host, pending in listings.items():
+                if isinstance(pending, Exception):
+                    results.append(pending)
+                    continue
+                futures += [executor.submit(self._fetch_with_retry, host, remote) for remote in pending]
+            results += [future.result() for future in futures]
+        return results
+
+    def run(self, interval=60, stop_event=None):
+        '''
+        Poll every 'interval' seconds until 'stop_event' is set.
+        '''
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            self.poll()
+            stop_event.wait(interval)
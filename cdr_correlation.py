@@ -0,0 +1,207 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+
+from config import config
+from cdr_parser import STATUS_START, STATUS_STOP, parse_connect_time
+
+CALL_COMPLETE = 'complete'
+CALL_ORPHAN_START = 'orphan_start'
+CALL_ORPHAN_STOP = 'orphan_stop'
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class CorrelatedCall:
+    '''
+    A call emitted by the CallCorrelator.
+
+    Attributes:
+        call_id (str): The accounting id shared by the start and stop records.
+        status (str): CALL_COMPLETE, or CALL_ORPHAN_START / CALL_ORPHAN_STOP for a record whose pair never arrived
+                      within the horizon.
+        start_trunk_group (str): The trunk group of the start record, or None.
+        stop_trunk_group (str): The trunk group of the stop record, or None.
+        connect_time (datetime.datetime): The CONNECT_TIME_START value of the start record, or None.
+        disconnect_time (datetime.datetime): The CONNECT_TIME_STOP value of the stop record, or None.
+        duration (float): Seconds between connect_time and disconnect_time, or None if either is missing.
+    '''
+
+    __slots__ = ('call_id', 'status', 'start_trunk_group', 'stop_trunk_group', 'connect_time', 'disconnect_time', 'duration')
+
+    def __init__(self, call_id, status, start_trunk_group=None, stop_trunk_group=None, connect_time=None, disconnect_time=None):
+        self.call_id = call_id
+        self.status = status
+        self.start_trunk_group = start_trunk_group
+        self.stop_trunk_group = stop_trunk_group
+        self.connect_time = connect_time
+        self.disconnect_time = disconnect_time
+        self.duration = (disconnect_time - connect_time).total_seconds() if connect_time and disconnect_time else None
+
+    def __repr__(self):
+        return (f'CorrelatedCall(call_id={self.call_id!r}, status={self.status!r}, duration={self.duration!r}, '
+                f'connect_time={self.connect_time!r}, disconnect_time={self.disconnect_time!r})')
+
+
+class _OpenLeg:
+    __slots__ = ('status', 'trunk_group', 'time', 'seen')
+
+    def __init__(self, status, trunk_group, time, seen):
+        self.status = status
+        self.trunk_group = trunk_group
+        self.time = time
+        self.seen = seen
+
+
+def _timestamp(value):
+    return (value - _EPOCH).total_seconds()
+
+
+class CallCorrelator:
+    '''
+    Streaming pairing of Accounting-Start and Accounting-Stop records into calls.
+
+    Records are fed as CDRBatch objects (cdr_parser) in any order and from any number of files. The correlator keeps a
+    table of open legs indexed by call id: a start waits for its stop and, since files can arrive out of order, a stop
+    also waits for its start. A call is emitted as soon as both legs are known.
+
+    Time is measured on the CDRs themselves (the latest connect time seen, the 'watermark'), so replaying old files
+    behaves like the live run. Legs that stayed open longer than 'horizon' seconds of CDR time are emitted as orphans,
+    and when more than 'max_open' legs are open the oldest are expired early, which bounds memory.
+
+    The open legs, the watermark and the byte offset reached in every file are checkpointed to 'checkpoint_path' (JSON,
+    written atomically). After a restart records at or before the checkpointed offset of their file are skipped, so
+    only the data that follows the checkpoint is processed again.
+
+    Parameters:
+        horizon (int, optional): Seconds after which an unmatched leg is expired. Default is CDR_CORRELATION_HORIZON.
+        checkpoint_path (str, optional): The checkpoint file. Default is CDR_CORRELATION_CHECKPOINT; None disables it.
+        max_open (int, optional): The maximum number of open legs. Default is CDR_CORRELATION_MAX_OPEN.
+        checkpoint_interval (float, optional): Minimum seconds between two automatic checkpoints. Default is 30.
+
+    Example:
+        correlator = CallCorrelator()
+        for batch in parse_files(find_cdr_files()):
+            for call in correlator.feed(batch):
+                ...
+        correlator.checkpoint()
+    '''
+
+    def __init__(self, horizon=None, checkpoint_path=None, max_open=None, checkpoint_interval=30):
+        self.horizon = config.CDR_CORRELATION_HORIZON if horizon is None else horizon
+        self.checkpoint_path = config.CDR_CORRELATION_CHECKPOINT if checkpoint_path is None else checkpoint_path
+        self.max_open = max_open or config.CDR_CORRELATION_MAX_OPEN
+        self.checkpoint_interval = checkpoint_interval
+        self.watermark = 0.0
+        self.open = {}
+        self.offsets = {}
+        self._last_checkpoint = time.monotonic()
+        if self.checkpoint_path:
+            self._load()
+
+    def feed(self, batch):
+        '''
+        Correlate the records of a CDRBatch.
+
+        The checkpoint is written, when due, once the returned generator is exhausted, i.e. after the caller handled
+        every emitted call.
+
+        Yields:
+            CorrelatedCall: The completed calls, then the legs expired by this batch.
+        '''
+        names = batch.names
+        call_ids = batch.columns[names.index('call_id')]
+        trunk_groups = batch.columns[names.index('trunk_group')]
+        connect_times = batch.columns[names.index('connect_time')]
+        reached = self.offsets.get(batch.path, -1)
+        open_legs = self.open
+
+        for i, (status, offset) in enumerate(zip(batch.status, batch.offset)):
+            if offset <= reached:
+                continue
+            call_id = call_ids[i]
+            moment = parse_connect_time(connect_times[i])
+            if moment is not None:
+                self.watermark = max(self.watermark, _timestamp(moment))
+            other = open_legs.pop(call_id, None)
+            if other is None or other.status == status:
+                # first leg of the call (a repeated leg replaces the previous one)
+                open_legs[call_id] = _OpenLeg(status, trunk_groups[i], moment, self.watermark)
+                continue
+            if status == STATUS_STOP:
+                yield CorrelatedCall(call_id, CALL_COMPLETE, other.trunk_group, trunk_groups[i], other.time, moment)
+            else:
+                yield CorrelatedCall(call_id, CALL_COMPLETE, trunk_groups[i], other.trunk_group, moment, other.time)
+
+        if len(batch):
+            self.offsets[batch.path] = max(reached, batch.offset[-1])
+        yield from self.expire()
+        if self.checkpoint_path and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def expire(self, flush=False):
+        '''
+        Emit the legs older than the horizon, and the oldest legs beyond 'max_open'.
+
+        Parameters:
+            flush (bool): Expire every open leg, e.g. at the end of a bounded reprocessing run.
+
+        Yields:
+            CorrelatedCall: The expired legs as CALL_ORPHAN_START / CALL_ORPHAN_STOP calls.
+        '''
+        open_legs = self.open
+        limit = self.watermark - self.horizon
+        # legs are inserted with a non-decreasing 'seen' watermark, so the oldest are at the front of the dict
+        while open_legs:
+            call_id = next(iter(open_legs))
+            leg = open_legs[call_id]
+            if not flush and leg.seen >= limit and len(open_legs) <= self.max_open:
+                break
+            del open_legs[call_id]
+            if leg.status == STATUS_START:
+                yield CorrelatedCall(call_id, CALL_ORPHAN_START, start_trunk_group=leg.trunk_group, connect_time=leg.time)
+            else:
+                yield CorrelatedCall(call_id, CALL_ORPHAN_STOP, stop_trunk_group=leg.trunk_group, disconnect_time=leg.time)
+
+    def checkpoint(self):
+        '''
+        Atomically write the open legs, the watermark and the file offsets to the checkpoint file.
+        '''
+        if not self.checkpoint_path:
+            return
+        data = {
+            'watermark': self.watermark,
+            'offsets': self.offsets,
+            'open': [
+                [call_id, leg.status, leg.trunk_group, leg.time.isoformat() if leg.time else None, leg.seen]
+                for call_id, leg in self.open.items()
+            ],
+        }
+        directory = os.path.dirname(os.path.abspath(self.checkpoint_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.cdr_correlation.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.checkpoint_path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._last_checkpoint = time.monotonic()
+
+    def _load(self):
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.watermark = data.get('watermark', 0.0)
+        self.offsets = data.get('offsets', {})
+        for call_id, status, trunk_group, moment, seen in data.get('open', []):
+            moment = datetime.datetime.fromisoformat(moment) if moment else None
+            self.open[call_id] = _OpenLeg(status, trunk_group, moment, seen)
@@ -0,0 +1,307 @@
+import collections
+import datetime
+import fnmatch
+import itertools
+import mmap
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from config import config
+
+STATUS_START = 1
+STATUS_STOP = 2
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+_MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+class CDRLayout:
+    '''
+    Field layout of the SBC accounting CDRs, read from config/config.py.
+
+    Records are comma separated lines. The ACCOUTING_STATUS field tells an Accounting-Start (ACCOUNTING_START) from an
+    Accounting-Stop (ACCOUNTING_STOP) record; the two record types have ACCT_START_CDR_LENGTH and ACCT_STOP_CDR_LENGTH
+    fields and keep the decoded fields at different positions.
+
+    Parameters:
+        fields (dict, optional): Maps the name of each decoded field to its (start index, stop index).
+                                 Default is call_id, trunk_group and connect_time from the configuration.
+    '''
+
+    __slots__ = ('status_field', 'start_value', 'stop_value', 'start_length', 'stop_length', 'fields',
+                 'start_indexes', 'stop_indexes', 'start_maxsplit', 'stop_maxsplit')
+
+    def __init__(self, status_field=0, start_value='1', stop_value='2', start_length=35, stop_length=43, fields=None):
+        self.status_field = int(status_field)
+        self.start_value = str(start_value).encode()
+        self.stop_value = str(stop_value).encode()
+        self.start_length = int(start_length)
+        self.stop_length = int(stop_length)
+        self.fields = dict(fields or {})
+        self.start_indexes = tuple(int(start) for start, _ in self.fields.values())
+        self.stop_indexes = tuple(int(stop) for _, stop in self.fields.values())
+        # only split a record as far as the last field we decode
+        self.start_maxsplit = max(self.start_indexes + (self.status_field,)) + 1
+        self.stop_maxsplit = max(self.stop_indexes + (self.status_field,)) + 1
+
+    @classmethod
+    def from_config(cls):
+        fields = {
+            'call_id': (config.CDR_CALL_ID_FIELD, config.CDR_CALL_ID_FIELD),
+            'trunk_group': (config.ORG_TRUNK_ACC_START, config.ORG_TRUNK_ACC_STOP),
+            'connect_time': (config.CONNECT_TIME_START, config.CONNECT_TIME_STOP),
+        }
+        # party numbers are only decoded when configured, they are needed by the XDR reconciliation
+        if config.CDR_CALLING_NUMBER_FIELDS:
+            fields['calling_number'] = config.CDR_CALLING_NUMBER_FIELDS
+        if config.CDR_CALLED_NUMBER_FIELDS:
+            fields['called_number'] = config.CDR_CALLED_NUMBER_FIELDS
+        return cls(
+            status_field=config.ACCOUTING_STATUS,
+            start_value=config.ACCOUNTING_START,
+            stop_value=config.ACCOUNTING_STOP,
+            start_length=config.ACCT_START_CDR_LENGTH,
+            stop_length=config.ACCT_STOP_CDR_LENGTH,
+            fields=fields,
+        )
+
+
+class CDRRecord:
+    '''
+    One decoded CDR: its status (STATUS_START or STATUS_STOP), byte offset in the file and the decoded fields.
+    '''
+
+    __slots__ = ('status', 'offset', 'values', 'names')
+
+    def __init__(self, status, offset, values, names):
+        self.status = status
+        self.offset = offset
+        self.values = values
+        self.names = names
+
+    def __getattr__(self, name):
+        # special names (e.g. looked up by pickle and copy before the slots are set) are never fields
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self.values[self.names.index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={value!r}' for name, value in zip(self.names, self.values))
+        return f'CDRRecord(status={self.status}, offset={self.offset}, {fields})'
+
+
+class CDRBatch:
+    '''
+    Column-oriented batch of decoded CDRs of one file range.
+
+    'status' and 'offset' are compact arrays, 'columns' holds one list of strings per decoded field.
+    Iterating over the batch yields CDRRecord objects built on demand.
+
+    Attributes:
+        path (str): The file the records come from.
+        invalid (int): Number of start/stop records whose field count did not match the layout.
+        skipped (int): Number of records that are neither starts nor stops.
+    '''
+
+    __slots__ = ('path', 'names', 'status', 'offset', 'columns', 'invalid', 'skipped')
+
+    def __init__(self, path, names):
+        self.path = path
+        self.names = tuple(names)
+        self.status = array('b')
+        self.offset = array('q')
+        self.columns = tuple([] for _ in self.names)
+        self.invalid = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.status)
+
+    def column(self, name):
+        return self.columns[self.names.index(name)]
+
+    def __iter__(self):
+        for i in range(len(self.status)):
+            yield CDRRecord(self.status[i], self.offset[i], tuple(column[i] for column in self.columns), self.names)
+
+
+def parse_connect_time(value):
+    '''
+    Parse a Cisco connect/disconnect time such as '*10:38:03.123 ICT Tue Jan 11 2022' into a naive datetime.
+
+    The leading '*' or '.' clock-sync marker and the timezone abbreviation are dropped. ISO formatted values are also
+    accepted. Returns None for empty or unparseable values (calls that never connected carry no connect time).
+    '''
+    value = value.strip().lstrip('*.')
+    if not value:
+        return None
+    try:
+        parts = value.split()
+        if len(parts) == 6:
+            clock, _, _, month, day, year = parts
+            hour, minute, second = clock.split(':')
+            second, _, fraction = second.partition('.')
+            return datetime.datetime(int(year), _MONTHS[month], int(day), int(hour), int(minute), int(second),
+                                     int(fraction.ljust(6, '0')[:6]) if fraction else 0)
+        return datetime.datetime.fromisoformat(value)
+    except (KeyError, ValueError):
+        return None
+
+
+def _decode(value):
+    return value.strip(b'"').decode('utf-8', 'replace')
+
+
+def parse_range(path, start, end, layout=None):
+    '''
+    Decode the CDRs of the byte range [start, end) of a file. The range must start at the beginning of a line.
+
+    The file is memory-mapped and line breaks are found with mmap.find. Each line is copied out of the map as one bytes
+    object, which the C-level comma count and split need, so memory does not grow with the size of the range. Each line
+    is only split as far as the last decoded field.
+
+    Returns:
+        CDRBatch: The decoded records of the range.
+    '''
+    layout = layout or CDRLayout.from_config()
+    batch = CDRBatch(path, layout.fields)
+    status_field = layout.status_field
+    start_value, stop_value = layout.start_value, layout.stop_value
+    start_fields, stop_fields = layout.start_length - 1, layout.stop_length - 1
+    append_status, append_offset = batch.status.append, batch.offset.append
+    columns = batch.columns
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0 or start >= end:
+            return batch
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = min(end, len(mm))
+            find = mm.find
+            position = start
+            while position < end:
+                line_offset = position
+                newline = find(b'\n', position, end)
+                if newline == -1:
+                    newline = end
+                line = mm[position:newline]
+                position = newline + 1
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                if not line:
+                    continue
+                commas = line.count(b',')
+                if commas == start_fields:
+                    parts = line.split(b',', layout.start_maxsplit)
+                    if parts[status_field].strip(b'"') != start_value:
+                        batch.skipped += 1
+                        continue
+                    status, indexes = STATUS_START, layout.start_indexes
+                elif commas == stop_fields:
+                    parts = line.split(b',', layout.stop_maxsplit)
+                    if parts[status_field].strip(b'"') != stop_value:
+                        batch.skipped += 1
+                        continue
+                    status, indexes = STATUS_STOP, layout.stop_indexes
+                else:
+                    value = line.split(b',', status_field + 1)[status_field].strip(b'"') if commas >= status_field else b''
+                    if value in (start_value, stop_value):
+                        batch.invalid += 1
+                    else:
+                        batch.skipped += 1
+                    continue
+                append_status(status)
+                append_offset(line_offset)
+                for column, index in zip(columns, indexes):
+                    column.append(_decode(parts[index]))
+    return batch
+
+
+def split_ranges(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Split a file into byte ranges of about 'chunk_size' bytes which end on a line break.
+    '''
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    ranges = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                newline = mm.find(b'\n', end)
+                end = size if newline == -1 else newline + 1
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def iter_cdr_file(path, layout=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Decode one CDR file in the current process, yielding one CDRBatch per range of about 'chunk_size' bytes.
+    '''
+    layout = layout or CDRLayout.from_config()
+    for start, end in split_ranges(path, chunk_size):
+        yield parse_range(path, start, end, layout)
+
+
+def find_cdr_files(directory=None, pattern=None):
+    '''
+    List the CDR files of a directory, oldest name first.
+
+    Parameters:
+        directory (str, optional): The directory to scan. Default is LOCAL_PATH.
+        pattern (str, optional): A glob pattern the file names must match. Default is CDR_FILENAME_FORMAT, or every file.
+
+    Returns:
+        list: The paths of the matching files.
+    '''
+    directory = directory or config.LOCAL_PATH
+    pattern = pattern or config.CDR_FILENAME_FORMAT or '*'
+    names = sorted(name for name in os.listdir(directory) if fnmatch.fnmatch(name, pattern))
+    return [os.path.join(directory, name) for name in names if os.path.isfile(os.path.join(directory, name))]
+
+
+def _parse_task(task):
+    path, start, end, layout = task
+    return parse_range(path, start, end, layout)
+
+
+def parse_files(paths, layout=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, max_pending=None):
+    '''
+    Decode several CDR files in parallel with a process pool.
+
+    Every file is split into ranges of about 'chunk_size' bytes, so a single large file also uses all the workers.
+    Batches are yielded in file and range order while the following ranges are still being parsed. At most 'max_pending'
+    ranges are submitted ahead of the consumer, so decoded batches do not pile up when it is slower than the workers.
+
+    Parameters:
+        paths (list): The CDR files to parse.
+        layout (CDRLayout, optional): The record layout. Default is CDRLayout.from_config().
+        workers (int, optional): The number of worker processes. Default is CDR_PARSER_WORKERS, or the CPU count.
+        chunk_size (int): The size in bytes of the range handled by one task.
+        max_pending (int, optional): Ranges parsed or waiting to be yielded at a time. Default is twice 'workers'.
+
+    Yields:
+        CDRBatch: The decoded records of each range.
+    '''
+    layout = layout or CDRLayout.from_config()
+    tasks = [(path, start, end, layout) for path in paths for start, end in split_ranges(path, chunk_size)]
+    if not tasks:
+        return
+    workers = min(workers or config.CDR_PARSER_WORKERS or os.cpu_count(), len(tasks))
+    tasks = iter(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque(
+            executor.submit(_parse_task, task) for task in itertools.islice(tasks, max_pending or 2 * workers))
+        while pending:
+            batch = pending.popleft().result()
+            # a new range is only submitted once a batch leaves, the in-flight count stays bounded
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(executor.submit(_parse_task, task))
+            yield batch
@@ -8,6 +8,15 @@ load_dotenv()
 HOSTNAME = os.getenv('hostname')
 USERNAME = os.getenv('username')
 PASSWORD = os.getenv('password')
+# SBCs polled by the CDR collector (list_ip_sbc of [SBC] in ServiceControl.cfg), default is HOSTNAME
+SBC_HOSTS = [host.strip() for host in os.getenv('list_ip_sbc', HOSTNAME or '').split(',') if host.strip()]
+SBC_PORT = int(os.getenv('sbc_port', 22))
+SBC_MAX_CONNECTIONS_PER_HOST = int(os.getenv('sbc_max_connections_per_host', 2))
+CDR_COLLECTOR_WORKERS = int(os.getenv('cdr_collector_workers', 8))
+# SSH host keys of the SBCs: known_hosts file checked on top of the system one (~/.ssh/known_hosts), and whether
+# unknown hosts are trusted and added instead of rejected
+SBC_KNOWN_HOSTS = os.getenv('sbc_known_hosts', '')
+SBC_TRUST_UNKNOWN_HOSTS = os.getenv('sbc_trust_unknown_hosts', 'false').lower() in ('1', 'true', 'yes')
 
 # FILE
 REMOTE_PATH = os.getenv('remote_path')
@@ -24,6 +33,78 @@ COREAPI_SERVER =  os.getenv('coreapi_server')
 COREAPI_USERNAME =  os.getenv('coreapi_username')
 COREAPI_PASSWORD =  os.getenv('coreapi_password')
 JWT_TOKEN =  os.getenv('jwt_token')
+# local caching gateway (coreapi_gateway.py): when set, the coreapi_* functions call it instead of the server,
+# and the gateway forwards to COREAPI_UPSTREAM_SERVER
+COREAPI_GATEWAY_URL = os.getenv('coreapi_gateway_url', '')
+COREAPI_GATEWAY_PORT = int(os.getenv('coreapi_gateway_port', 3081))
+COREAPI_GATEWAY_TTLS = os.getenv('coreapi_gateway_ttls', 'clients.search=30,clients.get=60,clients.accounts.search=30,clients.accounts.get=60,reports.xdrs_list.query=10')
+COREAPI_UPSTREAM_SERVER = COREAPI_SERVER
+if COREAPI_GATEWAY_URL:
+    COREAPI_SERVER = COREAPI_GATEWAY_URL
+# seconds before the JWT 'exp' at which the shared session re-authenticates
+COREAPI_TOKEN_REFRESH_MARGIN = int(os.getenv('coreapi_token_refresh_margin', 60))
+# JSON-RPC error codes meaning the server rejected the token (e.g. revoked by a restart before its 'exp'): the token is
+# dropped and the call is sent once more with a new one
+COREAPI_AUTH_ERROR_CODES = [int(code) for code in os.getenv('coreapi_auth_error_codes', '-32002').split(',') if code.strip()]
+# JSON file holding the token shared by every process, kept apart from .env
+COREAPI_TOKEN_STORE_PATH = os.getenv('coreapi_token_store_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.coreapi_token.json'))
+# pooled HTTP transport
+COREAPI_POOL_CONNECTIONS = int(os.getenv('coreapi_pool_connections', 10))
+COREAPI_POOL_MAXSIZE = int(os.getenv('coreapi_pool_maxsize', 20))
+COREAPI_KEEP_ALIVE = os.getenv('coreapi_keep_alive', 'true').lower() in ('1', 'true', 'yes')
+COREAPI_CONNECT_TIMEOUT = float(os.getenv('coreapi_connect_timeout', 5))
+COREAPI_READ_TIMEOUT = float(os.getenv('coreapi_read_timeout', 60))
+# client-side scheduler of the coreAPI calls (coreapi_scheduler.scheduler): token bucket (0 = no rate limit),
+# adaptive concurrency limit (max 0 = COREAPI_POOL_MAXSIZE), slots kept for interactive calls
+COREAPI_SCHEDULER_ENABLED = os.getenv('coreapi_scheduler_enabled', 'true').lower() in ('1', 'true', 'yes')
+COREAPI_RATE_LIMIT = float(os.getenv('coreapi_rate_limit', 0))
+COREAPI_RATE_BURST = int(os.getenv('coreapi_rate_burst', 0))
+COREAPI_CONCURRENCY_INITIAL = int(os.getenv('coreapi_concurrency_initial', 8))
+COREAPI_CONCURRENCY_MIN = int(os.getenv('coreapi_concurrency_min', 1))
+COREAPI_CONCURRENCY_MAX = int(os.getenv('coreapi_concurrency_max', 0))
+COREAPI_LATENCY_TOLERANCE = float(os.getenv('coreapi_latency_tolerance', 2.0))
+COREAPI_INTERACTIVE_RESERVE = float(os.getenv('coreapi_interactive_reserve', 0.2))
+# tail-latency controls (coreapi_resilience.resilience): deadline of a call in seconds including its retries
+# (0 = none), cap of the RETRY_DELAY based backoff, hedged reads after the p95 latency, circuit breaker
+COREAPI_CALL_DEADLINE = float(os.getenv('coreapi_call_deadline', 120))
+COREAPI_RETRY_MAX_DELAY = float(os.getenv('coreapi_retry_max_delay', 30))
+COREAPI_HEDGING_ENABLED = os.getenv('coreapi_hedging_enabled', 'false').lower() in ('1', 'true', 'yes')
+COREAPI_HEDGE_METHODS = os.getenv('coreapi_hedge_methods', 'clients.get,clients.accounts.get,clients.search,clients.accounts.search')
+COREAPI_HEDGE_MIN_DELAY = float(os.getenv('coreapi_hedge_min_delay', 0.05))
+COREAPI_HEDGE_BUDGET = float(os.getenv('coreapi_hedge_budget', 0.1))
+COREAPI_BREAKER_THRESHOLD = int(os.getenv('coreapi_breaker_threshold', 5))
+COREAPI_BREAKER_RESET = float(os.getenv('coreapi_breaker_reset', 30))
+# per-method RPC metrics (coreapi_metrics.metrics)
+COREAPI_METRICS_ENABLED = os.getenv('coreapi_metrics_enabled', 'false').lower() in ('1', 'true', 'yes')
+# number of calls sent in one JSON-RPC batch array
+COREAPI_BATCH_SIZE = int(os.getenv('coreapi_batch_size', 100))
+# paged search iterators
+COREAPI_PAGE_SIZE = int(os.getenv('coreapi_page_size', 1000))
+COREAPI_PREFETCH_PAGES = int(os.getenv('coreapi_prefetch_pages', 1))
+# bytes read at a time by the streaming decoder of large search results (coreapi_stream.iter_result)
+COREAPI_STREAM_CHUNK_SIZE = int(os.getenv('coreapi_stream_chunk_size', 65536))
+# search parameter the server accepts a field list in (empty = fields are only projected client-side)
+COREAPI_PROJECTION_PARAM = os.getenv('coreapi_projection_param', '')
+# cap on in-flight requests of the asyncio client
+COREAPI_ASYNC_MAX_IN_FLIGHT = int(os.getenv('coreapi_async_max_in_flight', 16))
+# read-through cache of client/account records (TTL in seconds)
+COREAPI_CACHE_ENABLED = os.getenv('coreapi_cache_enabled', 'false').lower() in ('1', 'true', 'yes')
+COREAPI_CACHE_MAX_ENTRIES = int(os.getenv('coreapi_cache_max_entries', 4096))
+COREAPI_CACHE_CLIENT_TTL = float(os.getenv('coreapi_cache_client_ttl', 300))
+COREAPI_CACHE_ACCOUNT_TTL = float(os.getenv('coreapi_cache_account_ttl', 300))
+COREAPI_CACHE_CLIENT_ACCOUNTS_TTL = float(os.getenv('coreapi_cache_client_accounts_ttl', 60))
+# local SQLite snapshot of the client/account directory
+DIRECTORY_SNAPSHOT_PATH = os.getenv('directory_snapshot_path', 'directory_snapshot.db')
+# XDR export: the XDR reports come from their own coreAPI server and account (the ones of coreAPI.get_xdrs, the
+# password is set in .env), with their token kept in a store of their own
+XDR_COREAPI_SERVER = os.getenv('xdr_coreapi_server', 'http://10.155.19.150:3080')
+XDR_COREAPI_USERNAME = os.getenv('xdr_coreapi_username', 'servicecontrol')
+XDR_COREAPI_PASSWORD = os.getenv('xdr_coreapi_password')
+XDR_TOKEN_STORE_PATH = os.getenv('xdr_token_store_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.xdr_coreapi_token.json'))
+XDR_PAGE_LIMIT = int(os.getenv('xdr_page_limit', 10000))
+XDR_EXPORT_WORKERS = int(os.getenv('xdr_export_workers', 4))
+# per-client hourly usage rollups (xdr_rollup.UsageRollup)
+XDR_ROLLUP_PATH = os.getenv('xdr_rollup_path', 'xdr_rollup.db')
 
 
 # CDR 
@@ -39,6 +120,20 @@ ACCOUTING_STATUS = os.getenv('acc_status_field')
 
 CONNECT_TIME_START = os.getenv('cisco_connect_time_start_field')
 CONNECT_TIME_STOP = os.getenv('cisco_connect_time_stop_field')
+# field holding the accounting id shared by the start and stop records of a call
+CDR_CALL_ID_FIELD = int(os.getenv('cdr_call_id_field', 2))
+# worker processes of the CDR parser (0 = CPU count)
+CDR_PARSER_WORKERS = int(os.getenv('cdr_parser_workers', 0))
+# start/stop correlation: seconds an unmatched leg stays open, cap on open legs, checkpoint file
+CDR_CORRELATION_HORIZON = int(os.getenv('cdr_correlation_horizon', 86400))
+CDR_CORRELATION_MAX_OPEN = int(os.getenv('cdr_correlation_max_open', 1000000))
+CDR_CORRELATION_CHECKPOINT = os.getenv('cdr_correlation_checkpoint', 'cdr_correlation.json')
+# calling / called number fields as 'start index,stop index' (empty = not decoded)
+CDR_CALLING_NUMBER_FIELDS = tuple(int(i) for i in os.getenv('cdr_calling_number_fields', '').split(',') if i.strip())
+CDR_CALLED_NUMBER_FIELDS = tuple(int(i) for i in os.getenv('cdr_called_number_fields', '').split(',') if i.strip())
+# XDR/CDR reconciliation: start time tolerance in seconds, records sorted in memory per run
+RECONCILE_TOLERANCE = float(os.getenv('reconcile_tolerance', 5))
+RECONCILE_RUN_SIZE = int(os.getenv('reconcile_run_size', 200000))
 
 TIMEZONE_MAPPING_FILE_PATH = os.getenv('timezone_mapping_file_path')
 CDR_TIMEZONE = os.getenv('cdr_timezone')
@@ -53,6 +148,32 @@ VCS_PASSWORD = os.getenv('vcs_password')
 VCS_ADMIN = os.getenv('vcs_admin')
 VCS_ADMIN_PASSWORD= os.getenv('vcs_admin_password')
 VCS_ADMIN_ROLES_NAME = os.getenv('vcs_admin_roles_name')
+# seconds a user's role is cached by coreapi_clients_authenticate (0 disables)
+VCS_ROLE_CACHE_TTL = float(os.getenv('vcs_role_cache_ttl', 60))
+# seconds a successful login check is remembered (0 disables)
+VCS_AUTH_CACHE_TTL = float(os.getenv('vcs_auth_cache_ttl', 0))
+
+
+# DATABASE ([POSTGRESQL] / [MYSQL] of ServiceControl.cfg), driver is sqlite, postgresql or mysql
+DB_DRIVER = os.getenv('db_driver', 'sqlite')
+DB_HOST = os.getenv('db_host')
+DB_PORT = os.getenv('db_port')
+DB_NAME = os.getenv('db_database', 'service_control_db')
+DB_USER = os.getenv('db_user_name')
+DB_PASSWORD = os.getenv('db_password')
+DB_SQLITE_PATH = os.getenv('db_sqlite_path', 'service_control.db')
+# buffered bulk writer (db_sink.BulkWriter)
+DB_SINK_MAX_ROWS = int(os.getenv('db_sink_max_rows', 1000))
+DB_SINK_FLUSH_INTERVAL = float(os.getenv('db_sink_flush_interval', 1.0))
+DB_SINK_QUEUE_SIZE = int(os.getenv('db_sink_queue_size', 10000))
+# flush attempts of a batch before it is moved to the dead letters, and dead letter batches kept in memory
+DB_SINK_MAX_ATTEMPTS = int(os.getenv('db_sink_max_attempts', 5))
+DB_SINK_DEAD_LETTERS = int(os.getenv('db_sink_dead_letters', 100))
+# log retention: rows of DB_LOG_TABLE older than DB_TIME_DELETE_LOG days are deleted in chunks
+DB_TIME_DELETE_LOG = float(os.getenv('time_delete_log', 60))
+DB_LOG_TABLE = os.getenv('log_table', 'vcsapi_systemlog')
+DB_LOG_TIME_COLUMN = os.getenv('log_time_column', 'created_at')
+DB_DELETE_CHUNK_SIZE = int(os.getenv('db_delete_chunk_size', 5000))
 
 
 
@@ -1,72 +1,109 @@
-from jsonrpc_requests import Server
 import jsonrpc_requests
+import requests
+import hashlib
+import hmac
+import os
 import sys
 import jwt
 import datetime
+import itertools
 from pathlib import Path 
 # Get the parent directory of the current script file (2 levels up from the script's location).
 # sys.path.insert(0, str(Path(__file__).parents[1]))
 from config import config
+from coreapi_session import get_coreapi_session, get_vcs_admin_session, is_auth_rejected
+from coreapi_transport import get_transport
+from coreapi_paging import iter_pages
+from coreapi_stream import iter_result
+from coreapi_scheduler import INTERACTIVE, BULK, priority
+from coreapi_records import project, compact_records
+from coreapi_cache import TTLCache
+from coreapi_metrics import metrics
+from token_store import get_token_store
 
 def get_coreapi():
-    coreapi_unauthorized = Server(config.COREAPI_SERVER)
-    print(config.COREAPI_USERNAME)
-    print(config.COREAPI_PASSWORD)
-    result = coreapi_unauthorized.iam.auth.jwt.authenticate(
-        login=config.COREAPI_USERNAME,
-        password=config.COREAPI_PASSWORD
-    )
-    token = result['token']
-    coreapi = Server(config.COREAPI_SERVER, headers={'Authorization': f'Bearer {token}'})
+    '''
+    Return the shared authenticated coreAPI Server.
+
+    The Server is kept by the process-wide CoreAPISession, which authenticates once per token lifetime
+    instead of on every call. Use 'get_coreapi_session().auth_calls' to see how many authentications were made.
+
+    Returns:
+        Server: The authenticated Server, or False if the authentication failed.
+    '''
     try:
-        coreapi.clients.search(limit=1)
-        return coreapi
-    except:
+        return get_coreapi_session().get_server()
+    except jsonrpc_requests.jsonrpc.JSONRPCError:
         return False
 
 
-def check_token_avaiable():
-    '''
-    Check if the JWT token is available and still valid.
+# read-through caches of client and account records, used when COREAPI_CACHE_ENABLED is set
+_record_caches = {
+    'clients': TTLCache(ttl=config.COREAPI_CACHE_CLIENT_TTL, max_entries=config.COREAPI_CACHE_MAX_ENTRIES),
+    'accounts': TTLCache(ttl=config.COREAPI_CACHE_ACCOUNT_TTL, max_entries=config.COREAPI_CACHE_MAX_ENTRIES),
+    'client_accounts': TTLCache(ttl=config.COREAPI_CACHE_CLIENT_ACCOUNTS_TTL, max_entries=config.COREAPI_CACHE_MAX_ENTRIES),
+}
+
 
-    This function retrieves the JWT token from the specified config_section and config_assisged_name in the configuration file. 
-    If the token has expired, a new JWT token is generated using the 'generate_jwt_token' function and returned. 
-    If the token is still valid, the original JWT token is returned.
+def _read_through(entity, key, loader):
+    if not config.COREAPI_CACHE_ENABLED:
+        return loader()
+    return _record_caches[entity].get_or_load(key, loader)
+
+
+def coreapi_cache_invalidate(entity: str, key=None):
+    '''
+    Drop one cached record, or every record of an entity when 'key' is None.
 
     Parameters:
-        config_section (str): The config_section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
-        config_assisged_name (str): The name of the token variable in the specified config_section. Default is 'jwt_token'.
+        entity (str): 'clients' (coreapi_clients_get), 'accounts' (coreapi_accounts_get) or 'client_accounts' (coreapi_accounts_search).
+        key (int, optional): The client or account ID to drop.
+    '''
+    if key is None:
+        _record_caches[entity].clear()
+    else:
+        _record_caches[entity].invalidate(key)
 
-    Returns:
-        str: The JWT token, either the original token if it is still valid, or a new token if the original token has expired or encountered decoding errors.
 
-    Raises:
-        jwt.exceptions.DecodeError: If there is an error while decoding the JWT token.
-        configparser.NoSectionError: If the specified config_section is not found in the configuration.
+def coreapi_cache_clear():
     '''
-    try:
-        jwt_token = config.JWT_TOKEN
-        decoded_data = jwt.decode(jwt=jwt_token, algorithms=['HS256'], options={'verify_signature': False})
-        datetime_expire = datetime.datetime.fromtimestamp(decoded_data['exp'])
+    Drop every cached client and account record.
+    '''
+    for cache in _record_caches.values():
+        cache.clear()
 
-        if datetime.datetime.now() > datetime_expire:
-            return generate_jwt_token()
-        return jwt_token
-    except jwt.exceptions.DecodeError:
-        return generate_jwt_token()
 
+def coreapi_cache_stats():
+    '''
+    Return the entries, hits, misses, coalesced misses and evictions of each record cache.
+    '''
+    return {entity: cache.stats() for entity, cache in _record_caches.items()}
+
+
+def check_token_avaiable():
+    '''
+    Check if the JWT token is available and still valid.
+
+    The token is read from the cross-process token store (COREAPI_TOKEN_STORE_PATH) through the shared coreAPI session.
+    If the token is missing or about to expire, one process authenticates again and stores the new token while the
+    other processes wait for it and reuse it. If the token is still valid, the stored token is returned.
+
+    Returns:
+        str: The JWT token, either the stored token if it is still valid, or a new token if it has expired.
+             If the authentication fails, the exception is returned.
+    '''
+    try:
+        return get_coreapi_session().get_token()
+    except jsonrpc_requests.jsonrpc.JSONRPCError as e:
+        return e
 
 
 def generate_jwt_token():
     '''
     Generate a new JWT token by authenticating with the coreAPI server.
 
-    This function attempts to authenticate with the coreAPI server using the specified login and password (VCS_LOGIN and VCS_PASSWORD constants). 
-    If the authentication is successful, the JWT token is obtained from the response and stored in the specified config_section and config_assisged_name using the 'conf.write_token_to_config' function.
-
-    Parameters:
-        config_section (str): The config_section name in the configuration file where the new JWT token will be stored. Default is 'coreAPI_Token'.
-        config_assisged_name (str): The name of the token variable in the specified config_section. Default is 'jwt_token'.
+    This function attempts to authenticate with the coreAPI server using the specified login and password (COREAPI_USERNAME and COREAPI_PASSWORD constants). 
+    If the authentication is successful, the JWT token is obtained from the response and atomically written to the cross-process token store.
 
     Returns:
         str: The newly generated JWT token.
@@ -77,14 +114,14 @@ def generate_jwt_token():
         jsonrpc_requests.jsonrpc.JSONRPCError: If there is an error in the JSON-RPC response from the server.
     '''
     try:
-        coreapi_unauthorized = Server(config.COREAPI_SERVER)
-        print(f"{config.COREAPI_SERVER=}")
+        coreapi_unauthorized = get_transport().server(config.COREAPI_SERVER)
+        metrics.record_auth_refresh('generate_jwt_token')
         result = coreapi_unauthorized.iam.auth.jwt.authenticate(
             login=config.COREAPI_USERNAME,
             password=config.COREAPI_PASSWORD
         )
         jwt_token = result['token']
-        config.write_to_env_file(key='jwt_token', value=jwt_token)
+        get_token_store().write(jwt_token)
         return jwt_token
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
@@ -99,6 +136,7 @@ def coreapi_clients_get(client_id: int = 0):
     Get client information from the coreAPI server using the provided client ID.
 
     This function queries the coreAPI server to get information about the client with the specified 'client_id'.
+    When COREAPI_CACHE_ENABLED is set, the result is served from the in-memory read-through cache (see 'coreapi_cache_stats').
 
     Parameters:
         config_section (str): The config_section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
@@ -114,28 +152,121 @@ def coreapi_clients_get(client_id: int = 0):
         jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
     '''
     try:
-        jwt_token = check_token_avaiable()
-
-        coreapi = Server(
-            config.COREAPI_SERVER,
-            headers={
-                'Authorization': 'Bearer {}'.format(jwt_token)
-            }
-        )
+        def load():
+            return get_coreapi_session().run(lambda token: _server(token).clients.get(id=client_id))
 
-        result = coreapi.clients.get(id=client_id)
-        return result
+        return _read_through('clients', client_id, load)
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
         return e
     
     
-def coreapi_clients_search(is_limit = False, limit: int = 0):
+def _server(token):
+    return get_transport().server(config.COREAPI_SERVER, token=token)
+
+
+def _projection(fields):
+    # the field list is only sent when the server is known to accept it (COREAPI_PROJECTION_PARAM)
+    if fields and config.COREAPI_PROJECTION_PARAM:
+        return {config.COREAPI_PROJECTION_PARAM: list(fields)}
+    return {}
+
+
+def iter_clients(page_size: int = 0, prefetch: int = 0, fields=None, **filters):
+    '''
+    Iterate over the clients in the coreAPI server page by page.
+
+    The clients are requested with 'clients.search(offset=..., limit=page_size)' and the next page is prefetched on a
+    background thread while the caller works on the current one, so memory stays bounded to a few pages.
+
+    Parameters:
+        page_size (int): The number of clients requested per page. Default is 0, which means COREAPI_PAGE_SIZE is used.
+        prefetch (int): The number of pages fetched ahead. Default is 0, which means COREAPI_PREFETCH_PAGES is used.
+        fields (list, optional): Only keep these fields of every record (see 'coreapi_clients_search').
+        **filters: Additional search parameters passed to 'clients.search'.
+
+    Yields:
+        dict: The information about each client.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+    '''
+    def fetch_page(offset, limit):
+        with priority(BULK):
+            return project(get_coreapi_session().run(
+                lambda token: _server(token).clients.search(offset=offset, limit=limit, **_projection(fields), **filters)
+            ), fields)
+
+    return iter_pages(fetch_page, page_size or config.COREAPI_PAGE_SIZE, prefetch or config.COREAPI_PREFETCH_PAGES)
+
+
+def iter_accounts(page_size: int = 0, prefetch: int = 0, fields=None, **filters):
+    '''
+    Iterate over the accounts in the coreAPI server page by page.
+
+    Works like 'iter_clients' but pages through 'clients.accounts.search'. Pass 'clients_id' to only iterate over the
+    accounts of one client.
+
+    Parameters:
+        page_size (int): The number of accounts requested per page. Default is 0, which means COREAPI_PAGE_SIZE is used.
+        prefetch (int): The number of pages fetched ahead. Default is 0, which means COREAPI_PREFETCH_PAGES is used.
+        fields (list, optional): Only keep these fields of every record (see 'coreapi_clients_search').
+        **filters: Additional search parameters passed to 'clients.accounts.search'.
+
+    Yields:
+        dict: The information about each account.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+    '''
+    def fetch_page(offset, limit):
+        with priority(BULK):
+            return project(get_coreapi_session().run(
+                lambda token: _server(token).clients.accounts.search(offset=offset, limit=limit, **_projection(fields), **filters)
+            ), fields)
+
+    return iter_pages(fetch_page, page_size or config.COREAPI_PAGE_SIZE, prefetch or config.COREAPI_PREFETCH_PAGES)
+
+
+def iter_clients_search(limit: int = 10000, fields=None, **filters):
+    '''
+    Run one 'clients.search(limit=limit)' and yield the clients one at a time while the response is received.
+
+    The response is requested gzip-compressed and its result array is decoded incrementally (see
+    coreapi_stream.iter_result), so a 10000-client answer is never held in memory as a whole.
+
+    Parameters:
+        limit (int): The number of clients requested. Default is 10000.
+        fields (list, optional): Only keep these fields of every record (see 'coreapi_clients_search').
+        **filters: Additional search parameters passed to 'clients.search'.
+
+    Yields:
+        dict: The information about each client.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+    '''
+    params = dict(filters, limit=limit, **_projection(fields))
+    records = get_coreapi_session().run_iter(
+        lambda token: iter_result(config.COREAPI_SERVER, 'clients.search', params, token=token, priority_class=BULK)
+    )
+    if not fields:
+        yield from records
+        return
+    for record in records:
+        yield {field: record.get(field) for field in fields}
+
+
+def coreapi_clients_search(is_limit = False, limit: int = 0, fields=None, compact=None):
     '''
     Search for clients infomation in the coreAPI server using the provided options.
 
     The function searches for clients based on the provided options. If is_limit is False, the API will return all client's information, else it will return the number of client information according to the 'limit' variable.
+    The results are collected page by page from 'iter_clients', so large tenants are no longer truncated at 10000 clients.
 
     Parameters:
         config_section (str): The section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
@@ -145,31 +276,28 @@ def coreapi_clients_search(is_limit = False, limit: int = 0):
                          If False, no limit is applied. Default is False.
         limit (int): The maximum number of results to return. This parameter is only used if 'is_limit' is True.
                      Default is 0, which means no limit is applied.
+        fields (list, optional): Only return these fields of every client. The list is sent to the server as
+                                 COREAPI_PROJECTION_PARAM when that is set, and always applied to the received records.
+        compact (str, optional): 'columns' to return a coreapi_records.RecordList, 'slots' to return a list of
+                                 __slots__ records, instead of a list of dictionaries. Default is None.
 
     Returns:
         list: A list of dictionaries, each containing information about clients that matches the search criteria.
               If no clients match the search criteria, an empty list is returned.
+              With 'compact', the compact container is returned instead.
 
     Raises:
         jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
         jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
     '''
     try:
-        # jwt_token = check_token_avaiable()
-
-        # coreapi = Server(
-        #     config.COREAPI_SERVER,
-        #     headers={
-        #         'Authorization': 'Bearer {}'.format(jwt_token)
-        #     }
-        # )
-
-        coreapi = get_coreapi()
         if is_limit:
-            result = coreapi.clients.search(limit=limit)
+            records = itertools.islice(iter_clients(page_size=min(limit, config.COREAPI_PAGE_SIZE) or 1, fields=fields), limit)
         else:
-            result = coreapi.clients.search(limit = 10000)
-        return result
+            records = iter_clients(fields=fields)
+        if compact:
+            return compact_records(records, fields, compact)
+        return list(records)
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
@@ -181,6 +309,7 @@ def coreapi_accounts_search(client_id: int = 0):
     Search for accounts associated with a client in the coreAPI server.
 
     The function searches for accounts associated with the specified 'client_id'.
+    When COREAPI_CACHE_ENABLED is set, the result is served from the in-memory read-through cache (see 'coreapi_cache_stats').
 
     Parameters:
         config_section (str): The section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
@@ -205,21 +334,22 @@ def coreapi_accounts_search(client_id: int = 0):
         #         'Authorization': 'Bearer {}'.format(jwt_token)
         #     }
         # )
-        coreapi = get_coreapi()
+        def load():
+            return get_coreapi_session().run(lambda token: _server(token).clients.accounts.search(clients_id=client_id))
 
-        result = coreapi.clients.accounts.search(clients_id=client_id)
-        return result
+        return _read_through('client_accounts', client_id, load)
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
         return e
     
 
-def coreapi_accounts_search_list(is_limit = False, limit: int = 0):
+def coreapi_accounts_search_list(is_limit = False, limit: int = 0, fields=None, compact=None):
     '''
     Search for a list accounts in the coreAPI server based on the provided options.
 
     The function searches for alist of accounts based on the provided options.
+    The results are collected page by page from 'iter_accounts'.
 
     Parameters:
         config_section (str): The section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
@@ -229,31 +359,26 @@ def coreapi_accounts_search_list(is_limit = False, limit: int = 0):
                          If False, no limit is applied. Default is False.
         limit (int): The maximum number of results to return. This parameter is only used if 'is_limit' is True.
                      Default is 0, which means no limit is applied.
+        fields (list, optional): Only return these fields of every account (see 'coreapi_clients_search').
+        compact (str, optional): 'columns' or 'slots' for a compact container (see 'coreapi_clients_search').
 
     Returns:
         list: A list of dictionaries, each containing information about an account that matches the search criteria.
               If no accounts match the search criteria, an empty list is returned.
+              With 'compact', the compact container is returned instead.
 
     Raises:
         jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
         jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
     '''
     try:
-        # jwt_token = check_token_avaiable()
-        # print(f"{config.COREAPI_SERVER}")
-        # coreapi = Server(
-        #     config.COREAPI_SERVER,
-        #     headers={
-        #         'Authorization': 'Bearer {}'.format(jwt_token)
-        #     }
-        # )
-        coreapi = get_coreapi()
-
         if is_limit:
-            result = coreapi.clients.accounts.search(limit=limit)
+            records = itertools.islice(iter_accounts(page_size=min(limit, config.COREAPI_PAGE_SIZE) or 1, fields=fields), limit)
         else:
-            result = coreapi.clients.accounts.search()
-        return result
+            records = iter_accounts(fields=fields)
+        if compact:
+            return compact_records(records, fields, compact)
+        return list(records)
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
@@ -265,6 +390,7 @@ def coreapi_accounts_get(account_id: int = 0):
     Get account information from the coreAPI server using the provided account ID.
 
     The function queries the coreAPI server to get information about the account with the specified 'account_id'.
+    When COREAPI_CACHE_ENABLED is set, the result is served from the in-memory read-through cache (see 'coreapi_cache_stats').
 
     Parameters:
         config_section (str): The section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
@@ -289,91 +415,226 @@ def coreapi_accounts_get(account_id: int = 0):
         #     }
         # )
 
-        coreapi = get_coreapi()
+        def load():
+            return get_coreapi_session().run(lambda token: _server(token).clients.accounts.get(id=account_id))
 
-        result = coreapi.clients.accounts.get(id=account_id)
-        return result
+        return _read_through('accounts', account_id, load)
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return e
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
         return e
     
-def coreapi_clients_authenticate(user: str = '', password: str = ''):
+def _batch_auth_rejected(responses):
+    items = responses if isinstance(responses, list) else [responses]
+    return any(
+        isinstance(item, dict) and isinstance(item.get('error'), dict)
+        and item['error'].get('code') in config.COREAPI_AUTH_ERROR_CODES
+        for item in items
+    )
+
+
+def coreapi_batch_call(calls, chunk_size: int = 0):
     '''
-    Authenticate a user with the coreAPI server and check if the user has the required admin role.
+    Call several coreAPI methods using JSON-RPC 2.0 batch requests.
 
-    This function authenticates an admin user with 'All Resellers' in Reseller field (VCS_ADMIN and VCS_ADMIN_PASSWORD constants) with the coreAPI server to obtain an JWT token. 
-    Then, authenticate the user with the specified 'user' (username) and 'password'. 
-    If the user is successfully authenticated. Then use admin user which is authenticated before to check if the user has the admin role (VCS_ADMIN_ROLES_NAME), the function returns True; otherwise, it returns False.
+    The calls are split into chunks of 'chunk_size' and each chunk is sent as one batch array, so N calls cost N/chunk_size round trips.
+    Responses are matched back to the calls by their 'id'. A failed call does not fail the batch: its slot holds the exception instead of the result.
+    A chunk rejected for its token (COREAPI_AUTH_ERROR_CODES) is sent once more after the session re-authenticates.
 
     Parameters:
-        config_section (str): The config_section name in the configuration file where the JWT token is stored. Default is 'coreAPI_Token'.
-        config_config_assisged_name (str): The name of the token variable in the specified config_section. Default is 'jwt_token'.
-        user (str): The username of the user to authenticate.
-        password (str): The password of the user to authenticate.
+        calls (list): A list of (method_name, params) tuples, e.g. [('clients.get', {'id': 36})].
+        chunk_size (int): The maximum number of calls per batch request. Default is 0, which means COREAPI_BATCH_SIZE is used.
 
     Returns:
-        bool: True if the user is authenticated and has the required admin role; otherwise, False.
+        list: The results in the same order as 'calls'. Failed calls hold a jsonrpc_requests.jsonrpc.TransportError or ProtocolError.
 
     Raises:
-        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
-        jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while authenticating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If the authentication request is rejected by the server.
     '''
-    try:
-        coreapi_unauthorized = Server(config.VCS_COREAPI)
+    chunk_size = chunk_size or config.COREAPI_BATCH_SIZE
+    transport = get_transport()
+    session = get_coreapi_session()
+    jwt_token = session.get_token()
+    results = [None] * len(calls)
+
+    def send(payload, token):
+        try:
+            return transport.post(config.COREAPI_SERVER, payload, token=token)
+        except requests.RequestException as e:
+            raise jsonrpc_requests.jsonrpc.TransportError('Error calling batch of %d methods' % len(payload), cause=e)
+        except ValueError as e:
+            raise jsonrpc_requests.jsonrpc.ProtocolError('Cannot deserialize response body: %s' % e)
+
+    for start in range(0, len(calls), chunk_size):
+        chunk_ids = range(start, min(start + chunk_size, len(calls)))
+        payload = []
+        for call_id in chunk_ids:
+            method_name, params = calls[call_id]
+            request = {'jsonrpc': '2.0', 'method': method_name, 'id': call_id}
+            if params:
+                request['params'] = params
+            payload.append(request)
+
+        try:
+            try:
+                responses = send(payload, jwt_token)
+            except jsonrpc_requests.jsonrpc.TransportError as e:
+                if not is_auth_rejected(e):
+                    raise
+                responses = None
+            if responses is None or _batch_auth_rejected(responses):
+                # the token was rejected before its expiry, the chunk is sent once more with a new one
+                session.invalidate(jwt_token)
+                jwt_token = session.get_token()
+                responses = send(payload, jwt_token)
+        except jsonrpc_requests.jsonrpc.JSONRPCError as error:
+            for call_id in chunk_ids:
+                results[call_id] = error
+            continue
+
+        # a server that rejects the whole batch answers with a single error object
+        if not isinstance(responses, list):
+            responses = []
+        responses_by_id = {response.get('id'): response for response in responses if isinstance(response, dict)}
+
+        for call_id in chunk_ids:
+            response = responses_by_id.get(call_id)
+            if response is None:
+                results[call_id] = jsonrpc_requests.jsonrpc.ProtocolError('No response for batch call id %s' % call_id)
+            elif response.get('error'):
+                code = response['error'].get('code', '')
+                message = response['error'].get('message', '')
+                results[call_id] = jsonrpc_requests.jsonrpc.ProtocolError('Error: %s %s' % (code, message), server_data=response)
+            elif 'result' not in response:
+                results[call_id] = jsonrpc_requests.jsonrpc.ProtocolError('Response without a result field', server_data=response)
+            else:
+                results[call_id] = response['result']
+    return results
 
-        # this will be used to check user role
-        admin_login = coreapi_unauthorized.iam.auth.jwt.authenticate(
-            login=config.VCS_ADMIN,
-            password=config.VCS_ADMIN_PASSWORD
-        )
-        jwt_token = admin_login['token']
 
-        coreapi = Server(
-            config.VCS_COREAPI,
-            headers={
-                'Authorization': 'Bearer {}'.format(jwt_token)
-            }
-        )
+def coreapi_clients_get_many(client_ids, chunk_size: int = 0):
+    '''
+    Get information about several clients using batched 'clients.get' calls.
 
-        # check the valid login
-        user_login = coreapi_unauthorized.iam.auth.jwt.authenticate(
-            login=user,
-            password=password
-        )
+    Parameters:
+        client_ids (list): The IDs of the clients to retrieve information for.
+        chunk_size (int): The maximum number of clients per batch request. Default is 0, which means COREAPI_BATCH_SIZE is used.
 
-        if user_login:
-            result = coreapi.iam.users.search(login=user)
-            roles_name = result[0]['roles_name']
-            if roles_name == config.VCS_ADMIN_ROLES_NAME:
+    Returns:
+        dict: A dictionary mapping each client ID to its information, or to the exception returned for that client.
+    '''
+    client_ids = list(client_ids)
+    results = coreapi_batch_call([('clients.get', {'id': client_id}) for client_id in client_ids], chunk_size=chunk_size)
+    return dict(zip(client_ids, results))
+
+
+def coreapi_accounts_get_many(account_ids, chunk_size: int = 0):
+    '''
+    Get information about several accounts using batched 'clients.accounts.get' calls.
+
+    Parameters:
+        account_ids (list): The IDs of the accounts to retrieve information for.
+        chunk_size (int): The maximum number of accounts per batch request. Default is 0, which means COREAPI_BATCH_SIZE is used.
+
+    Returns:
+        dict: A dictionary mapping each account ID to its information, or to the exception returned for that account.
+    '''
+    account_ids = list(account_ids)
+    results = coreapi_batch_call([('clients.accounts.get', {'id': account_id}) for account_id in account_ids], chunk_size=chunk_size)
+    return dict(zip(account_ids, results))
+
+
+# user -> roles_name, looked up with the admin session
+_user_roles_cache = TTLCache(ttl=config.VCS_ROLE_CACHE_TTL, max_entries=config.COREAPI_CACHE_MAX_ENTRIES)
+# keyed hashes of credentials which passed the full check; never holds passwords or failed attempts
+_positive_auth_cache = TTLCache(ttl=config.VCS_AUTH_CACHE_TTL, max_entries=config.COREAPI_CACHE_MAX_ENTRIES)
+_positive_auth_salt = os.urandom(32)
+
+
+def _credentials_key(user, password):
+    return hmac.new(_positive_auth_salt, f'{user}\0{password}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _user_roles_name(user):
+    def load():
+        session = get_vcs_admin_session()
+        result = session.run(lambda token: session.transport.server(session.server_url, token=token).iam.users.search(login=user))
+        return result[0]['roles_name'] if result else None
+
+    if config.VCS_ROLE_CACHE_TTL <= 0:
+        return load()
+    return _user_roles_cache.get_or_load(user, load)
+
+
+def coreapi_auth_cache_clear():
+    '''
+    Drop the cached user roles and the cached successful logins, e.g. after a role or password change.
+    '''
+    _user_roles_cache.clear()
+    _positive_auth_cache.clear()
+
+
+def coreapi_clients_authenticate(user: str = '', password: str = ''):
+    '''
+    Authenticate a user with the coreAPI server and check if the user has the required admin role.
+
+    This function authenticates the user with the specified 'user' (username) and 'password'.
+    If the user is successfully authenticated, the admin user with 'All Resellers' in Reseller field (VCS_ADMIN and VCS_ADMIN_PASSWORD constants) is used to check if the user has the admin role (VCS_ADMIN_ROLES_NAME): the function returns True; otherwise, it returns False.
+    The admin session is shared and only re-authenticated near its token expiry, and the role of each user is cached for VCS_ROLE_CACHE_TTL seconds,
+    so a login check costs one RPC in steady state. If VCS_AUTH_CACHE_TTL is set, successful checks are also remembered for that many seconds,
+    keyed by a salted HMAC of the credentials; failed checks are never cached.
+
+    Parameters:
+        user (str): The username of the user to authenticate.
+        password (str): The password of the user to authenticate.
+
+    Returns:
+        bool: True if the user is authenticated and has the required admin role; otherwise, False.
+    '''
+    try:
+        credentials_key = None
+        if config.VCS_AUTH_CACHE_TTL > 0:
+            credentials_key = _credentials_key(user, password)
+            if _positive_auth_cache.get(credentials_key):
                 return True
-            else:
-                return False
+
+        # check the valid login, sent ahead of the queued bulk calls
+        with priority(INTERACTIVE):
+            coreapi_unauthorized = get_transport().server(config.VCS_COREAPI)
+            user_login = coreapi_unauthorized.iam.auth.jwt.authenticate(
+                login=user,
+                password=password
+            )
+            is_admin = bool(user_login) and _user_roles_name(user) == config.VCS_ADMIN_ROLES_NAME
+
+        if is_admin:
+            if credentials_key is not None:
+                _positive_auth_cache.set(credentials_key, True)
+            return True
         return False
     except jsonrpc_requests.jsonrpc.TransportError as e:
         return False
     except jsonrpc_requests.jsonrpc.ProtocolError as e:
         return False
 
-import requests  
-import json
 def request_token():
-    url = 'http://10.155.19.150:3080'
+    url = config.XDR_COREAPI_SERVER
     json={
     "jsonrpc": "2.0",
     "method": "iam.auth.jwt.authenticate",
     "params": {
-        "login": "servicecontrol",
-        "password": "Vcs@2023"
+        "login": config.XDR_COREAPI_USERNAME,
+        "password": config.XDR_COREAPI_PASSWORD
     },
     "id": 1
     }
-    headers = {'Content-Type': 'application/json'}
-    
-    return requests.post(url, headers=headers, json=json).json()['result']['token']
+
+    metrics.record_auth_refresh('request_token')
+    return get_transport().post(url, json)['result']['token']
 
 def get_xdrs():
-    url = 'http://10.155.19.150:3080'
+    url = config.XDR_COREAPI_SERVER
     json={
     "jsonrpc": "2.0",
     "method": "reports.xdrs_list.query",
@@ -385,9 +646,7 @@ def get_xdrs():
     "id": 1
     }
 
-    headers = {'Content-Type': 'application/json','Authorization': "Bearer "+request_token()}
-    
-    print(requests.post(url, headers=headers, json=json).json())
+    print(get_transport().post(url, json, token=request_token()))
     
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jsonrpc_requests import TransportError, ProtocolError
+
+from config import config
+from coreapi_metrics import metrics
+from coreapi_records import project
+from coreapi_scheduler import INTERACTIVE, priority
+from coreapi_session import get_xdr_session, is_auth_rejected
+from coreapi_transport import get_transport
+from token_store import get_token_store, token_expire_at
+from xdr_export import xdr_query_params
+
+
+class AsyncTokenManager:
+    '''
+    Async counterpart of CoreAPISession: keeps one JWT token and renews it 'refresh_margin' seconds before it expires.
+
+    Concurrent coroutines that find the token stale wait on one asyncio.Lock, so only one of them authenticates.
+    With a 'token_store' the token is read and refreshed through it in the client's thread pool, so the async clients
+    and the synchronous sessions of every process on the host share one token.
+
+    Parameters:
+        token_store (TokenStore, optional): Cross-process store of the token (see token_store.TokenStore).
+
+    Attributes:
+        auth_calls (int): Number of 'iam.auth.jwt.authenticate' calls made by this manager.
+    '''
+
+    def __init__(self, client, server_url, login, password, refresh_margin=60, default_lifetime=3600, token_store=None):
+        self.client = client
+        self.server_url = server_url
+        self.token_store = token_store
+        self.login = login
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.auth_calls = 0
+        self._lock = None
+        self._token = None
+        self._expire_at = 0.0
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expire_at - self.refresh_margin
+
+    async def get_token(self):
+        if self._is_fresh():
+            return self._token
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._is_fresh():
+                if self.token_store is not None:
+                    loop = asyncio.get_running_loop()
+                    token = await loop.run_in_executor(
+                        self.client._executor, self.token_store.get_token, self._request_token
+                    )
+                else:
+                    self.auth_calls += 1
+                    metrics.record_auth_refresh(self.login)
+                    result = await self.client.call(
+                        'iam.auth.jwt.authenticate', {'login': self.login, 'password': self.password},
+                        url=self.server_url, authenticated=False
+                    )
+                    token = result['token']
+                self._token = token
+                self._expire_at = token_expire_at(self._token, self.default_lifetime)
+        return self._token
+
+    def _request_token(self):
+        # runs in the thread pool, under the lock of the token store
+        self.auth_calls += 1
+        metrics.record_auth_refresh(self.login)
+        with priority(INTERACTIVE):
+            result = self.client.transport.call(
+                self.server_url, 'iam.auth.jwt.authenticate', {'login': self.login, 'password': self.password}
+            )
+        return result['token']
+
+    async def invalidate(self, token=None):
+        # a token another coroutine already replaced is kept
+        if token is not None and token != self._token:
+            return
+        token = self._token
+        self._token = None
+        self._expire_at = 0.0
+        if token is not None and self.token_store is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.client._executor, self.token_store.invalidate, token)
+
+
+class AsyncCoreAPI:
+    '''
+    Asyncio client for the coreAPI server with a cap on the number of in-flight requests.
+
+    The requests run on the shared pooled CoreAPITransport in a dedicated thread pool, so the client adds no new HTTP
+    dependency and reuses the same keep-alive connections as the synchronous functions in coreAPI.py.
+    An asyncio.Semaphore limits the requests in flight to 'max_in_flight'.
+
+    Parameters:
+        server_url (str, optional): The URL of the coreAPI server. Default is COREAPI_SERVER.
+        login (str, optional): The coreAPI login. Default is COREAPI_USERNAME.
+        password (str, optional): The coreAPI password. Default is COREAPI_PASSWORD.
+        max_in_flight (int): The maximum number of concurrent requests. Default is 0, which means COREAPI_ASYNC_MAX_IN_FLIGHT is used.
+        transport (CoreAPITransport, optional): The transport used for the requests. Default is the shared transport.
+
+    Example:
+        async with AsyncCoreAPI() as coreapi:
+            clients = await coreapi.gather_clients_get([36, 37, 38])
+    '''
+
+    def __init__(self, server_url=None, login=None, password=None, max_in_flight: int = 0, transport=None):
+        self.server_url = server_url or config.COREAPI_SERVER
+        self.max_in_flight = max_in_flight or config.COREAPI_ASYNC_MAX_IN_FLIGHT
+        self.transport = transport or get_transport()
+        # the default account shares its token with the coreAPI sessions through the token store
+        shared = server_url is None and login is None and password is None
+        self.tokens = AsyncTokenManager(
+            self, self.server_url, login or config.COREAPI_USERNAME, password or config.COREAPI_PASSWORD,
+            refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN, token_store=get_token_store() if shared else None
+        )
+        self._admin_tokens = None
+        self._xdr_tokens = None
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='coreapi-async')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def call(self, method_name, params=None, url=None, authenticated=True, token=None, tokens=None):
+        '''
+        Call one JSON-RPC method and return its result.
+
+        If the server rejects a managed token (see coreapi_session.is_auth_rejected), the token is dropped and the call
+        is sent once more with a new one.
+
+        Parameters:
+            method_name (str): The JSON-RPC method, e.g. 'clients.get'.
+            params (dict, optional): The method parameters.
+            url (str, optional): The server URL. Default is the client server URL.
+            authenticated (bool): Whether to send the managed JWT token. Default is True.
+            token (str, optional): A token sent instead of the managed one.
+            tokens (AsyncTokenManager, optional): The manager of the token to send. Default is 'self.tokens'.
+
+        Raises:
+            jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+            jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+        '''
+        if not authenticated or token is not None:
+            return await self._send(method_name, params, url, token)
+        tokens = tokens or self.tokens
+        token = await tokens.get_token()
+        try:
+            return await self._send(method_name, params, url, token)
+        except (TransportError, ProtocolError) as e:
+            if not is_auth_rejected(e):
+                raise
+            await tokens.invalidate(token)
+        return await self._send(method_name, params, url, await tokens.get_token())
+
+    async def _send(self, method_name, params, url, token):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, self.transport.call, url or self.server_url, method_name, params, token
+            )
+
+    async def coreapi_clients_get(self, client_id: int = 0):
+        return await self.call('clients.get', {'id': client_id})
+
+    async def coreapi_clients_search(self, is_limit=False, limit: int = 0, fields=None):
+        params = {'limit': limit if is_limit else 10000}
+        if fields and config.COREAPI_PROJECTION_PARAM:
+            params[config.COREAPI_PROJECTION_PARAM] = list(fields)
+        return project(await self.call('clients.search', params), fields)
+
+    async def coreapi_accounts_search(self, client_id: int = 0):
+        return await self.call('clients.accounts.search', {'clients_id': client_id})
+
+    async def coreapi_accounts_get(self, account_id: int = 0):
+        return await self.call('clients.accounts.get', {'id': account_id})
+
+    async def coreapi_clients_authenticate(self, user: str = '', password: str = ''):
+        '''
+        Async version of coreAPI.coreapi_clients_authenticate: True if 'user' logs in and has the VCS_ADMIN_ROLES_NAME role.
+        '''
+        if self._admin_tokens is None:
+            self._admin_tokens = AsyncTokenManager(
+                self, config.VCS_COREAPI, config.VCS_ADMIN, config.VCS_ADMIN_PASSWORD,
+                refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN
+            )
+        try:
+            user_login = await self.call(
+                'iam.auth.jwt.authenticate', {'login': user, 'password': password},
+                url=config.VCS_COREAPI, authenticated=False
+            )
+            if not user_login:
+                return False
+            result = await self.call('iam.users.search', {'login': user}, url=config.VCS_COREAPI, tokens=self._admin_tokens)
+            return bool(result) and result[0]['roles_name'] == config.VCS_ADMIN_ROLES_NAME
+        except (TransportError, ProtocolError):
+            return False
+
+    async def query_xdrs(self, date_from, date_to, billed_clients_id=None, return_fields=None, origin='orig', limit: int = 0,
+                         fields=None):
+        '''
+        Async version of xdr_export.query_xdrs, on XDR_COREAPI_SERVER with the XDR_COREAPI_USERNAME account.
+        '''
+        if self._xdr_tokens is None:
+            self._xdr_tokens = AsyncTokenManager(
+                self, config.XDR_COREAPI_SERVER, config.XDR_COREAPI_USERNAME, config.XDR_COREAPI_PASSWORD,
+                refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN, token_store=get_xdr_session().token_store
+            )
+        params = xdr_query_params(date_from, date_to, billed_clients_id, fields or return_fields, origin, limit)
+        result = await self.call('reports.xdrs_list.query', params, url=config.XDR_COREAPI_SERVER, tokens=self._xdr_tokens)
+        return project(result or [], fields)
+
+    async def _gather(self, coroutine_function, keys):
+        keys = list(keys)
+        results = await asyncio.gather(*(coroutine_function(key) for key in keys), return_exceptions=True)
+        return dict(zip(keys, results))
+
+    async def gather_clients_get(self, client_ids):
+        '''
+        Fetch several clients concurrently. Returns a dictionary mapping each id to its client or to the raised exception.
+        '''
+        return await self._gather(self.coreapi_clients_get, client_ids)
+
+    async def gather_accounts_get(self, account_ids):
+        '''
+        Fetch several accounts concurrently. Returns a dictionary mapping each id to its account or to the raised exception.
+        '''
+        return await self._gather(self.coreapi_accounts_get, account_ids)
+
+    async def gather_accounts_search(self, client_ids):
+        '''
+        Fetch the accounts of several clients concurrently. Returns a dictionary mapping each client id to its accounts or to the raised exception.
+        '''
+        return await self._gather(self.coreapi_accounts_search, client_ids)
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _PendingLoad:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    '''
+    Thread-safe in-memory read-through cache with a time-to-live and LRU eviction by entry count.
+
+    Concurrent misses for the same key are coalesced: the first caller runs the loader and the others wait for its result.
+    Loader exceptions are passed to every waiting caller and are never cached.
+    Cached values are shared between callers and must not be modified.
+
+    Parameters:
+        ttl (float): Number of seconds an entry stays valid.
+        max_entries (int): Maximum number of entries kept. The least recently used entry is evicted first.
+
+    Attributes:
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that ran the loader.
+        coalesced (int): Number of misses that waited for another caller's load instead of running the loader.
+        evictions (int): Number of entries evicted because the cache was full.
+    '''
+
+    def __init__(self, ttl=60.0, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def get_or_load(self, key, loader):
+        '''
+        Return the cached value of 'key', or call 'loader()' to load and cache it.
+
+        Raises:
+            Exception: Any exception raised by 'loader'.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expire_at = entry
+                if time.monotonic() < expire_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                pending = self._pending[key] = _PendingLoad()
+                self.misses += 1
+                owner = True
+
+        if not owner:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = loader()
+        except Exception as e:
+            pending.error = e
+            raise
+        else:
+            self.set(key, pending.value)
+            return pending.value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.done.set()
+
+    def get(self, key, default=None):
+        '''
+        Return the cached value of 'key' without loading it, or 'default' if it is missing or expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+            }
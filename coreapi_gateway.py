@@ -0,0 +1,237 @@
+'''
+Local caching JSON-RPC gateway in front of the coreAPI server.
+
+Usage:
+    python coreapi_gateway.py [--host 127.0.0.1] [--port 3081]
+
+Then set 'coreapi_gateway_url = http://127.0.0.1:3081' in config/.env: COREAPI_SERVER points to the gateway in every
+process importing config.py, and the gateway itself forwards to the upstream server (COREAPI_UPSTREAM_SERVER).
+'''
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from jsonrpc_requests import TransportError
+
+from config import config
+from coreapi_cache import TTLCache
+from coreapi_resilience import DeadlineExceeded, error_response
+from coreapi_transport import get_transport
+from token_store import token_expire_at
+
+# answer of the coreAPI server to a call without a token
+AUTHORIZATION_REQUIRED = {'code': -32002, 'message': 'Authorization required'}
+INVALID_REQUEST = {'code': -32600, 'message': 'Invalid Request'}
+
+
+def parse_method_ttls(value):
+    '''
+    Parse 'method=ttl,method=ttl' into a {method: ttl} dictionary.
+    '''
+    ttls = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            method_name, ttl = item.split('=', 1)
+            ttls[method_name.strip()] = float(ttl)
+    return ttls
+
+
+class _UpstreamError(Exception):
+    def __init__(self, error):
+        self.error = error
+
+
+class CoreAPIGateway:
+    '''
+    Sidecar JSON-RPC server shared by the scripts of one host.
+
+    Read-only methods listed in 'method_ttls' are served from a per-method TTLCache: identical requests (same caller
+    token, method and params) made while one is in flight wait for it instead of reaching the server, and the result is
+    reused for 'ttl' seconds. They are sent upstream with the caller's own token, so the server checks the caller's
+    rights on every miss, and a cached result is only given back to callers presenting the token it was loaded with:
+    scripts sharing a token through the token store share the cache, other users never read their results. Calls
+    without a token are rejected with the server's 'Authorization required' error, and calls with an expired token are
+    forwarded instead of answered from the cache. Every other method, including 'iam.auth.jwt.authenticate' and
+    write-style methods, is forwarded unchanged with the caller's Authorization header.
+    JSON-RPC errors are passed back to the caller and never cached, and so are upstream 4xx answers, with their HTTP
+    status (a 401 still tells the caller to re-authenticate). Only upstream failures are answered with 502, or 504 when
+    they timed out. Batch items which are not request objects, and empty batches, get an 'Invalid Request' error.
+
+    Parameters:
+        upstream_url (str, optional): The coreAPI server. Default is COREAPI_UPSTREAM_SERVER.
+        method_ttls (dict, optional): Cacheable methods and their TTL in seconds. Default is COREAPI_GATEWAY_TTLS.
+        host (str): The address to listen on. Default is '127.0.0.1'.
+        port (int): The port to listen on. Default is 0 (any free port, see 'url').
+    '''
+
+    def __init__(self, upstream_url=None, method_ttls=None, host='127.0.0.1', port=0):
+        self.upstream_url = upstream_url or config.COREAPI_UPSTREAM_SERVER
+        self.method_ttls = parse_method_ttls(config.COREAPI_GATEWAY_TTLS) if method_ttls is None else method_ttls
+        self.transport = get_transport()
+        self.caches = {
+            method_name: TTLCache(ttl=ttl, max_entries=config.COREAPI_CACHE_MAX_ENTRIES)
+            for method_name, ttl in self.method_ttls.items()
+        }
+        self.passthrough = 0
+        self.rejected = 0
+        self._passthrough_lock = threading.Lock()
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, content_type='application/json'):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip('/') == '/stats':
+                    self._reply(200, gateway.stats())
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                authorization = self.headers.get('Authorization', '')
+                token = authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None
+                try:
+                    request = json.loads(body)
+                except ValueError:
+                    self._reply(200, {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32700, 'message': 'Parse error'}})
+                    return
+                try:
+                    self._reply(200, gateway.handle(request, token))
+                except (requests.RequestException, TransportError) as e:
+                    response = error_response(e)
+                    if response is not None and response.status_code < 500:
+                        # a 4xx (e.g. 401 for a rejected token) is an answer of the server, the caller gets it as is
+                        self._reply(response.status_code, response.content,
+                                    response.headers.get('Content-Type', 'application/json'))
+                    elif isinstance(e, (DeadlineExceeded, requests.Timeout)) or isinstance(getattr(e, 'cause', None),
+                                                                                         requests.Timeout):
+                        self._reply(504, {'error': 'Upstream timeout: %s' % e})
+                    else:
+                        # upstream failures and an open circuit surface as a TransportError in the caller
+                        self._reply(502, {'error': 'Upstream error: %s' % e})
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.url = 'http://%s:%d' % self._httpd.server_address
+        self._thread = None
+
+    def handle(self, request, token=None):
+        '''
+        Answer a decoded JSON-RPC request or batch array.
+        '''
+        if isinstance(request, list):
+            if not request:
+                return {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST}
+            passthrough = [item for item in request if isinstance(item, dict) and item.get('method') not in self.caches]
+            forwarded = self._forward(passthrough, token) if passthrough else []
+            # batch responses may come back in any order, they are matched on their id
+            by_id = {response.get('id'): response for response in forwarded if isinstance(response, dict)}
+            responses = []
+            for item in request:
+                if not isinstance(item, dict):
+                    responses.append({'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST})
+                elif item.get('method') in self.caches:
+                    responses.append(self._cached(item, token))
+                else:
+                    responses.append(by_id.get(item.get('id')))
+            return [response for response in responses if response is not None]
+        if not isinstance(request, dict):
+            return {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST}
+        if request.get('method') in self.caches:
+            return self._cached(request, token)
+        return self._forward(request, token)
+
+    def _forward(self, payload, token):
+        with self._passthrough_lock:
+            self.passthrough += 1
+        return self.transport.post(self.upstream_url, payload, token=token)
+
+    def _cached(self, request, token):
+        method_name = request['method']
+        params = request.get('params')
+        if not token:
+            with self._passthrough_lock:
+                self.rejected += 1
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': AUTHORIZATION_REQUIRED}
+        payload = {'jsonrpc': '2.0', 'method': method_name, 'id': request.get('id')}
+        if params:
+            payload['params'] = params
+        if token_expire_at(token) <= time.time():
+            # the server decides what an expired token may still do, its answer is not shared
+            return self._forward(payload, token)
+        # the token is hashed so the cache keys do not hold credentials
+        caller = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        key = caller + json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+        def load():
+            response = self.transport.post(self.upstream_url, payload, token=token)
+            if response.get('error'):
+                raise _UpstreamError(response['error'])
+            return response.get('result')
+
+        try:
+            result = self.caches[method_name].get_or_load(key, load)
+        except _UpstreamError as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'), 'error': e.error}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def stats(self):
+        '''
+        Return the cache statistics of every cacheable method, the number of forwarded requests and the number of
+        cacheable calls rejected for lack of a token.
+        '''
+        return {
+            'methods': {method_name: cache.stats() for method_name, cache in self.caches.items()},
+            'passthrough': self.passthrough,
+            'rejected': self.rejected,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='coreapi-gateway', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the local caching coreAPI gateway.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=config.COREAPI_GATEWAY_PORT)
+    args = parser.parse_args(argv)
+    gateway = CoreAPIGateway(host=args.host, port=args.port)
+    print(f'coreAPI gateway listening on {gateway.url}, upstream {gateway.upstream_url}')
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        gateway.stop()
+
+
+if __name__ == '__main__':
+    main()
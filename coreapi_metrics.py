@@ -0,0 +1,143 @@
+import bisect
+import json
+import threading
+from collections import defaultdict
+
+from config import config
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _MethodStats:
+    __slots__ = ('calls', 'latency_sum', 'buckets', 'request_bytes', 'response_bytes', 'errors')
+
+    def __init__(self):
+        self.calls = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.errors = defaultdict(int)
+
+
+class CoreAPIMetrics:
+    '''
+    Per-method metrics of the RPCs made through the coreAPI transport.
+
+    For every JSON-RPC method the registry counts calls, keeps a latency histogram (LATENCY_BUCKETS, in seconds),
+    sums request and response body sizes and counts errors by exception type ('TransportError', 'ProtocolError',
+    'JSONRPCError'). Token refreshes are counted per source.
+    When 'enabled' is False the instrumented code paths skip timing and recording entirely.
+
+    Parameters:
+        enabled (bool): Whether metrics are recorded.
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._methods = defaultdict(_MethodStats)
+        self._auth_refreshes = defaultdict(int)
+
+    def observe(self, method_name, seconds, request_bytes=0, response_bytes=0):
+        with self._lock:
+            stats = self._methods[method_name]
+            stats.calls += 1
+            stats.latency_sum += seconds
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+
+    def record_error(self, method_name, error_type):
+        with self._lock:
+            self._methods[method_name].errors[error_type] += 1
+
+    def record_auth_refresh(self, source):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._auth_refreshes[source] += 1
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._auth_refreshes.clear()
+
+    def snapshot(self):
+        '''
+        Return the metrics as a JSON-serialisable dictionary.
+
+        Returns:
+            dict: 'methods' maps each method to its 'calls', 'latency_sum', cumulative 'latency_buckets' (keyed by the
+                  upper bound, '+Inf' last), 'request_bytes', 'response_bytes' and 'errors' by type;
+                  'auth_refreshes' maps each source to its refresh count.
+        '''
+        with self._lock:
+            methods = {}
+            for method_name, stats in self._methods.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), stats.buckets):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                methods[method_name] = {
+                    'calls': stats.calls,
+                    'latency_sum': stats.latency_sum,
+                    'latency_buckets': buckets,
+                    'request_bytes': stats.request_bytes,
+                    'response_bytes': stats.response_bytes,
+                    'errors': dict(stats.errors),
+                }
+            return {'methods': methods, 'auth_refreshes': dict(self._auth_refreshes)}
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        '''
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP coreapi_rpc_calls_total Number of coreAPI RPCs by method.',
+            '# TYPE coreapi_rpc_calls_total counter',
+        ]
+        for method_name, stats in snapshot['methods'].items():
+            lines.append(f'coreapi_rpc_calls_total{{method="{method_name}"}} {stats["calls"]}')
+
+        lines += [
+            '# HELP coreapi_rpc_latency_seconds Latency of coreAPI RPCs by method.',
+            '# TYPE coreapi_rpc_latency_seconds histogram',
+        ]
+        for method_name, stats in snapshot['methods'].items():
+            for bound, count in stats['latency_buckets'].items():
+                lines.append(f'coreapi_rpc_latency_seconds_bucket{{method="{method_name}",le="{bound}"}} {count}')
+            lines.append(f'coreapi_rpc_latency_seconds_sum{{method="{method_name}"}} {stats["latency_sum"]}')
+            lines.append(f'coreapi_rpc_latency_seconds_count{{method="{method_name}"}} {stats["calls"]}')
+
+        for name, key, help_text in (
+            ('coreapi_rpc_request_bytes_total', 'request_bytes', 'Bytes sent in coreAPI RPC request bodies by method.'),
+            ('coreapi_rpc_response_bytes_total', 'response_bytes', 'Bytes received in coreAPI RPC response bodies by method.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for method_name, stats in snapshot['methods'].items():
+                lines.append(f'{name}{{method="{method_name}"}} {stats[key]}')
+
+        lines += [
+            '# HELP coreapi_rpc_errors_total Number of failed coreAPI RPCs by method and exception type.',
+            '# TYPE coreapi_rpc_errors_total counter',
+        ]
+        for method_name, stats in snapshot['methods'].items():
+            for error_type, count in stats['errors'].items():
+                lines.append(f'coreapi_rpc_errors_total{{method="{method_name}",type="{error_type}"}} {count}')
+
+        lines += [
+            '# HELP coreapi_auth_refresh_total Number of JWT token refreshes by source.',
+            '# TYPE coreapi_auth_refresh_total counter',
+        ]
+        for source, count in snapshot['auth_refreshes'].items():
+            lines.append(f'coreapi_auth_refresh_total{{source="{source}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = CoreAPIMetrics(enabled=config.COREAPI_METRICS_ENABLED)
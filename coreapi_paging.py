@@ -0,0 +1,64 @@
+import queue
+import threading
+
+_END = object()
+
+
+def iter_pages(fetch_page, page_size, prefetch=1):
+    '''
+    Iterate over the records of a paged coreAPI search, prefetching the next pages on a background thread.
+
+    'fetch_page(offset, limit)' is called with increasing offsets until it returns fewer than 'page_size' records.
+    At most 'prefetch' pages wait in the queue while the caller works on the current one, so memory stays bounded
+    to prefetch + 2 pages whatever the size of the result.
+
+    Parameters:
+        fetch_page (callable): A function taking (offset, limit) and returning the list of records of that page.
+        page_size (int): The number of records requested per page.
+        prefetch (int): The number of pages fetched ahead of the caller. Default is 1.
+
+    Yields:
+        dict: The records of every page, in order.
+
+    Raises:
+        Exception: Any exception raised by 'fetch_page' is re-raised in the caller's thread.
+    '''
+    pages = queue.Queue(maxsize=max(prefetch, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        offset = 0
+        try:
+            while not stop.is_set():
+                page = fetch_page(offset, page_size) or []
+                if page and not put(page):
+                    return
+                if len(page) < page_size:
+                    break
+                offset += len(page)
+        except Exception as e:
+            put(e)
+            return
+        put(_END)
+
+    producer = threading.Thread(target=produce, name='coreapi-prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _END:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield from page
+    finally:
+        stop.set()
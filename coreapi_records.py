@@ -0,0 +1,145 @@
+import functools
+import keyword
+import re
+
+
+def project(records, fields):
+    '''
+    Keep only 'fields' of every record (missing fields become None). Returns 'records' unchanged if 'fields' is empty.
+    '''
+    if not fields:
+        return records
+    return [{field: record.get(field) for field in fields} for record in records]
+
+
+def _attribute(field):
+    name = re.sub(r'\W', '_', field)
+    if not name or name[0].isdigit() or keyword.iskeyword(name):
+        name = '_' + name
+    return name
+
+
+@functools.lru_cache(maxsize=256)
+def record_type(fields):
+    '''
+    Return a __slots__ record class for a tuple of field names, created once per distinct tuple.
+
+    Instances hold one slot per field instead of a per-record dictionary; fields are read as attributes, with
+    'record[field]' or 'record.get(field)', and 'to_dict()' rebuilds the original dictionary.
+    '''
+    attributes = tuple(_attribute(field) for field in fields)
+    index = dict(zip(fields, attributes))
+
+    def __init__(self, *values):
+        for attribute, value in zip(attributes, values):
+            setattr(self, attribute, value)
+
+    def __getitem__(self, field):
+        return getattr(self, index[field])
+
+    def get(self, field, default=None):
+        attribute = index.get(field)
+        return default if attribute is None else getattr(self, attribute)
+
+    def to_dict(self):
+        return {field: getattr(self, attribute) for field, attribute in index.items()}
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join(f'{field}={getattr(self, attribute)!r}' for field, attribute in index.items())
+
+    def __eq__(self, other):
+        return isinstance(other, type(self)) and all(getattr(self, a) == getattr(other, a) for a in attributes)
+
+    return type('Record', (), {
+        '__slots__': attributes, 'fields': fields, '__init__': __init__, '__getitem__': __getitem__, 'get': get,
+        'to_dict': to_dict, '__repr__': __repr__, '__eq__': __eq__, '__hash__': None,
+    })
+
+
+class RecordList:
+    '''
+    Column-oriented container for a large list of records with the same fields.
+
+    Values are kept in one list per field, so the field names and the per-record dictionary are not repeated for every
+    row; a 10k-row search result takes a fraction of the memory of the equivalent list of dictionaries. Indexing and
+    iteration yield __slots__ records (see 'record_type') built on demand.
+
+    Parameters:
+        fields (list): The field names.
+        records (iterable, optional): Dictionaries to append.
+    '''
+
+    __slots__ = ('fields', 'columns', '_record_type')
+
+    def __init__(self, fields, records=None):
+        self.fields = tuple(fields)
+        self.columns = {field: [] for field in self.fields}
+        self._record_type = record_type(self.fields)
+        if records is not None:
+            self.extend(records)
+
+    def append(self, record):
+        for field, column in self.columns.items():
+            column.append(record.get(field))
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def column(self, field):
+        return self.columns[field]
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            result = RecordList(self.fields)
+            for field, column in self.columns.items():
+                result.columns[field] = column[index]
+            return result
+        return self._record_type(*(column[index] for column in self.columns.values()))
+
+    def __iter__(self):
+        make = self._record_type
+        for values in zip(*self.columns.values()):
+            yield make(*values)
+
+    def to_dicts(self):
+        return [dict(zip(self.fields, values)) for values in zip(*self.columns.values())]
+
+    def __repr__(self):
+        return f'RecordList(fields={list(self.fields)!r}, rows={len(self)})'
+
+
+def compact_records(records, fields=None, compact='columns'):
+    '''
+    Store 'records' in a compact container.
+
+    Parameters:
+        records (iterable): Dictionaries.
+        fields (list, optional): The fields to keep. Default is the keys of the first record.
+        compact (str): 'columns' for a RecordList, 'slots' for a list of __slots__ records.
+
+    Returns:
+        RecordList or list: The records.
+    '''
+    iterator = iter(records)
+    if not fields:
+        first = next(iterator, None)
+        if first is None:
+            return RecordList(()) if compact == 'columns' else []
+        fields = tuple(first)
+        iterator = _chain_first(first, iterator)
+    fields = tuple(fields)
+    if compact == 'columns':
+        return RecordList(fields, iterator)
+    if compact == 'slots':
+        make = record_type(fields)
+        return [make(*(record.get(field) for field in fields)) for record in iterator]
+    raise ValueError(f"Unsupported compact container '{compact}'")
+
+
+def _chain_first(first, iterator):
+    yield first
+    yield from iterator
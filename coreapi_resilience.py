@@ -0,0 +1,429 @@
+import collections
+import contextlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from jsonrpc_requests import TransportError, ProtocolError
+
+from config import config
+from coreapi_scheduler import current_priority, priority
+
+# methods which return the same answer when they are sent twice, so they may be retried and hedged; logins are not
+# among them, a repeated failed login counts against the lockout policy of the account
+IDEMPOTENT_METHODS = frozenset({
+    'clients.get', 'clients.accounts.get', 'clients.search', 'clients.accounts.search', 'iam.users.search',
+    'reports.xdrs_list.query',
+})
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# absolute deadline (time.monotonic) of the calls made by the current thread
+_context = threading.local()
+
+
+class CircuitOpenError(TransportError):
+    '''
+    Raised without contacting the server while its circuit breaker is open.
+    '''
+
+
+class DeadlineExceeded(TransportError):
+    '''
+    Raised when the deadline of a call passed before it could be answered.
+    '''
+
+
+def error_response(error):
+    '''
+    Return the HTTP response carried by a transport error (a TransportError or its requests cause), or None if the
+    server never answered.
+    '''
+    cause = getattr(error, 'cause', None)
+    if cause is None:
+        cause = error
+    # a requests.Response is falsy for every 4xx and 5xx status, so it is compared to None
+    response = getattr(cause, 'response', None)
+    if response is None:
+        response = getattr(error, 'server_response', None)
+    return response
+
+
+def is_server_failure(error):
+    '''
+    Tell whether a transport error means the server is unhealthy: a connection error, a timeout or a 5xx status.
+    A 4xx status is an answer, like a JSON-RPC error.
+    '''
+    response = error_response(error)
+    return response is None or response.status_code >= 500
+
+
+def current_deadline():
+    return getattr(_context, 'deadline', None)
+
+
+def remaining_time():
+    '''
+    Return the seconds left before the deadline of the current thread, or None if it has no deadline.
+    '''
+    deadline = current_deadline()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''
+    Give the coreAPI calls made by the current thread inside the block 'seconds' seconds in total, retries and
+    backoff pauses included. A nested deadline can only shorten the enclosing one.
+
+    Example:
+        with deadline(5):
+            client = coreapi_clients_get(client_id)
+    '''
+    previous = current_deadline()
+    until = time.monotonic() + seconds
+    _context.deadline = until if previous is None else min(previous, until)
+    try:
+        yield
+    finally:
+        _context.deadline = previous
+
+
+def request_timeout(timeout):
+    '''
+    Shorten a requests (connect, read) timeout to the time left before the deadline of the current thread.
+
+    Raises:
+        DeadlineExceeded: If the deadline already passed.
+    '''
+    remaining = remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded('Deadline exceeded')
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(min(value, remaining) for value in timeout)
+    return min(timeout, remaining)
+
+
+class CircuitBreaker:
+    '''
+    Circuit breaker of one coreAPI server.
+
+    The outcomes of the last 'window' calls are kept. When at least 'failure_threshold' of them, and at least
+    'failure_ratio' of them, are transport failures, the circuit opens and every call fails at once with
+    CircuitOpenError for 'reset_timeout' seconds. Then one probe call is let through (half-open): its success closes
+    the circuit, its failure opens it again. JSON-RPC errors are answers of a healthy server and count as successes.
+    '''
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, failure_ratio=0.5, window=20):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failure_ratio = failure_ratio
+        self.state = CLOSED
+        self.opened = 0
+        self._outcomes = collections.deque(maxlen=max(window, failure_threshold))
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def failures(self):
+        return self._outcomes.count(False)
+
+    def allow(self, name=''):
+        '''
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with its probe call in flight.
+        '''
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError('Circuit open for %s after %d failures' % (name or 'coreAPI', self.failures))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                self._outcomes.clear()
+            self.state = CLOSED
+            self._outcomes.append(True)
+            self._probing = False
+
+    def abandon(self):
+        # the call let through ended without telling anything about the server, e.g. its deadline passed
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            if self.state == HALF_OPEN or (failures >= self.failure_threshold
+                                           and failures >= self.failure_ratio * len(self._outcomes)):
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyTracker:
+    '''
+    Latencies of the last 'window' successful calls of every method, and their 95th percentile.
+    '''
+
+    def __init__(self, window=256, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self._counts = collections.defaultdict(int)
+        self._p95 = {}
+        self._lock = threading.Lock()
+
+    def add(self, method_name, seconds):
+        with self._lock:
+            samples = self._samples[method_name]
+            samples.append(seconds)
+            self._counts[method_name] += 1
+            count = self._counts[method_name]
+            # the percentile is recomputed every 16 samples instead of on every read
+            if count == self.min_samples or count > self.min_samples and count % 16 == 0:
+                ordered = sorted(samples)
+                self._p95[method_name] = ordered[int(0.95 * (len(ordered) - 1))]
+
+    def p95(self, method_name):
+        '''
+        Return the 95th percentile latency of 'method_name', or None before 'min_samples' calls were seen.
+        '''
+        return self._p95.get(method_name)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._p95)
+
+
+class CallPolicy:
+    '''
+    Deadlines, retries, hedged reads and circuit breaking of the calls made through the coreAPI transport.
+
+    Every call runs under a deadline (the enclosing deadline() block, else 'call_timeout' seconds) which bounds the
+    HTTP timeouts of all its attempts and the pauses between them. Idempotent methods (IDEMPOTENT_METHODS) failing at
+    the transport level (see is_server_failure) are sent again up to 'attempts' times in total, after a pause drawn
+    uniformly from [0, min(max_delay, delay * 2 ** retry)] (exponential backoff with full jitter), as long as the
+    deadline allows it. JSON-RPC errors and 4xx answers are never retried.
+
+    With 'hedging' enabled, a call of one of 'hedge_methods' which did not answer within the 95th percentile latency
+    of its method (at least 'hedge_min_delay') is sent a second time and the first answer wins. At most
+    'hedge_budget' of the calls are hedged, so a slow server does not get twice the load.
+
+    Each server URL has its own CircuitBreaker; while it is open calls fail immediately with CircuitOpenError instead
+    of waiting for timeouts.
+
+    Parameters:
+        attempts (int): Attempts per call, including the first one.
+        delay (float): Base backoff pause in seconds.
+        max_delay (float): Cap of the backoff pause in seconds.
+        call_timeout (float): Default deadline of a call in seconds, 0 for none.
+        hedging (bool): Whether hedged requests are sent.
+        hedge_methods (iterable): The methods which may be hedged.
+        hedge_min_delay (float): Lowest delay in seconds before a hedged request.
+        hedge_budget (float): Highest fraction of calls which are hedged.
+        failure_threshold (int): Transport failures among the last 20 calls which open a circuit, if they are also at
+                                 least half of them.
+        reset_timeout (float): Seconds a circuit stays open before a probe call.
+    '''
+
+    def __init__(self, attempts=3, delay=5.0, max_delay=30.0, call_timeout=0.0, hedging=False, hedge_methods=(),
+                 hedge_min_delay=0.05, hedge_budget=0.1, failure_threshold=5, reset_timeout=30.0):
+        self.attempts = max(attempts, 1)
+        self.delay = delay
+        self.max_delay = max_delay
+        self.call_timeout = call_timeout
+        self.hedging = hedging
+        self.hedge_methods = frozenset(hedge_methods)
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latencies = LatencyTracker()
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {'calls': 0, 'retries': 0, 'hedges': 0, 'hedge_wins': 0, 'rejected': 0, 'deadline_exceeded': 0}
+
+    def breaker(self, url):
+        with self._lock:
+            breaker = self._breakers.get(url)
+            if breaker is None:
+                breaker = self._breakers[url] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def call(self, url, method_name, send, idempotent=None, hedge=True):
+        '''
+        Run 'send' (one attempt of the call, returning its result) under the policy.
+
+        Parameters:
+            url (str): The server URL, which selects the circuit breaker.
+            method_name (str): The JSON-RPC method.
+            send (callable): Sends the request once and returns the result; raises TransportError or a
+                             requests.RequestException on transport failures.
+            idempotent (bool, optional): Whether the call may be sent again. Default is whether 'method_name' is in
+                                         IDEMPOTENT_METHODS.
+            hedge (bool): Whether the call may be hedged. Default is True.
+
+        Raises:
+            CircuitOpenError: If the circuit of 'url' is open.
+            DeadlineExceeded: If the deadline passed before an attempt could be sent.
+        '''
+        if current_deadline() is None and self.call_timeout:
+            with deadline(self.call_timeout):
+                return self._call(url, method_name, send, idempotent, hedge)
+        return self._call(url, method_name, send, idempotent, hedge)
+
+    def _call(self, url, method_name, send, idempotent, hedge):
+        idempotent = method_name in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        hedge = hedge and self.hedging and idempotent and method_name in self.hedge_methods
+        breaker = self.breaker(url)
+        self._count('calls')
+        attempt = 0
+        while True:
+            try:
+                breaker.allow(url)
+            except CircuitOpenError:
+                self._count('rejected')
+                raise
+            try:
+                result = self._hedged(method_name, send) if hedge else self._timed(method_name, send)
+            except DeadlineExceeded:
+                breaker.abandon()
+                self._count('deadline_exceeded')
+                raise
+            except ProtocolError:
+                breaker.record_success()
+                raise
+            except (TransportError, requests.RequestException) as e:
+                if not is_server_failure(e):
+                    breaker.record_success()
+                    raise
+                remaining = remaining_time()
+                if remaining is not None and remaining <= 0:
+                    # the timeout was cut short by the deadline of the caller, not a sign of an unhealthy server
+                    breaker.abandon()
+                    self._count('deadline_exceeded')
+                    raise DeadlineExceeded('Deadline exceeded calling %r' % method_name, cause=e)
+                breaker.record_failure()
+                attempt += 1
+                if not idempotent or attempt >= self.attempts:
+                    raise
+                pause = random.uniform(0, min(self.max_delay, self.delay * 2 ** (attempt - 1)))
+                if remaining is not None and pause >= remaining:
+                    # no time left for another attempt, the last error is the answer
+                    raise
+                self._count('retries')
+                time.sleep(pause)
+                continue
+            except BaseException:
+                breaker.abandon()
+                raise
+            breaker.record_success()
+            return result
+
+    def _timed(self, method_name, send):
+        start = time.monotonic()
+        result = send()
+        self.latencies.add(method_name, time.monotonic() - start)
+        return result
+
+    def _run(self, deadline_at, priority_class, method_name, send):
+        # worker threads do not inherit the thread-local deadline and priority class of the caller
+        _context.deadline = deadline_at
+        try:
+            with priority(priority_class):
+                return self._timed(method_name, send)
+        finally:
+            _context.deadline = None
+
+    def _hedge_allowed(self):
+        with self._lock:
+            if self._stats['hedges'] >= self.hedge_budget * self._stats['calls']:
+                return False
+            self._stats['hedges'] += 1
+            return True
+
+    def _hedged(self, method_name, send):
+        delay = self.latencies.p95(method_name)
+        if delay is None:
+            return self._timed(method_name, send)
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=config.COREAPI_POOL_MAXSIZE * 2,
+                                                        thread_name_prefix='coreapi-hedge')
+        context = (current_deadline(), current_priority(), method_name, send)
+        primary = self._executor.submit(self._run, *context)
+        done, _ = wait([primary], timeout=max(delay, self.hedge_min_delay))
+        if done or not self._hedge_allowed():
+            return primary.result()
+        hedged = self._executor.submit(self._run, *context)
+        pending = {primary, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is hedged:
+                        self._count('hedge_wins')
+                    return future.result()
+                if isinstance(error, ProtocolError):
+                    # the server answered, the other attempt would get the same answer
+                    raise error
+        raise error
+
+    def stats(self):
+        '''
+        Return the call counters, the circuit breaker of every server and the p95 latency of every method.
+
+        Returns:
+            dict: 'calls', 'retries', 'hedges', 'hedge_wins', 'rejected' (by an open circuit), 'deadline_exceeded',
+                  'circuits' as {url: {'state', 'failures', 'opened'}} and 'p95' as {method: seconds}.
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            breakers = dict(self._breakers)
+        stats['circuits'] = {
+            url: {'state': breaker.state, 'failures': breaker.failures, 'opened': breaker.opened}
+            for url, breaker in breakers.items()
+        }
+        stats['p95'] = self.latencies.snapshot()
+        return stats
+
+
+resilience = CallPolicy(
+    attempts=int(config.RETRY_ATTEMPS or 3),
+    delay=float(config.RETRY_DELAY or 5),
+    max_delay=config.COREAPI_RETRY_MAX_DELAY,
+    call_timeout=config.COREAPI_CALL_DEADLINE,
+    hedging=config.COREAPI_HEDGING_ENABLED,
+    hedge_methods=[name.strip() for name in config.COREAPI_HEDGE_METHODS.split(',') if name.strip()],
+    hedge_min_delay=config.COREAPI_HEDGE_MIN_DELAY,
+    hedge_budget=config.COREAPI_HEDGE_BUDGET,
+    failure_threshold=config.COREAPI_BREAKER_THRESHOLD,
+    reset_timeout=config.COREAPI_BREAKER_RESET,
+)
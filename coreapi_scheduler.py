@@ -0,0 +1,310 @@
+import collections
+import contextlib
+import heapq
+import itertools
+import threading
+import time
+
+import requests
+from jsonrpc_requests import TransportError
+
+from config import config
+
+# priority classes, lower is served first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+PRIORITY_NAMES = ('interactive', 'normal', 'bulk')
+
+# priority class of the calls made by the current thread
+_context = threading.local()
+
+
+def current_priority():
+    return getattr(_context, 'priority', NORMAL)
+
+
+@contextlib.contextmanager
+def priority(priority_class):
+    '''
+    Run the coreAPI calls made by the current thread inside the block with 'priority_class'.
+
+    Example:
+        with priority(BULK):
+            records = query_xdrs(date_from, date_to)
+    '''
+    previous = current_priority()
+    _context.priority = priority_class
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def _resilience():
+    # imported on use, coreapi_resilience itself imports this module for the priority context
+    import coreapi_resilience
+    return coreapi_resilience
+
+
+class _Baseline:
+    # smoothed latency of a method, and its lowest value over the current and the previous window of samples
+    __slots__ = ('smoothed', 'current', 'previous', 'samples')
+
+    def __init__(self):
+        self.smoothed = None
+        self.current = float('inf')
+        self.previous = float('inf')
+        self.samples = 0
+
+    def add(self, latency, window, smoothing=0.2):
+        self.smoothed = latency if self.smoothed is None else self.smoothed + smoothing * (latency - self.smoothed)
+        self.current = min(self.current, self.smoothed)
+        self.samples += 1
+        if self.samples >= window:
+            # a new window lets the baseline follow a server which became slower for good
+            self.previous, self.current, self.samples = self.current, float('inf'), 0
+        return self.smoothed
+
+    def value(self):
+        return min(self.current, self.previous)
+
+
+class _Ticket:
+    __slots__ = ('priority', 'admitted')
+
+    def __init__(self, priority_class, admitted):
+        self.priority = priority_class
+        self.admitted = admitted
+
+
+class RPCScheduler:
+    '''
+    Client-side admission control of the RPCs sent to coreAPI.
+
+    Every call takes a slot before it is sent and gives it back when the answer arrives. Calls wait in one queue
+    ordered by priority class (INTERACTIVE, NORMAL, BULK, then arrival), so a login check queued behind a bulk export
+    is sent first, and only INTERACTIVE calls may use the last 'interactive_reserve' fraction of the slots.
+
+    The number of slots (the concurrency limit) adapts with AIMD: it grows by about one per round trip while the
+    smoothed latency (EWMA) of every method stays within 'latency_tolerance' times its own baseline (the lowest smoothed
+    latency over the last 'baseline_window' calls of that method), and is multiplied by 'backoff', at most once per
+    round trip, when the smoothed latency rises above that or a call fails at the transport level. JSON-RPC errors and
+    4xx answers count as healthy. A call waits in the queue no longer than the deadline of its thread.
+
+    A token bucket of 'rate' calls per second with 'burst' tokens caps the request rate on top of the limit.
+    When 'enabled' is False calls are sent immediately and nothing is recorded.
+
+    Parameters:
+        rate (float): Calls per second, 0 for no rate limit.
+        burst (int): Size of the token bucket. Default is 0, which means max(1, rate).
+        initial_limit (int): Starting concurrency limit.
+        min_limit (int): Lowest concurrency limit.
+        max_limit (int): Highest concurrency limit, e.g. the size of the connection pool.
+        latency_tolerance (float): Latency over baseline ratio above which the limit is decreased.
+        backoff (float): Multiplicative decrease factor.
+        interactive_reserve (float): Fraction of the limit kept for INTERACTIVE calls.
+        baseline_window (int): Calls per method after which its latency baseline is renewed.
+        enabled (bool): Whether calls go through the scheduler.
+    '''
+
+    def __init__(self, rate=0.0, burst=0, initial_limit=8, min_limit=1, max_limit=20, latency_tolerance=2.0,
+                 backoff=0.9, interactive_reserve=0.2, baseline_window=500, enabled=True):
+        self.enabled = enabled
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.interactive_reserve = interactive_reserve
+        self.baseline_window = baseline_window
+        self._condition = threading.Condition()
+        self._limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self._in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+        self._baselines = collections.defaultdict(_Baseline)
+        self._queued = [0] * len(PRIORITY_NAMES)
+        self._max_queued = [0] * len(PRIORITY_NAMES)
+        self._admitted = [0] * len(PRIORITY_NAMES)
+        self._wait_sum = [0.0] * len(PRIORITY_NAMES)
+        self._waits = [collections.deque(maxlen=1024) for _ in PRIORITY_NAMES]
+        self._rate_limited = 0
+        self._decreases = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _has_slot(self, priority_class):
+        limit = int(self._limit)
+        if priority_class != INTERACTIVE:
+            limit -= int(limit * self.interactive_reserve)
+        return self._in_flight < max(limit, 1)
+
+    def _take_token(self):
+        # seconds until a token is available, 0 if one was taken
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            return 0.0
+        return (1.0 - self._tokens) / self.rate
+
+    def acquire(self, priority_class=None):
+        '''
+        Block until the call may be sent and return the ticket to pass to release().
+
+        The wait is bounded by the deadline of the calling thread (see coreapi_resilience.deadline).
+
+        Raises:
+            coreapi_resilience.DeadlineExceeded: If the deadline passed while the call was queued.
+        '''
+        if not self.enabled:
+            return None
+        priority_class = current_priority() if priority_class is None else priority_class
+        resilience = _resilience()
+        deadline_at = resilience.current_deadline()
+        queued = time.monotonic()
+        with self._condition:
+            entry = (priority_class, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            self._queued[priority_class] += 1
+            self._max_queued[priority_class] = max(self._max_queued[priority_class], self._queued[priority_class])
+            rate_limited = False
+            try:
+                while True:
+                    timeout = None
+                    if self._waiting[0] == entry and self._has_slot(priority_class):
+                        timeout = self._take_token()
+                        if not timeout:
+                            break
+                        rate_limited = True
+                    if deadline_at is not None:
+                        remaining = deadline_at - time.monotonic()
+                        if remaining <= 0:
+                            raise resilience.DeadlineExceeded('Deadline exceeded waiting for a coreAPI slot')
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                    self._condition.wait(timeout)
+            except BaseException:
+                # a caller which gives up must not stay at the head of the queue and block the others
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._queued[priority_class] -= 1
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            admitted = time.monotonic()
+            self._queued[priority_class] -= 1
+            self._admitted[priority_class] += 1
+            self._wait_sum[priority_class] += admitted - queued
+            self._waits[priority_class].append(admitted - queued)
+            self._rate_limited += rate_limited
+            # the next call in the queue may fit as well
+            self._condition.notify_all()
+        return _Ticket(priority_class, admitted)
+
+    def release(self, ticket, method_name='', failed=False, measured=True):
+        '''
+        Give back the slot of 'ticket' and adapt the limit to the latency of the call.
+
+        Parameters:
+            method_name (str): The JSON-RPC method, latencies are compared to the baseline of the same method.
+            failed (bool): True if the call failed at the transport level (timeout, connection error, 5xx status).
+            measured (bool): False if the call ended without telling anything about the server, e.g. its deadline
+                             passed: the slot is given back and the limit is left as it is.
+        '''
+        if ticket is None:
+            return
+        now = time.monotonic()
+        latency = now - ticket.admitted
+        with self._condition:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            if not measured:
+                self._condition.notify_all()
+                return
+            baseline = self._baselines[method_name]
+            smoothed = None if failed else baseline.add(latency, self.baseline_window)
+            if failed or smoothed > baseline.value() * self.latency_tolerance:
+                if now - self._last_decrease >= latency:
+                    self._limit = max(float(self.min_limit), self._limit * self.backoff)
+                    self._last_decrease = now
+                    self._decreases += 1
+            elif in_flight >= int(self._limit) // 2:
+                # only grow a limit which is actually used
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, method_name='', priority_class=None):
+        '''
+        Hold a slot for the duration of the block. Server failures raised inside it (see
+        coreapi_resilience.is_server_failure) count as failed calls; 4xx answers count as answers, and a passed deadline
+        or an open circuit leaves the limit as it is.
+        '''
+        ticket = self.acquire(priority_class)
+        failed = False
+        measured = True
+        try:
+            yield
+        except (requests.RequestException, TransportError) as e:
+            resilience = _resilience()
+            if isinstance(e, (resilience.DeadlineExceeded, resilience.CircuitOpenError)):
+                measured = False
+            else:
+                failed = resilience.is_server_failure(e)
+            raise
+        finally:
+            self.release(ticket, method_name, failed, measured)
+
+    def stats(self):
+        '''
+        Return the current limit, the calls in flight and the queue statistics of every priority class.
+
+        Returns:
+            dict: 'limit', 'in_flight', 'tokens', 'rate_limited' admissions which waited for a token, 'decreases' of
+                  the limit, and per class in 'classes': 'queued' (current depth), 'max_queued', 'admitted',
+                  'wait_mean', 'wait_p95' and 'wait_max' in seconds (p95 and max over the last 1024 admissions).
+        '''
+        with self._condition:
+            classes = {}
+            for priority_class, name in enumerate(PRIORITY_NAMES):
+                waits = sorted(self._waits[priority_class])
+                admitted = self._admitted[priority_class]
+                classes[name] = {
+                    'queued': self._queued[priority_class],
+                    'max_queued': self._max_queued[priority_class],
+                    'admitted': admitted,
+                    'wait_mean': self._wait_sum[priority_class] / admitted if admitted else 0.0,
+                    'wait_p95': waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                    'wait_max': waits[-1] if waits else 0.0,
+                }
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'tokens': self._tokens if self.rate > 0 else None,
+                'rate_limited': self._rate_limited,
+                'decreases': self._decreases,
+                'classes': classes,
+            }
+
+
+scheduler = RPCScheduler(
+    rate=config.COREAPI_RATE_LIMIT,
+    burst=config.COREAPI_RATE_BURST,
+    initial_limit=config.COREAPI_CONCURRENCY_INITIAL,
+    min_limit=config.COREAPI_CONCURRENCY_MIN,
+    max_limit=config.COREAPI_CONCURRENCY_MAX or config.COREAPI_POOL_MAXSIZE,
+    latency_tolerance=config.COREAPI_LATENCY_TOLERANCE,
+    interactive_reserve=config.COREAPI_INTERACTIVE_RESERVE,
+    enabled=config.COREAPI_SCHEDULER_ENABLED,
+)
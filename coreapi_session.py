@@ -0,0 +1,229 @@
+import threading
+import time
+
+from jsonrpc_requests import TransportError, ProtocolError
+
+from config import config
+from coreapi_metrics import metrics
+from coreapi_scheduler import INTERACTIVE, priority
+from coreapi_transport import get_transport
+from token_store import TokenStore, get_token_store, token_expire_at
+
+
+def is_auth_rejected(error):
+    '''
+    Tell whether an error means the server rejected the token: a JSON-RPC error whose code is in
+    COREAPI_AUTH_ERROR_CODES, or an HTTP 401 answer.
+    '''
+    if isinstance(error, ProtocolError):
+        server_data = error.server_data if isinstance(error.server_data, dict) else {}
+        code = (server_data.get('error') or {}).get('code')
+        return code in config.COREAPI_AUTH_ERROR_CODES
+    if isinstance(error, TransportError):
+        response = getattr(error.cause, 'response', None)
+        if response is None:
+            response = error.server_response
+        return response is not None and response.status_code == 401
+    return False
+
+
+_END = object()
+
+
+class CoreAPISession:
+    '''
+    Process-wide holder of one authenticated coreAPI Server.
+
+    The session authenticates lazily, keeps the resulting Server together with the JWT token and reads the token 'exp' claim
+    (the same way 'check_token_avaiable' does) to refresh it 'refresh_margin' seconds before it expires.
+    Only one thread re-authenticates at a time; the others wait on the lock and then reuse the fresh token.
+    A token the server rejects before its expiry (e.g. after a server restart) is dropped by run(), here and in the
+    token store, and the call is sent once more with a new token.
+
+    Parameters:
+        server_url (str): The URL of the coreAPI server.
+        login (str): The login used with 'iam.auth.jwt.authenticate'.
+        password (str): The password used with 'iam.auth.jwt.authenticate'.
+        refresh_margin (int): Number of seconds before the token expiry at which the token is renewed.
+        default_lifetime (int): Token lifetime in seconds used when the token carries no 'exp' claim.
+        transport (CoreAPITransport, optional): Transport used for the requests. Defaults to the shared pooled transport.
+        token_store (TokenStore, optional): Cross-process store the token is read from and refreshed through,
+                                            so that processes sharing the credentials authenticate once between them.
+
+    Attributes:
+        auth_calls (int): Number of 'iam.auth.jwt.authenticate' calls made by this session.
+    '''
+
+    def __init__(self, server_url, login, password, refresh_margin=60, default_lifetime=3600, transport=None, token_store=None):
+        self.server_url = server_url
+        self.transport = transport or get_transport()
+        self.token_store = token_store
+        self.login = login
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.auth_calls = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._token = None
+        self._expire_at = 0.0
+
+    def _is_fresh(self):
+        return self._server is not None and time.time() < self._expire_at - self.refresh_margin
+
+    def _request_token(self):
+        coreapi_unauthorized = self.transport.server(self.server_url)
+        self.auth_calls += 1
+        metrics.record_auth_refresh(self.login)
+        # every call of the process waits for the new token, it is not queued behind bulk calls
+        with priority(INTERACTIVE):
+            result = coreapi_unauthorized.iam.auth.jwt.authenticate(
+                login=self.login,
+                password=self.password
+            )
+        return result['token']
+
+    def _authenticate(self):
+        if self.token_store is not None:
+            token = self.token_store.get_token(self._request_token)
+        else:
+            token = self._request_token()
+        self._token = token
+        self._expire_at = token_expire_at(token, self.default_lifetime)
+        self._server = self.transport.server(self.server_url, token=token)
+
+    def get_server(self):
+        '''
+        Return the shared authenticated Server, authenticating first if the token is missing or about to expire.
+
+        Raises:
+            jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while authenticating.
+            jsonrpc_requests.jsonrpc.ProtocolError: If the authentication request is rejected by the server.
+        '''
+        if self._is_fresh():
+            return self._server
+        with self._lock:
+            if not self._is_fresh():
+                self._authenticate()
+            return self._server
+
+    def get_token(self):
+        '''
+        Return the current JWT token, refreshing it the same way as 'get_server'.
+        '''
+        self.get_server()
+        return self._token
+
+    def invalidate(self, token=None):
+        '''
+        Drop the cached token so the next call authenticates again, e.g. after the server rejected the token.
+
+        Parameters:
+            token (str, optional): The rejected token. It is also removed from the token store, and nothing is dropped
+                                   if another thread already replaced it. Default is the current token.
+        '''
+        with self._lock:
+            if token is not None and token != self._token:
+                return
+            token = self._token
+            self._server = None
+            self._token = None
+            self._expire_at = 0.0
+        if token is not None and self.token_store is not None:
+            self.token_store.invalidate(token)
+
+    def run(self, function):
+        '''
+        Return function(token) called with the current token. If the server rejects the token (see
+        is_auth_rejected), it is invalidated and the function is called once more with a new token.
+
+        Example:
+            session.run(lambda token: transport.call(url, 'clients.get', {'id': 36}, token=token))
+        '''
+        token = self.get_token()
+        try:
+            return function(token)
+        except (TransportError, ProtocolError) as e:
+            if not is_auth_rejected(e):
+                raise
+            self.invalidate(token)
+        return function(self.get_token())
+
+    def run_iter(self, function):
+        '''
+        Like run() for a function returning an iterator, e.g. a coreapi_stream.iter_result() stream: its first element
+        is read inside run(), so a rejected token is retried before anything is yielded.
+        '''
+        def start(token):
+            records = iter(function(token))
+            return records, next(records, _END)
+
+        records, first = self.run(start)
+        if first is _END:
+            return
+        yield first
+        yield from records
+
+
+_coreapi_session = None
+_coreapi_session_lock = threading.Lock()
+
+
+def get_coreapi_session():
+    '''
+    Return the process-wide CoreAPISession for COREAPI_SERVER, creating it on first use.
+    '''
+    global _coreapi_session
+    if _coreapi_session is None:
+        with _coreapi_session_lock:
+            if _coreapi_session is None:
+                _coreapi_session = CoreAPISession(
+                    config.COREAPI_SERVER,
+                    config.COREAPI_USERNAME,
+                    config.COREAPI_PASSWORD,
+                    refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN,
+                    token_store=get_token_store(),
+                )
+    return _coreapi_session
+
+
+_vcs_admin_session = None
+
+
+def get_vcs_admin_session():
+    '''
+    Return the process-wide CoreAPISession of the VCS admin user (VCS_ADMIN on VCS_COREAPI), creating it on first use.
+    '''
+    global _vcs_admin_session
+    if _vcs_admin_session is None:
+        with _coreapi_session_lock:
+            if _vcs_admin_session is None:
+                _vcs_admin_session = CoreAPISession(
+                    config.VCS_COREAPI,
+                    config.VCS_ADMIN,
+                    config.VCS_ADMIN_PASSWORD,
+                    refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN,
+                )
+    return _vcs_admin_session
+
+
+_xdr_session = None
+
+
+def get_xdr_session():
+    '''
+    Return the process-wide CoreAPISession of the XDR reports (XDR_COREAPI_USERNAME on XDR_COREAPI_SERVER), creating it
+    on first use. Its token is shared between processes through its own store, XDR_TOKEN_STORE_PATH.
+    '''
+    global _xdr_session
+    if _xdr_session is None:
+        with _coreapi_session_lock:
+            if _xdr_session is None:
+                _xdr_session = CoreAPISession(
+                    config.XDR_COREAPI_SERVER,
+                    config.XDR_COREAPI_USERNAME,
+                    config.XDR_COREAPI_PASSWORD,
+                    refresh_margin=config.COREAPI_TOKEN_REFRESH_MARGIN,
+                    token_store=TokenStore(path=config.XDR_TOKEN_STORE_PATH),
+                )
+    return _xdr_session
@@ -0,0 +1,225 @@
+import json
+import re
+import time
+
+try:
+    import orjson
+except ImportError:  # the standard library decoder is used instead
+    orjson = None
+
+import requests
+from jsonrpc_requests import TransportError, ProtocolError
+
+from config import config
+from coreapi_metrics import metrics
+from coreapi_scheduler import scheduler
+from coreapi_resilience import resilience, request_timeout
+from coreapi_transport import get_transport
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+_RESULT_ARRAY = re.compile(rb'"result"\s*:\s*\[')
+# the bytes before the next bracket (_NESTED) or the next bracket or comma (_TOP), skipping whole strings; they stop at
+# the quote of a string whose end was not received yet
+_NESTED = re.compile(rb'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*', re.DOTALL)
+_TOP = re.compile(rb'[^"\[\]{},]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{},]*)*', re.DOTALL)
+_QUOTE, _OPENING, _CLOSING = ord('"'), b'[{', b']}'
+
+
+class ResultStreamParser:
+    '''
+    Incremental parser of a JSON-RPC response whose 'result' is an array.
+
+    Bytes are fed as they arrive; every call to feed() returns the array elements completed by the new bytes, so only
+    the undecoded tail of the body is buffered, whatever the size of the whole response. Only the new bytes are scanned:
+    the nesting depth is carried from one chunk to the next, strings are skipped whole, and the buffer is cut after the
+    last comma at the level of the result array. The complete elements before the cut are decoded with a single call of
+    the fastest available JSON decoder (orjson, else the standard library).
+
+    The other members of the response ('jsonrpc', 'id', 'error', or a 'result' which is not an array) are available
+    in 'members' after close(); 'in_result' tells whether a result array was found.
+    '''
+
+    __slots__ = ('members', 'in_result', '_buffer', '_search_from', '_scanned', '_depth', '_ended')
+
+    def __init__(self):
+        self.members = {}
+        self._buffer = bytearray()
+        self.in_result = False
+        self._search_from = 0
+        # scan position in the buffer, nesting depth there (0 between two elements) and end of the array seen
+        self._scanned = 0
+        self._depth = 0
+        self._ended = False
+
+    def feed(self, data):
+        '''
+        Add the next bytes of the body and return the list of result elements they completed.
+
+        Raises:
+            ValueError: If the members preceding the result are not valid JSON.
+        '''
+        self._buffer += data
+        if not self.in_result and not self._find_result():
+            return []
+        if self._ended:
+            return []
+        return self._decode_elements()
+
+    def close(self):
+        '''
+        Decode the end of the body and return the remaining result elements.
+
+        Raises:
+            ValueError: If the body is not a valid JSON object.
+        '''
+        buffer = self._buffer
+        self._buffer = bytearray()
+        if not self.in_result:
+            response = _loads(bytes(buffer))
+            if not isinstance(response, dict):
+                raise ValueError('Response is not a dictionary')
+            self.members.update(response)
+            result = response.get('result')
+            if isinstance(result, list):
+                return result
+            return [] if result is None else [result]
+        # the rest of the array and of the enclosing object
+        tail = _loads(b'{"result":[' + buffer)
+        self.members.update((key, value) for key, value in tail.items() if key != 'result')
+        return tail['result']
+
+    def _find_result(self):
+        buffer = self._buffer
+        while True:
+            match = _RESULT_ARRAY.search(buffer, self._search_from)
+            if match is None:
+                # a key split between two chunks is searched again with the next bytes
+                self._search_from = max(len(buffer) - 32, 0)
+                return False
+            # only a top-level 'result' leaves a valid object once its value is replaced
+            try:
+                head = _loads(bytes(buffer[:match.start()]) + b'"result":null}')
+            except ValueError:
+                self._search_from = match.end()
+                continue
+            if not isinstance(head, dict):
+                raise ValueError('Response is not a dictionary')
+            head.pop('result')
+            self.members.update(head)
+            self.in_result = True
+            del buffer[:match.end()]
+            return True
+
+    def _decode_elements(self):
+        buffer = self._buffer
+        length = len(buffer)
+        depth = self._depth
+        position = self._scanned
+        cut = -1
+        while True:
+            # strings, and the commas inside elements, are skipped by the regular expression
+            position = (_TOP if depth == 0 else _NESTED).match(buffer, position).end()
+            if position >= length:
+                break
+            token = buffer[position]
+            if token == _QUOTE:
+                # the string continues in the next chunk, it is scanned again from its start
+                break
+            if token in _OPENING:
+                depth += 1
+            elif token in _CLOSING:
+                depth -= 1
+                if depth < 0:
+                    # end of the result array, the rest of the body is decoded by close()
+                    self._ended = True
+                    break
+            else:
+                cut = position
+            position += 1
+        self._depth = depth
+        if cut < 0:
+            self._scanned = position
+            return []
+        elements = _loads(b'[' + buffer[:cut] + b']')
+        del buffer[:cut + 1]
+        self._scanned = position - cut - 1
+        return elements
+
+
+def iter_result(url, method_name, params=None, token=None, chunk_size: int = 0, transport=None, priority_class=None):
+    '''
+    Call one JSON-RPC method and yield the elements of its result array as the response is received.
+
+    The request asks for a gzip-compressed body, which is decompressed chunk by chunk while it is read, and the result
+    array is decoded incrementally by ResultStreamParser, so memory stays flat instead of growing with the response.
+    A result which is not an array is yielded as one element, a null result yields nothing.
+    The call holds a slot of 'coreapi_scheduler.scheduler' until the response headers arrive: the body is then read
+    at the pace of the caller, which may make other calls meanwhile. Sending the request and receiving the headers
+    run under 'coreapi_resilience.resilience' (deadline, retries, circuit breaker); a failure while the body is read
+    is raised to the caller.
+
+    Parameters:
+        url (str): The URL of the JSON-RPC server.
+        method_name (str): The method to call.
+        params (dict, optional): The parameters of the call.
+        token (str, optional): JWT token sent as 'Authorization: Bearer <token>'.
+        chunk_size (int): Bytes read from the socket at a time. Default is 0, which means COREAPI_STREAM_CHUNK_SIZE is used.
+        transport (CoreAPITransport, optional): Default is the shared transport.
+        priority_class (int, optional): The scheduler priority class. Default is the class of the calling thread.
+
+    Yields:
+        object: The elements of the result array.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If the request fails or the server answers with a non-200 status code.
+        jsonrpc_requests.jsonrpc.ProtocolError: If the response cannot be decoded or carries a JSON-RPC error.
+    '''
+    transport = transport or get_transport()
+    payload = {'jsonrpc': '2.0', 'method': method_name, 'id': 1}
+    if params:
+        payload['params'] = params
+    headers = transport.auth_headers(token)
+    headers['Accept-Encoding'] = 'gzip'
+    parser = ResultStreamParser()
+    received = 0
+
+    def open_response():
+        with scheduler.slot(method_name, priority_class):
+            response = transport.session.post(url, headers=headers, json=payload,
+                                              timeout=request_timeout(transport.timeout), stream=True)
+        if not response.ok:
+            response.close()
+            response.raise_for_status()
+        return response
+
+    start = time.perf_counter()
+    try:
+        # nothing has been yielded until the headers arrive, so opening the response may be retried
+        response = resilience.call(url, method_name, open_response, hedge=False)
+        with response:
+            for chunk in response.iter_content(chunk_size or config.COREAPI_STREAM_CHUNK_SIZE):
+                received += len(chunk)
+                yield from parser.feed(chunk)
+            elements = parser.close()
+    except requests.RequestException as e:
+        if metrics.enabled:
+            metrics.record_error(method_name, 'TransportError')
+        raise TransportError('Error calling method %r' % method_name, cause=e)
+    except ValueError as e:
+        if metrics.enabled:
+            metrics.record_error(method_name, 'ProtocolError')
+        raise ProtocolError('Cannot deserialize response body: %s' % e)
+    finally:
+        if metrics.enabled:
+            metrics.observe(method_name, time.perf_counter() - start, 0, received)
+
+    error = parser.members.get('error')
+    if error:
+        if metrics.enabled:
+            metrics.record_error(method_name, 'ProtocolError')
+        raise ProtocolError('Error: %s %s' % (error.get('code', ''), error.get('message', '')),
+                            server_data=parser.members)
+    if not parser.in_result and 'result' not in parser.members:
+        raise ProtocolError('Response without a result field', server_data=parser.members)
+    yield from elements
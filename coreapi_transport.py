@@ -0,0 +1,230 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from jsonrpc_requests import Server, TransportError, ProtocolError, JSONRPCError
+
+from config import config
+from coreapi_metrics import metrics
+from coreapi_scheduler import scheduler
+from coreapi_resilience import resilience, request_timeout, IDEMPOTENT_METHODS
+
+# body sizes of the last request made by an InstrumentedServer in this thread
+_last_sizes = threading.local()
+
+
+class InstrumentedServer(Server):
+    '''
+    jsonrpc_requests Server which reports latency, body sizes and errors of every call to 'coreapi_metrics.metrics'.
+    Every call runs under 'coreapi_resilience.resilience' (deadline, retries, hedging, circuit breaker) and every
+    attempt takes a slot of 'coreapi_scheduler.scheduler' first.
+    '''
+
+    def __init__(self, url, session=None, **requests_kwargs):
+        super().__init__(url, session=session, **requests_kwargs)
+        self.url = url
+        self._timeout = requests_kwargs.get('timeout')
+        self._post = self.request
+        self.request = self._measured_request
+
+    def _measured_request(self, data):
+        response = self._post(data=data, timeout=request_timeout(self._timeout))
+        if metrics.enabled:
+            _last_sizes.value = (len(data), len(response.content))
+        return response
+
+    def send_request(self, method_name, is_notification, params):
+        return resilience.call(self.url, method_name, lambda: self._send_scheduled(method_name, is_notification, params))
+
+    def _send_scheduled(self, method_name, is_notification, params):
+        with scheduler.slot(method_name):
+            return self._send_measured(method_name, is_notification, params)
+
+    def _send_measured(self, method_name, is_notification, params):
+        if not metrics.enabled:
+            return super().send_request(method_name, is_notification, params)
+        _last_sizes.value = (0, 0)
+        start = time.perf_counter()
+        try:
+            return super().send_request(method_name, is_notification, params)
+        except JSONRPCError as e:
+            metrics.record_error(method_name, type(e).__name__)
+            raise
+        finally:
+            request_bytes, response_bytes = _last_sizes.value
+            metrics.observe(method_name, time.perf_counter() - start, request_bytes, response_bytes)
+
+
+class CoreAPITransport:
+    '''
+    Pooled keep-alive HTTP transport shared by every coreAPI call.
+
+    All JSON-RPC Servers and raw requests made through the transport use one requests.Session, so TCP connections
+    are reused between calls instead of being opened for every RPC.
+
+    Parameters:
+        pool_connections (int): Number of per-host connection pools kept by the session.
+        pool_maxsize (int): Maximum number of connections kept open to a single host. Callers block when all of them are busy.
+        keep_alive (bool): If False, every request asks the server to close the connection.
+        connect_timeout (float): Timeout in seconds for establishing a connection.
+        read_timeout (float): Timeout in seconds for waiting on the server response.
+    '''
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True, connect_timeout=5.0, read_timeout=60.0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.keep_alive = keep_alive
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+    @staticmethod
+    def auth_headers(token=None):
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['Authorization'] = 'Bearer {}'.format(token)
+        return headers
+
+    def server(self, url, token=None):
+        '''
+        Return a jsonrpc_requests Server for 'url' bound to the pooled session.
+
+        Parameters:
+            url (str): The URL of the JSON-RPC server.
+            token (str, optional): JWT token sent as 'Authorization: Bearer <token>'.
+
+        Returns:
+            Server: A Server that sends its requests through the shared connection pool.
+        '''
+        return InstrumentedServer(url, session=self.session, headers=self.auth_headers(token), timeout=self.timeout)
+
+    def post(self, url, payload, token=None):
+        '''
+        Post a raw JSON-RPC payload (a single request or a batch array) and return the decoded JSON body.
+        The post runs under 'coreapi_resilience.resilience'; a batch is only retried if all its methods are idempotent
+        and is never hedged. Every attempt takes a slot of 'coreapi_scheduler.scheduler' first.
+
+        Raises:
+            requests.RequestException: If the request fails or the server answers with a non-200 status code.
+        '''
+        if isinstance(payload, dict):
+            method_name = payload.get('method', '')
+            idempotent = method_name in IDEMPOTENT_METHODS
+        else:
+            method_name = 'batch:' + payload[0].get('method', '') if payload else 'batch'
+            idempotent = all(item.get('method') in IDEMPOTENT_METHODS for item in payload)
+        return resilience.call(url, method_name, lambda: self._post_scheduled(url, payload, token, method_name),
+                               idempotent=idempotent, hedge=isinstance(payload, dict))
+
+    def _post_scheduled(self, url, payload, token, method_name):
+        with scheduler.slot(method_name):
+            return self._post(url, payload, token, method_name)
+
+    def _post(self, url, payload, token, method_name):
+        if not metrics.enabled:
+            response = self.session.post(url, headers=self.auth_headers(token), json=payload,
+                                         timeout=request_timeout(self.timeout))
+            response.raise_for_status()
+            return response.json()
+
+        response = None
+        start = time.perf_counter()
+        try:
+            response = self.session.post(url, headers=self.auth_headers(token), json=payload,
+                                         timeout=request_timeout(self.timeout))
+            response.raise_for_status()
+            return response.json()
+        except requests.RequestException:
+            metrics.record_error(method_name, 'TransportError')
+            raise
+        except ValueError:
+            metrics.record_error(method_name, 'ProtocolError')
+            raise
+        finally:
+            request_bytes = len(response.request.body or b'') if response is not None else 0
+            response_bytes = len(response.content) if response is not None else 0
+            metrics.observe(method_name, time.perf_counter() - start, request_bytes, response_bytes)
+
+    def call(self, url, method_name, params=None, token=None):
+        '''
+        Call one JSON-RPC method with a raw request and return its result.
+
+        Errors are raised with the same exception types as a jsonrpc_requests Server.
+
+        Raises:
+            jsonrpc_requests.jsonrpc.TransportError: If the request fails or the server answers with a non-200 status code.
+            jsonrpc_requests.jsonrpc.ProtocolError: If the response cannot be decoded or carries a JSON-RPC error.
+        '''
+        payload = {'jsonrpc': '2.0', 'method': method_name, 'id': 1}
+        if params:
+            payload['params'] = params
+        try:
+            server_data = self.post(url, payload, token=token)
+        except requests.RequestException as e:
+            raise TransportError('Error calling method %r' % method_name, cause=e)
+        except ValueError as e:
+            raise ProtocolError('Cannot deserialize response body: %s' % e)
+        if not isinstance(server_data, dict):
+            raise ProtocolError('Response is not a dictionary', server_data=server_data)
+        if server_data.get('error'):
+            code = server_data['error'].get('code', '')
+            message = server_data['error'].get('message', '')
+            if metrics.enabled:
+                metrics.record_error(method_name, 'ProtocolError')
+            raise ProtocolError('Error: %s %s' % (code, message), server_data=server_data)
+        if 'result' not in server_data:
+            raise ProtocolError('Response without a result field', server_data=server_data)
+        return server_data['result']
+
+    def stats(self):
+        '''
+        Return connection reuse statistics of the live connection pools.
+
+        Returns:
+            dict: 'requests' made, 'connections' opened, 'reused' requests served by an already open connection
+                  and the 'reuse_ratio' of the two.
+        '''
+        num_requests = 0
+        num_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        reused = max(num_requests - num_connections, 0)
+        return {
+            'requests': num_requests,
+            'connections': num_connections,
+            'reused': reused,
+            'reuse_ratio': reused / num_requests if num_requests else 0.0,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    '''
+    Return the process-wide CoreAPITransport configured from config/config.py, creating it on first use.
+    '''
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = CoreAPITransport(
+                    pool_connections=config.COREAPI_POOL_CONNECTIONS,
+                    pool_maxsize=config.COREAPI_POOL_MAXSIZE,
+                    keep_alive=config.COREAPI_KEEP_ALIVE,
+                    connect_timeout=config.COREAPI_CONNECT_TIMEOUT,
+                    read_timeout=config.COREAPI_READ_TIMEOUT,
+                )
+    return _transport
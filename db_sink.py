@@ -0,0 +1,344 @@
+import collections
+import csv
+import datetime
+import io
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+try:
+    import psycopg2
+except ImportError:  # PostgresDriver is then unavailable
+    psycopg2 = None
+
+try:
+    import pymysql
+except ImportError:  # MySQLDriver is then unavailable
+    pymysql = None
+
+from config import config
+
+TABLES = ('vcsapi_servicelog', 'vcsapi_agentinfo', 'vcsapi_systemlog', 'check_tasks')
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _identifier(name):
+    if not _IDENTIFIER.match(name):
+        raise ValueError(f'Invalid SQL identifier {name!r}')
+    return name
+
+
+class SQLiteDriver:
+    '''
+    Driver writing to a SQLite database, as a stand-in for PostgreSQL/MySQL in tests and local runs.
+    '''
+
+    placeholder = '?'
+
+    def __init__(self, path=None):
+        self.path = path or config.DB_SQLITE_PATH
+        self.connection = None
+
+    def connect(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+    def insert_many(self, table, columns, rows):
+        sql = (f'INSERT INTO {_identifier(table)} ({", ".join(map(_identifier, columns))}) '
+               f'VALUES ({", ".join([self.placeholder] * len(columns))})')
+        with self.connection:
+            self.connection.executemany(sql, rows)
+
+    def delete_chunk(self, table, column, before, chunk_size):
+        table, column = _identifier(table), _identifier(column)
+        with self.connection:
+            cursor = self.connection.execute(
+                f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {column} < ? LIMIT ?)',
+                (before, chunk_size))
+        return cursor.rowcount
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class PostgresDriver:
+    '''
+    Driver writing to PostgreSQL with COPY ... FROM STDIN (requires psycopg2).
+    '''
+
+    def __init__(self, host=None, port=None, database=None, user=None, password=None):
+        if psycopg2 is None:
+            raise ImportError('PostgresDriver requires psycopg2')
+        self.params = dict(host=host or config.DB_HOST, port=port or config.DB_PORT or 5432,
+                           dbname=database or config.DB_NAME, user=user or config.DB_USER,
+                           password=password or config.DB_PASSWORD)
+        self.connection = None
+
+    def connect(self):
+        self.connection = psycopg2.connect(**self.params)
+
+    def insert_many(self, table, columns, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['\\N' if value is None else value for value in row])
+        buffer.seek(0)
+        sql = (f'COPY {_identifier(table)} ({", ".join(map(_identifier, columns))}) '
+               f"FROM STDIN WITH (FORMAT csv, NULL '\\N')")
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.copy_expert(sql, buffer)
+
+    def delete_chunk(self, table, column, before, chunk_size):
+        table, column = _identifier(table), _identifier(column)
+        with self.connection, self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE ctid IN (SELECT ctid FROM {table} WHERE {column} < %s LIMIT %s)',
+                           (before, chunk_size))
+            return cursor.rowcount
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class MySQLDriver:
+    '''
+    Driver writing to MySQL with multi-row INSERT statements (requires pymysql, whose executemany folds the rows of
+    an INSERT ... VALUES into one statement).
+    '''
+
+    def __init__(self, host=None, port=None, database=None, user=None, password=None):
+        if pymysql is None:
+            raise ImportError('MySQLDriver requires pymysql')
+        self.params = dict(host=host or config.DB_HOST, port=int(port or config.DB_PORT or 3306),
+                           database=database or config.DB_NAME, user=user or config.DB_USER,
+                           password=password or config.DB_PASSWORD)
+        self.connection = None
+
+    def connect(self):
+        self.connection = pymysql.connect(**self.params)
+
+    def insert_many(self, table, columns, rows):
+        sql = (f'INSERT INTO {_identifier(table)} ({", ".join(map(_identifier, columns))}) '
+               f'VALUES ({", ".join(["%s"] * len(columns))})')
+        with self.connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        self.connection.commit()
+
+    def delete_chunk(self, table, column, before, chunk_size):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {_identifier(table)} WHERE {_identifier(column)} < %s LIMIT %s', (before, chunk_size))
+            count = cursor.rowcount
+        self.connection.commit()
+        return count
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def get_driver(kind=None):
+    '''
+    Return the driver named by 'kind' ('sqlite', 'postgresql' or 'mysql'). Default is DB_DRIVER.
+    '''
+    kind = (kind or config.DB_DRIVER).lower()
+    if kind == 'sqlite':
+        return SQLiteDriver()
+    if kind in ('postgresql', 'postgres'):
+        return PostgresDriver()
+    if kind == 'mysql':
+        return MySQLDriver()
+    raise ValueError(f'Unknown database driver {kind!r}')
+
+
+class BulkWriter:
+    '''
+    Buffered writer which lands rows in the service-control tables with bulk inserts from a background thread.
+
+    write() only puts the row on a bounded queue; when the queue is full it blocks (backpressure), so producers slow
+    down to what the database absorbs instead of growing memory. The writer thread groups rows by table and columns
+    and flushes a group with one bulk insert (COPY on PostgreSQL, multi-row INSERT on MySQL) once 'max_rows' rows are
+    buffered or 'flush_interval' seconds passed. A failed flush keeps its rows and is retried after 'retry_delay'
+    seconds on a fresh connection; a group which still fails after 'max_attempts' flushes (an unknown table or column,
+    a constraint violation) is moved to 'dead_letters' and counted in stats(), so it does not block the other rows.
+
+    Parameters:
+        driver (object, optional): SQLiteDriver, PostgresDriver or MySQLDriver. Default is get_driver().
+        max_rows (int, optional): Rows buffered before a flush. Default is DB_SINK_MAX_ROWS.
+        flush_interval (float, optional): Maximum seconds a row waits in the buffer. Default is DB_SINK_FLUSH_INTERVAL.
+        queue_size (int, optional): Rows queued before write() blocks. Default is DB_SINK_QUEUE_SIZE.
+        retry_delay (float, optional): Seconds between two flush attempts. Default is RETRY_DELAY.
+        max_attempts (int, optional): Flush attempts of a group before it is dead-lettered. Default is DB_SINK_MAX_ATTEMPTS.
+
+    Attributes:
+        dead_letters (collections.deque): The last DB_SINK_DEAD_LETTERS dead-lettered groups as
+                                          {'table', 'columns', 'rows', 'error'} dictionaries, e.g. to replay them.
+
+    Example:
+        with BulkWriter() as writer:
+            writer.write('vcsapi_systemlog', {'level': 'INFO', 'message': 'started', 'created_at': now})
+    '''
+
+    def __init__(self, driver=None, max_rows=None, flush_interval=None, queue_size=None, retry_delay=None,
+                 max_attempts=None):
+        self.driver = driver or get_driver()
+        self.max_rows = max_rows or config.DB_SINK_MAX_ROWS
+        self.flush_interval = config.DB_SINK_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.retry_delay = float(retry_delay if retry_delay is not None else config.RETRY_DELAY or 5)
+        self.max_attempts = max(max_attempts or config.DB_SINK_MAX_ATTEMPTS, 1)
+        self.dead_letters = collections.deque(maxlen=config.DB_SINK_DEAD_LETTERS)
+        self._queue = queue.Queue(maxsize=queue_size or config.DB_SINK_QUEUE_SIZE)
+        self._buffers = {}
+        self._attempts = {}
+        self._buffered = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {'rows_written': 0, 'flushes': 0, 'errors': 0, 'last_error': None, 'dead_batches': 0,
+                       'dead_rows': 0}
+        self._thread = threading.Thread(target=self._run, name='db-bulk-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, table, row, timeout=None):
+        '''
+        Queue one row (a dictionary of column values) for 'table', blocking while the queue is full.
+
+        Raises:
+            queue.Full: If 'timeout' seconds passed and the queue is still full.
+        '''
+        self._queue.put((table, tuple(row), tuple(row.values())), timeout=timeout)
+
+    def write_many(self, table, rows, timeout=None):
+        for row in rows:
+            self.write(table, row, timeout=timeout)
+
+    def flush(self, timeout=None):
+        '''
+        Block until every row queued before the call has been written.
+        '''
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=None):
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self.driver.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        '''
+        Return {'queued', 'buffered', 'rows_written', 'flushes', 'errors', 'last_error', 'dead_batches', 'dead_rows'}.
+        '''
+        with self._stats_lock:
+            return dict(self._stats, queued=self._queue.qsize(), buffered=self._buffered)
+
+    def _flush_buffers(self):
+        # every group is tried, a failing one does not hold back the others
+        flushed = True
+        for key in list(self._buffers):
+            rows = self._buffers[key]
+            try:
+                if self.driver.connection is None:
+                    self.driver.connect()
+                self.driver.insert_many(key[0], key[1], rows)
+            except Exception as e:
+                attempts = self._attempts[key] = self._attempts.get(key, 0) + 1
+                with self._stats_lock:
+                    self._stats['errors'] += 1
+                    self._stats['last_error'] = repr(e)
+                self.driver.close()
+                if attempts < self.max_attempts:
+                    flushed = False
+                    continue
+                # the rows are given up on, they would block the writer forever
+                self.dead_letters.append({'table': key[0], 'columns': key[1], 'rows': rows, 'error': repr(e)})
+                with self._stats_lock:
+                    self._stats['dead_batches'] += 1
+                    self._stats['dead_rows'] += len(rows)
+            else:
+                with self._stats_lock:
+                    self._stats['rows_written'] += len(rows)
+                    self._stats['flushes'] += 1
+            del self._buffers[key]
+            self._attempts.pop(key, None)
+            self._buffered -= len(rows)
+        return flushed
+
+    def _run(self):
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = False
+            if isinstance(item, tuple):
+                table, columns, values = item
+                self._buffers.setdefault((table, columns), []).append(values)
+                self._buffered += 1
+                if self._buffered < self.max_rows and time.monotonic() < deadline:
+                    continue
+            # size or time threshold reached, or a flush()/close() marker: every row queued before it is buffered
+            while not self._flush_buffers():
+                # the failed rows are kept until 'max_attempts'; the queue fills up meanwhile and write() applies backpressure
+                time.sleep(self.retry_delay)
+            deadline = time.monotonic() + self.flush_interval
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+
+def delete_older_than(driver, table, column, before, chunk_size=None, pause=0.0):
+    '''
+    Delete the rows of 'table' whose 'column' is older than 'before' in chunks of 'chunk_size' rows.
+
+    Every chunk is its own short transaction, so the table is never locked for the whole cleanup and writers keep
+    making progress between chunks.
+
+    Parameters:
+        pause (float): Seconds to sleep between two chunks.
+
+    Returns:
+        int: The number of deleted rows.
+    '''
+    chunk_size = chunk_size or config.DB_DELETE_CHUNK_SIZE
+    if driver.connection is None:
+        driver.connect()
+    deleted = 0
+    while True:
+        count = driver.delete_chunk(table, column, before, chunk_size)
+        deleted += max(count, 0)
+        if count < chunk_size:
+            return deleted
+        if pause:
+            time.sleep(pause)
+
+
+def purge_logs(driver=None, days=None, table=None, column=None):
+    '''
+    Apply the time_delete_log retention: delete the rows of the log table older than 'days' days.
+
+    Parameters:
+        driver (object, optional): Default is get_driver().
+        days (float, optional): Default is DB_TIME_DELETE_LOG.
+        table (str, optional): Default is DB_LOG_TABLE.
+        column (str, optional): The timestamp column. Default is DB_LOG_TIME_COLUMN.
+
+    Returns:
+        int: The number of deleted rows, or the exception if the cleanup failed.
+    '''
+    driver = driver or get_driver()
+    days = config.DB_TIME_DELETE_LOG if days is None else days
+    before = (datetime.datetime.now() - datetime.timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        return delete_older_than(driver, table or config.DB_LOG_TABLE, column or config.DB_LOG_TIME_COLUMN, before)
+    except Exception as e:
+        return e
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+import coreAPI
+from config import config
+
+SnapshotResult = namedtuple('SnapshotResult', ['value', 'synced_at', 'age'])
+SnapshotResult.__doc__ = '''
+A snapshot lookup result.
+
+Attributes:
+    value: The record (dict), the list of records, or None if nothing matched.
+    synced_at (float): UNIX timestamp of the last completed sync of the entity, or None if it was never synced.
+    age (float): Number of seconds since that sync, or None if it was never synced.
+'''
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS clients (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    id INTEGER PRIMARY KEY,
+    clients_id INTEGER,
+    data TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS accounts_clients_id ON accounts (clients_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    entity TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+'''
+
+
+def _digest(data):
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class DirectorySnapshot:
+    '''
+    Local SQLite snapshot of the coreAPI client and account directory.
+
+    'sync' pages through 'clients.search' and 'clients.accounts.search' and only writes the rows whose content changed
+    since the previous sync; rows that disappeared upstream are deleted. Lookups by id and by 'clients_id' are then
+    answered from the local indexes without any coreAPI call, and every result carries the age of the snapshot.
+
+    Parameters:
+        path (str, optional): The path of the SQLite file. Default is DIRECTORY_SNAPSHOT_PATH.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or config.DIRECTORY_SNAPSHOT_PATH
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._connection.commit()
+        self._synced_at = dict(self._connection.execute('SELECT entity, synced_at FROM sync_state'))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _sync_entity(self, table, records, batch_size=1000):
+        with self._lock:
+            digests = dict(self._connection.execute(f'SELECT id, digest FROM {table}'))
+        seen = set()
+        changed = []
+        stats = {'seen': 0, 'changed': 0, 'deleted': 0}
+
+        def flush():
+            with self._lock:
+                if table == 'accounts':
+                    self._connection.executemany(
+                        'INSERT OR REPLACE INTO accounts (id, clients_id, data, digest) VALUES (?, ?, ?, ?)', changed
+                    )
+                else:
+                    self._connection.executemany(
+                        'INSERT OR REPLACE INTO clients (id, data, digest) VALUES (?, ?, ?)', changed
+                    )
+                self._connection.commit()
+            changed.clear()
+
+        for record in records:
+            record_id = record['id']
+            seen.add(record_id)
+            stats['seen'] += 1
+            data = json.dumps(record, sort_keys=True, separators=(',', ':'))
+            digest = _digest(data)
+            if digests.get(record_id) == digest:
+                continue
+            stats['changed'] += 1
+            if table == 'accounts':
+                changed.append((record_id, record.get('clients_id'), data, digest))
+            else:
+                changed.append((record_id, data, digest))
+            if len(changed) >= batch_size:
+                flush()
+        if changed:
+            flush()
+
+        deleted = [(record_id,) for record_id in digests if record_id not in seen]
+        synced_at = time.time()
+        with self._lock:
+            if deleted:
+                self._connection.executemany(f'DELETE FROM {table} WHERE id = ?', deleted)
+            self._connection.execute(
+                'INSERT OR REPLACE INTO sync_state (entity, synced_at) VALUES (?, ?)', (table, synced_at)
+            )
+            self._connection.commit()
+            self._synced_at[table] = synced_at
+        stats['deleted'] = len(deleted)
+        return stats
+
+    def sync(self, clients=None, accounts=None):
+        '''
+        Refresh the snapshot incrementally.
+
+        Parameters:
+            clients (iterable, optional): The client records to sync. Default is 'coreAPI.iter_clients()'.
+            accounts (iterable, optional): The account records to sync. Default is 'coreAPI.iter_accounts()'.
+
+        Returns:
+            dict: For 'clients' and 'accounts', the number of records 'seen', 'changed' (upserted) and 'deleted'.
+
+        Raises:
+            jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+            jsonrpc_requests.jsonrpc.ProtocolError: If there is a protocol-level error during the communication.
+        '''
+        if clients is None:
+            clients = coreAPI.iter_clients()
+        if accounts is None:
+            accounts = coreAPI.iter_accounts()
+        return {
+            'clients': self._sync_entity('clients', clients),
+            'accounts': self._sync_entity('accounts', accounts),
+        }
+
+    def _result(self, entity, value):
+        synced_at = self._synced_at.get(entity)
+        if synced_at is None:
+            return SnapshotResult(value, None, None)
+        return SnapshotResult(value, synced_at, time.time() - synced_at)
+
+    def get_client(self, client_id: int):
+        '''
+        Return the snapshot of the client with 'client_id' as a SnapshotResult.
+        '''
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM clients WHERE id = ?', (client_id,)).fetchone()
+            return self._result('clients', json.loads(row[0]) if row else None)
+
+    def get_account(self, account_id: int):
+        '''
+        Return the snapshot of the account with 'account_id' as a SnapshotResult.
+        '''
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM accounts WHERE id = ?', (account_id,)).fetchone()
+            return self._result('accounts', json.loads(row[0]) if row else None)
+
+    def accounts_of_client(self, client_id: int):
+        '''
+        Return the snapshot of the accounts which belong to 'client_id' as a SnapshotResult holding a list.
+        '''
+        with self._lock:
+            rows = self._connection.execute('SELECT data FROM accounts WHERE clients_id = ? ORDER BY id', (client_id,))
+            return self._result('accounts', [json.loads(row[0]) for row in rows])
@@ -0,0 +1,30 @@
+import pytest
+
+from coreapi_gateway import AUTHORIZATION_REQUIRED, INVALID_REQUEST, CoreAPIGateway
+
+
+@pytest.fixture
+def gateway():
+    # nothing is forwarded in these tests, the upstream is never contacted
+    with CoreAPIGateway(upstream_url='http://127.0.0.1:9', method_ttls={'clients.get': 60}) as gateway:
+        yield gateway
+
+
+def test_invalid_batch_items(gateway):
+    assert gateway.handle([1, 'x']) == [
+        {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST},
+        {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST},
+    ]
+    assert gateway.handle([]) == {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST}
+    assert gateway.handle(5) == {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST}
+    assert gateway.stats()['passthrough'] == 0
+
+
+def test_cached_method_requires_a_token(gateway):
+    request = {'jsonrpc': '2.0', 'method': 'clients.get', 'params': {'id': 1}, 'id': 7}
+    assert gateway.handle(request) == {'jsonrpc': '2.0', 'id': 7, 'error': AUTHORIZATION_REQUIRED}
+    assert gateway.handle([request, 3]) == [
+        {'jsonrpc': '2.0', 'id': 7, 'error': AUTHORIZATION_REQUIRED},
+        {'jsonrpc': '2.0', 'id': None, 'error': INVALID_REQUEST},
+    ]
+    assert gateway.stats()['rejected'] == 2
@@ -0,0 +1,62 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from coreapi_resilience import CircuitOpenError, DeadlineExceeded, deadline
+from coreapi_scheduler import BULK, INTERACTIVE, RPCScheduler
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+def fail(scheduler, error):
+    with pytest.raises(type(error)):
+        with scheduler.slot('clients.get'):
+            raise error
+
+
+def test_client_errors_do_not_shrink_the_limit():
+    scheduler = RPCScheduler(initial_limit=8)
+    for _ in range(20):
+        fail(scheduler, http_error(400))
+        fail(scheduler, http_error(401))
+        fail(scheduler, DeadlineExceeded('Deadline exceeded'))
+        fail(scheduler, CircuitOpenError('Circuit open'))
+    assert scheduler.stats()['decreases'] == 0
+    assert scheduler.limit == 8
+    assert scheduler.stats()['in_flight'] == 0
+
+
+@pytest.mark.parametrize('error', [requests.ConnectionError(), requests.Timeout(), http_error(503)])
+def test_server_failures_shrink_the_limit(error):
+    scheduler = RPCScheduler(initial_limit=8)
+    fail(scheduler, error)
+    assert scheduler.stats()['decreases'] == 1
+    assert scheduler.limit < 8
+
+
+def test_queue_wait_is_bounded_by_the_deadline():
+    scheduler = RPCScheduler(initial_limit=1, min_limit=1, max_limit=1)
+    ticket = scheduler.acquire(INTERACTIVE)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        with deadline(0.1):
+            scheduler.acquire(BULK)
+    assert time.monotonic() - start < 1
+    assert scheduler.stats()['classes']['bulk']['queued'] == 0
+
+    # the caller which gave up does not block the next one
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(scheduler.acquire(BULK)))
+    waiter.start()
+    time.sleep(0.05)
+    scheduler.release(ticket)
+    waiter.join(2)
+    assert admitted and admitted[0] is not None
+    scheduler.release(admitted[0])
+    assert scheduler.stats()['in_flight'] == 0
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+import coreapi_stream
+from coreapi_stream import ResultStreamParser
+
+RECORDS = [
+    {'id': 1, 'name': 'plain'},
+    {'id': 2, 'name': 'brackets ] } [ { and, commas', 'tags': ['a', 'b,c']},
+    {'id': 3, 'name': 'escaped \\" quote \\\\', 'nested': {'list': [[1, 2], {'x': [3]}], 'empty': {}}},
+    {'id': 4, 'name': 'unicode é中', 'value': None},
+    [],
+    'a string element, with a comma]',
+    12.5,
+]
+
+
+def parse(body, chunk_size):
+    parser = ResultStreamParser()
+    elements = []
+    for start in range(0, len(body), chunk_size):
+        elements += parser.feed(body[start:start + chunk_size])
+    elements += parser.close()
+    return parser, elements
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def decoder(request, monkeypatch):
+    if request.param == 'json':
+        monkeypatch.setattr(coreapi_stream, '_loads', json.loads)
+    elif coreapi_stream.orjson is None:
+        pytest.skip('orjson is not installed')
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 100000])
+def test_result_elements_across_chunks(decoder, chunk_size):
+    body = json.dumps({'jsonrpc': '2.0', 'id': 5, 'result': RECORDS, 'extra': {'result': [1]}}).encode('utf-8')
+    parser, elements = parse(body, chunk_size)
+    assert elements == RECORDS
+    assert parser.in_result
+    assert parser.members == {'jsonrpc': '2.0', 'id': 5, 'extra': {'result': [1]}}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 100000])
+def test_whitespace_and_nested_result_key(decoder, chunk_size):
+    body = b'{ "meta" : {"result": [9, 9]} , "result" : [ {"a" : [ 1 , 2 ] } ,\n {"b": "]"} ] , "id": 1 }'
+    parser, elements = parse(body, chunk_size)
+    assert elements == [{'a': [1, 2]}, {'b': ']'}]
+    assert parser.members == {'meta': {'result': [9, 9]}, 'id': 1}
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100000])
+def test_error_response(decoder, chunk_size):
+    body = json.dumps({'jsonrpc': '2.0', 'id': 1, 'error': {'code': -32002, 'message': 'Authorization required'}})
+    parser, elements = parse(body.encode('utf-8'), chunk_size)
+    assert elements == []
+    assert not parser.in_result
+    assert parser.members['error']['code'] == -32002
+
+
+def test_scalar_and_empty_results(decoder):
+    assert parse(b'{"id": 1, "result": {"token": "x"}}', 4)[1] == [{'token': 'x'}]
+    assert parse(b'{"id": 1, "result": null}', 4)[1] == []
+    assert parse(b'{"id": 1, "result": []}', 1)[1] == []
+
+
+def test_elements_are_returned_before_the_end(decoder):
+    parser = ResultStreamParser()
+    assert parser.feed(b'{"id": 1, "result": [{"id": 1}, {"id"') == [{'id': 1}]
+    assert parser.feed(b': 2}, {"id": 3}') == [{'id': 2}]
+    assert parser.feed(b']}') == []
+    assert parser.close() == [{'id': 3}]
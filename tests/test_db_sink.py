@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+from db_sink import BulkWriter, SQLiteDriver
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'sink.db')
+    with sqlite3.connect(path) as connection:
+        connection.execute('CREATE TABLE vcsapi_systemlog (level TEXT, message TEXT)')
+    return path
+
+
+def rows(path):
+    with sqlite3.connect(path) as connection:
+        return connection.execute('SELECT level, message FROM vcsapi_systemlog ORDER BY rowid').fetchall()
+
+
+def test_rows_are_flushed_in_bulk(database):
+    writer = BulkWriter(driver=SQLiteDriver(database), max_rows=3, flush_interval=60, retry_delay=0)
+    writer.write_many('vcsapi_systemlog', ({'level': 'INFO', 'message': str(i)} for i in range(7)))
+    assert writer.flush(timeout=5)
+    stats = writer.stats()
+    writer.close(timeout=5)
+    assert rows(database) == [('INFO', str(i)) for i in range(7)]
+    assert stats['rows_written'] == 7
+    assert stats['flushes'] == 3
+    assert stats['buffered'] == 0
+
+
+def test_failing_group_is_dead_lettered(database):
+    writer = BulkWriter(driver=SQLiteDriver(database), max_rows=100, flush_interval=60, retry_delay=0, max_attempts=3)
+    writer.write('vcsapi_systemlog', {'level': 'INFO', 'message': 'kept'})
+    writer.write('missing_table', {'level': 'INFO', 'message': 'lost'})
+    assert writer.flush(timeout=5)
+    stats = writer.stats()
+    writer.close(timeout=5)
+    assert rows(database) == [('INFO', 'kept')]
+    assert stats['errors'] == 3
+    assert stats['dead_batches'] == 1
+    assert stats['dead_rows'] == 1
+    dead = writer.dead_letters[0]
+    assert dead['table'] == 'missing_table'
+    assert dead['columns'] == ('level', 'message')
+    assert dead['rows'] == [('INFO', 'lost')]
+
+
+def test_close_flushes_the_remaining_rows(database):
+    writer = BulkWriter(driver=SQLiteDriver(database), max_rows=100, flush_interval=60, retry_delay=0)
+    writer.write('vcsapi_systemlog', {'level': 'WARN', 'message': 'last'})
+    writer.close(timeout=5)
+    assert rows(database) == [('WARN', 'last')]
@@ -0,0 +1,70 @@
+import datetime
+import json
+
+from xdr_export import XDRExporter
+
+START = datetime.datetime(2024, 1, 1)
+HOT_SECOND = START + datetime.timedelta(seconds=7)
+
+
+def fake_query(per_second, hot=None):
+    # 'per_second' XDRs every second, truncated to 'limit' like the server; 'hot' seconds hold 'limit' XDRs by themselves
+    calls = []
+
+    def query(date_from, date_to, billed_clients_id=None, return_fields=None, origin='orig', limit=0):
+        calls.append((date_from, date_to))
+        records = []
+        moment = date_from
+        while moment <= date_to:
+            count = limit if moment in (hot or ()) else per_second
+            records += [{'start_time': str(moment), 'n': n, 'client': billed_clients_id} for n in range(count)]
+            moment += datetime.timedelta(seconds=1)
+        return records[:limit]
+
+    query.calls = calls
+    return query
+
+
+def exporter(tmp_path, query, **kwargs):
+    return XDRExporter(str(tmp_path / 'xdrs.jsonl'), return_fields=['start_time', 'n', 'client'], query=query,
+                       page_limit=4, workers=2, window=datetime.timedelta(seconds=16), **kwargs)
+
+
+def read(tmp_path):
+    with open(tmp_path / 'xdrs.jsonl') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_truncated_windows_are_split_until_complete(tmp_path):
+    query = fake_query(per_second=1)
+    stats = exporter(tmp_path, query).export(START, START + datetime.timedelta(seconds=31), client_ids=[1, 2])
+    records = read(tmp_path)
+    assert len(records) == 64
+    assert len({(r['client'], r['start_time']) for r in records}) == 64
+    assert stats['records'] == 64
+    assert stats['splits'] > 0
+    assert stats['incomplete'] == []
+    # every written window returned less than the page limit
+    assert stats['windows'] == 2 * 32 // 2
+
+
+def test_resume_skips_finished_windows(tmp_path):
+    first = exporter(tmp_path, fake_query(per_second=1)).export(START, START + datetime.timedelta(seconds=15))
+    query = fake_query(per_second=1)
+    second = exporter(tmp_path, query).export(START, START + datetime.timedelta(seconds=15))
+    assert query.calls == []
+    assert second['skipped'] == first['windows']
+    assert len(read(tmp_path)) == 16
+
+
+def test_saturated_second_is_reported_incomplete(tmp_path):
+    query = fake_query(per_second=1, hot={HOT_SECOND})
+    stats = exporter(tmp_path, query).export(START, START + datetime.timedelta(seconds=15))
+    key = 'None|2024-01-01 00:00:07|2024-01-01 00:00:07'
+    assert stats['incomplete'] == [key]
+    with open(str(tmp_path / 'xdrs.jsonl') + '.checkpoint') as f:
+        assert {'window': key, 'status': 'incomplete'} in [json.loads(line) for line in f]
+    # a resumed export does not query it again but still reports it
+    query = fake_query(per_second=1, hot={HOT_SECOND})
+    assert exporter(tmp_path, query).export(START, START + datetime.timedelta(seconds=15))['incomplete'] == [key]
+    assert query.calls == []
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from xdr_reconcile import MATCHED, XDR_ONLY, CDR_ONLY, UNPARSED, external_sort, reconcile, reconcile_to_files
+
+NAN = float('nan')
+A, B, C = ('8490', '8428'), ('8491', '8429'), ('8492', '8420')
+
+XDRS = [
+    (A, 100.0, {'xdr': 'a1'}),
+    (A, 200.0, {'xdr': 'a2'}),
+    (B, 50.0, {'xdr': 'b1'}),
+    (A, NAN, {'xdr': 'nan'}),
+]
+CDRS = [
+    (A, 203.0, {'cdr': 'a2'}),
+    (A, 101.0, {'cdr': 'a1'}),
+    (A, 150.0, {'cdr': 'a-late'}),
+    (C, 10.0, {'cdr': 'c1'}),
+    (B, NAN, {'cdr': 'nan'}),
+]
+
+
+def summary(results):
+    return sorted(((kind, (xdr or {}).get('xdr'), (cdr or {}).get('cdr')) for kind, xdr, cdr in results), key=repr)
+
+
+EXPECTED = sorted([
+    (MATCHED, 'a1', 'a1'),
+    (MATCHED, 'a2', 'a2'),
+    (XDR_ONLY, 'b1', None),
+    (CDR_ONLY, None, 'a-late'),
+    (CDR_ONLY, None, 'c1'),
+    (UNPARSED, 'nan', None),
+    (UNPARSED, None, 'nan'),
+], key=repr)
+
+
+@pytest.mark.parametrize('run_size', [1, 2, 1000])
+def test_reconcile_join(tmp_path, run_size):
+    results = list(reconcile(iter(XDRS), iter(CDRS), tolerance=5, run_size=run_size, directory=str(tmp_path)))
+    assert summary(results) == EXPECTED
+    # the unparsed records come last, once both inputs are read
+    assert [kind for kind, _, _ in results[-2:]] == [UNPARSED, UNPARSED]
+
+
+def test_reconcile_matches_the_earliest_cdr_in_the_window():
+    xdrs = [(A, 100.0, {'xdr': 'x'})]
+    cdrs = [(A, 104.0, {'cdr': 'later'}), (A, 97.0, {'cdr': 'earlier'})]
+    assert summary(reconcile(xdrs, cdrs, tolerance=5, run_size=10)) == sorted([
+        (MATCHED, 'x', 'earlier'), (CDR_ONLY, None, 'later'),
+    ], key=repr)
+
+
+def test_external_sort_spills_runs_and_reports_nan(tmp_path):
+    entries = [((str(i % 3),), float(10 - i), i) for i in range(10)] + [(('0',), NAN, 'nan')]
+    unparsed = []
+    ordered = list(external_sort(entries, run_size=3, directory=str(tmp_path), unparsed=unparsed.append))
+    assert [(key, moment) for key, moment, _ in ordered] == sorted((key, moment) for key, moment, _ in entries[:10])
+    assert [record for _, _, record in unparsed] == ['nan']
+
+
+def test_reconcile_to_files(tmp_path):
+    counts = reconcile_to_files(XDRS, CDRS, str(tmp_path), tolerance=5, run_size=2)
+    assert counts == {MATCHED: 2, XDR_ONLY: 1, CDR_ONLY: 2, UNPARSED: 2}
+    with open(tmp_path / 'unparsed.jsonl') as f:
+        unparsed = [json.loads(line) for line in f]
+    assert {'xdr': {'xdr': 'nan'}, 'cdr': None} in unparsed
+    assert {'xdr': None, 'cdr': {'cdr': 'nan'}} in unparsed
+    with open(tmp_path / 'matched.jsonl') as f:
+        assert len(f.readlines()) == 2
@@ -0,0 +1,340 @@
+import bisect
+import datetime
+import functools
+import json
+import math
+import os
+from array import array
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+try:
+    import numpy
+except ImportError:  # bulk conversions fall back to bisect over Python lists
+    numpy = None
+
+try:
+    import yaml
+except ImportError:  # the mapping file is then read as JSON or 'KEY = VALUE' lines
+    yaml = None
+
+from config import config
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+TABLE_FIRST_YEAR = 1970
+TABLE_LAST_YEAR = 2100
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+@functools.lru_cache(maxsize=None)
+def load_timezone_mapping(path=None):
+    '''
+    Load the timezone mapping file once per process.
+
+    The file maps the timezone abbreviations found in the CDRs (e.g. 'ICT') to IANA zone names (e.g. 'Asia/Bangkok').
+    JSON and YAML (if PyYAML is installed) files are supported, as well as plain 'KEY = VALUE' / 'KEY: VALUE' lines.
+
+    Parameters:
+        path (str, optional): The mapping file. Default is TIMEZONE_MAPPING_FILE_PATH.
+
+    Returns:
+        dict: The abbreviation to zone name mapping, empty if no file is configured or found.
+    '''
+    path = path or config.TIMEZONE_MAPPING_FILE_PATH
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        text = f.read()
+    if path.endswith('.json'):
+        return {str(k): str(v) for k, v in json.loads(text).items()}
+    if yaml is not None and path.endswith(('.yml', '.yaml')):
+        return {str(k): str(v) for k, v in (yaml.safe_load(text) or {}).items()}
+    mapping = {}
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        for separator in ('=', ':', ','):
+            if separator in line:
+                key, value = line.split(separator, 1)
+                mapping[key.strip().strip('"\'')] = value.strip().strip('"\'')
+                break
+    return mapping
+
+
+@functools.lru_cache(maxsize=None)
+def get_zone(name):
+    '''
+    Return the ZoneInfo of an IANA zone name or of an abbreviation listed in the mapping file.
+
+    Raises:
+        zoneinfo.ZoneInfoNotFoundError: If the name is neither a known zone nor a mapped abbreviation.
+    '''
+    name = load_timezone_mapping().get(name, name)
+    try:
+        return ZoneInfo(name)
+    except (ValueError, ZoneInfoNotFoundError):
+        if name.upper() in ('UTC', 'GMT', 'Z'):
+            return ZoneInfo('UTC')
+        raise ZoneInfoNotFoundError(f'Unknown timezone {name!r}')
+
+
+def _offset(zone, seconds):
+    return datetime.datetime.fromtimestamp(seconds, zone).utcoffset().total_seconds()
+
+
+class TransitionTable:
+    '''
+    UTC offset transitions of a zone between TABLE_FIRST_YEAR and TABLE_LAST_YEAR.
+
+    'transitions[i]' is the UTC timestamp from which 'offsets[i]' (seconds east of UTC) applies; the first entry covers
+    everything before the first transition. The table is found by sampling the zone once a day and narrowing every
+    change down to the second, so it is built once per zone (see get_transition_table) and then only bisected.
+    '''
+
+    __slots__ = ('zone', 'transitions', 'offsets', '_np_transitions', '_np_offsets')
+
+    def __init__(self, zone):
+        self.zone = zone
+        start = (datetime.datetime(TABLE_FIRST_YEAR, 1, 1) - _EPOCH).total_seconds()
+        stop = (datetime.datetime(TABLE_LAST_YEAR, 1, 1) - _EPOCH).total_seconds()
+        transitions = [-math.inf]
+        offsets = [_offset(zone, start)]
+        previous, current = start, start + 86400
+        while current < stop:
+            offset = _offset(zone, current)
+            if offset != offsets[-1]:
+                low, high = previous, current
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    if _offset(zone, middle) == offsets[-1]:
+                        low = middle
+                    else:
+                        high = middle
+                transitions.append(high)
+                offsets.append(offset)
+            previous, current = current, current + 86400
+        self.transitions = transitions
+        self.offsets = offsets
+        if numpy is not None:
+            self._np_transitions = numpy.array(transitions, dtype='float64')
+            self._np_offsets = numpy.array(offsets, dtype='float64')
+
+    def utc_offset(self, utc_seconds):
+        return self.offsets[bisect.bisect_right(self.transitions, utc_seconds) - 1]
+
+    def utc_to_local(self, utc_seconds):
+        '''
+        Convert a column of UTC timestamps to wall-clock timestamps of the zone.
+
+        Returns:
+            numpy.ndarray or array.array: Float64 wall-clock seconds since 1970-01-01.
+        '''
+        if numpy is not None:
+            values = numpy.asarray(utc_seconds, dtype='float64')
+            index = numpy.searchsorted(self._np_transitions, values, side='right') - 1
+            return values + self._np_offsets[index]
+        transitions, offsets = self.transitions, self.offsets
+        return array('d', (value + offsets[bisect.bisect_right(transitions, value) - 1] for value in utc_seconds))
+
+    def local_to_utc(self, local_seconds):
+        '''
+        Convert a column of wall-clock timestamps of the zone to UTC timestamps.
+
+        Like datetime with fold=0, ambiguous times (clocks set back) resolve to their first occurrence and
+        non-existent times (clocks set forward) are read with the offset in force before the gap.
+
+        Returns:
+            numpy.ndarray or array.array: Float64 UTC seconds since 1970-01-01.
+        '''
+        if numpy is not None:
+            values = numpy.asarray(local_seconds, dtype='float64')
+            transitions, offsets = self._np_transitions, self._np_offsets
+            guess = values - offsets[numpy.searchsorted(transitions, values, side='right') - 1]
+            index = numpy.searchsorted(transitions, guess, side='right') - 1
+            first = values - offsets[index]
+            before = values - offsets[numpy.maximum(index - 1, 0)]
+            boundary = transitions[index]
+            use_before = (index > 0) & ((before < boundary) | (first < boundary))
+            return numpy.where(use_before, before, first)
+        return array('d', (self._local_to_utc(value) for value in local_seconds))
+
+    def _local_to_utc(self, value):
+        transitions, offsets = self.transitions, self.offsets
+        index = bisect.bisect_right(transitions, value - offsets[bisect.bisect_right(transitions, value) - 1]) - 1
+        first = value - offsets[index]
+        if index > 0:
+            # the wall time also exists before the transition (clocks set back), or not at all (clocks set forward)
+            before = value - offsets[index - 1]
+            if before < transitions[index] or first < transitions[index]:
+                return before
+        return first
+
+
+@functools.lru_cache(maxsize=None)
+def get_transition_table(name):
+    '''
+    Return the TransitionTable of a zone name or mapped abbreviation, built on first use.
+    '''
+    return TransitionTable(get_zone(name))
+
+
+@functools.lru_cache(maxsize=65536)
+def _day_seconds(year, month, day):
+    return (datetime.datetime(year, month, day) - _EPOCH).total_seconds()
+
+
+@functools.lru_cache(maxsize=65536)
+def _cisco_day(date):
+    # 'Tue Jan 11 2022' -> seconds of the day's midnight; a day of CDRs repeats the same few dates
+    _, month, day, year = date.split()
+    return _day_seconds(int(year), _MONTHS[month], int(day))
+
+
+def _clock_seconds(clock):
+    hour, minute, second = clock.split(':')
+    return int(hour) * 3600 + int(minute) * 60 + float(second)
+
+
+def _parse_cisco(value):
+    clock, abbreviation, date = value.lstrip('*.').split(' ', 2)
+    return _cisco_day(date) + _clock_seconds(clock), abbreviation
+
+
+def _parse_iso(value):
+    # 'YYYY-MM-DD HH:MM:SS[.ffffff]' by slicing, several times faster than strptime
+    return _day_seconds(int(value[0:4]), int(value[5:7]), int(value[8:10])) + _clock_seconds(value[11:]), None
+
+
+@functools.lru_cache(maxsize=256)
+def _strptime_parser(fmt):
+    def parse(value):
+        moment = datetime.datetime.strptime(value, fmt)
+        return (moment - _EPOCH).total_seconds(), None
+    return parse
+
+
+@functools.lru_cache(maxsize=1024)
+def _detect_parser(shape):
+    '''
+    Pick the parser for a timestamp shape (its string with every digit replaced by '9'); cached per shape.
+    '''
+    if ':' in shape and len(shape.lstrip('*.').split()) == 6:
+        return _parse_cisco
+    if len(shape) >= 19 and shape[4] == '-' and shape[7] == '-' and shape[10] in ' T' and shape[13] == ':':
+        return _parse_iso
+    return None
+
+
+_DIGITS = str.maketrans('0123456789', '9999999999')
+
+
+def parse_timestamps(values, fmt=None, with_zone=False):
+    '''
+    Parse a column of wall-clock timestamp strings into seconds since 1970-01-01 (not converted to UTC).
+
+    Cisco connect times ('*10:38:03.123 ICT Tue Jan 11 2022') and ISO timestamps are recognised; the parser is chosen
+    once per timestamp shape and the date part of every value is cached, so a column of one day's CDRs costs a few
+    integer conversions per value. Unparseable and empty values become NaN.
+
+    Parameters:
+        values (iterable): The timestamp strings.
+        fmt (str, optional): A strptime format to use instead of the detection.
+        with_zone (bool): Also return the timezone abbreviation of every value (None if it has none).
+
+    Returns:
+        array.array: Float64 seconds, or a (seconds, abbreviations) tuple if 'with_zone' is True.
+    '''
+    seconds = array('d')
+    abbreviations = [] if with_zone else None
+    fixed = _strptime_parser(fmt) if fmt else None
+    for value in values:
+        value = value.strip() if value else ''
+        parser = fixed or (_detect_parser(value.translate(_DIGITS)) if value else None)
+        try:
+            second, abbreviation = parser(value) if parser else (math.nan, None)
+        except (KeyError, ValueError):
+            second, abbreviation = math.nan, None
+        seconds.append(second)
+        if with_zone:
+            abbreviations.append(abbreviation)
+    return (seconds, abbreviations) if with_zone else seconds
+
+
+def cdr_times_to_utc(values, zone=None):
+    '''
+    Parse a column of CDR timestamps and convert it to UTC in bulk.
+
+    Values carrying an abbreviation listed in the mapping file are converted with the mapped zone, the others with
+    'zone'.
+
+    Parameters:
+        values (iterable): The timestamp strings.
+        zone (str, optional): The zone of the CDR wall-clock times. Default is CDR_TIMEZONE.
+
+    Returns:
+        numpy.ndarray or array.array: Float64 UTC seconds since 1970-01-01, NaN for unparseable values.
+    '''
+    zone = zone or config.CDR_TIMEZONE or 'UTC'
+    seconds, abbreviations = parse_timestamps(values, with_zone=True)
+    mapping = load_timezone_mapping()
+    zones = {mapping[a] for a in set(abbreviations) if a in mapping}
+    if not zones or zones == {zone}:
+        return get_transition_table(zone).local_to_utc(seconds)
+    result = get_transition_table(zone).local_to_utc(seconds)
+    for name in zones:
+        indexes = [i for i, a in enumerate(abbreviations) if mapping.get(a) == name]
+        converted = get_transition_table(name).local_to_utc([seconds[i] for i in indexes])
+        for i, value in zip(indexes, converted):
+            result[i] = value
+    return result
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_day(day):
+    return (_EPOCH + datetime.timedelta(days=day)).strftime('%Y-%m-%d ')
+
+
+def format_timestamps(seconds, fmt=DATE_FORMAT):
+    '''
+    Format a column of seconds since 1970-01-01 as strings; NaN becomes None.
+
+    The default DATE_FORMAT is built from a per-day cached date string and integer arithmetic for the clock.
+    '''
+    result = []
+    for value in seconds:
+        if value != value:
+            result.append(None)
+        elif fmt == DATE_FORMAT:
+            day, second = divmod(int(value), 86400)
+            hour, second = divmod(second, 3600)
+            minute, second = divmod(second, 60)
+            result.append(f'{_format_day(day)}{hour:02d}:{minute:02d}:{second:02d}')
+        else:
+            result.append((_EPOCH + datetime.timedelta(seconds=float(value))).strftime(fmt))
+    return result
+
+
+def _utc_seconds(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return (value - _EPOCH).total_seconds()
+        return value.timestamp()
+    return float(value)
+
+
+def xdr_filter_window(utc_from, utc_to, zone=None):
+    '''
+    Build the 'date' filter of 'reports.xdrs_list.query' for a UTC range.
+
+    Parameters:
+        utc_from (datetime.datetime or float): The start of the range, an aware datetime, a naive UTC datetime or a
+                                               UTC timestamp.
+        utc_to (datetime.datetime or float): The end of the range, same types.
+        zone (str, optional): The zone the server filters in. Default is XDR_FILTER_TIMEZONE.
+
+    Returns:
+        list: [date_from, date_to] as DATE_FORMAT wall-clock strings of 'zone'.
+    '''
+    table = get_transition_table(zone or config.XDR_FILTER_TIMEZONE or 'UTC')
+    local = table.utc_to_local([_utc_seconds(utc_from), _utc_seconds(utc_to)])
+    return format_timestamps(local)
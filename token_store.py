@@ -0,0 +1,158 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, the store then only serialises threads of one process
+    fcntl = None
+
+import jwt
+
+from config import config
+
+
+def token_expire_at(token, default_lifetime=3600):
+    '''
+    Return the expiry of a JWT token as a UNIX timestamp, read from its 'exp' claim without verifying the signature.
+
+    If the token cannot be decoded or carries no 'exp' claim, the expiry is 'default_lifetime' seconds from now.
+    '''
+    try:
+        decoded_data = jwt.decode(jwt=token, algorithms=['HS256'], options={'verify_signature': False})
+        return float(decoded_data['exp'])
+    except (jwt.exceptions.DecodeError, KeyError, TypeError, ValueError):
+        return time.time() + default_lifetime
+
+
+class TokenStore:
+    '''
+    JWT token store shared by every process on the host.
+
+    The token is kept in a small JSON file, separate from config/.env. Writes go to a temporary file which is renamed
+    over the store, so readers never see a half written token. Readers re-read the file whenever its stat changes.
+    Refreshing an expiring token happens under an exclusive advisory lock (fcntl.flock) on '<path>.lock': the first
+    process refreshes, the others wait on the lock and then reuse the token it wrote.
+
+    Parameters:
+        path (str, optional): The path of the store file. Default is COREAPI_TOKEN_STORE_PATH.
+        refresh_margin (int, optional): Seconds before expiry at which the token is refreshed. Default is COREAPI_TOKEN_REFRESH_MARGIN.
+
+    Attributes:
+        refreshes (int): Number of refreshes made by this process.
+    '''
+
+    def __init__(self, path=None, refresh_margin=None):
+        self.path = path or config.COREAPI_TOKEN_STORE_PATH
+        self.lock_path = self.path + '.lock'
+        self.refresh_margin = config.COREAPI_TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self.refreshes = 0
+        self._thread_lock = threading.Lock()
+        self._cached = (None, {})
+
+    def read(self):
+        '''
+        Return the stored {'token': ..., 'expire_at': ...} dictionary, or an empty dictionary if nothing is stored.
+
+        The file is only parsed again when its inode, size or modification time changed.
+        '''
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+        stat_key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached_key, data = self._cached
+        if stat_key != cached_key:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                data = {}
+            self._cached = (stat_key, data)
+        return data
+
+    def write(self, token):
+        '''
+        Atomically replace the stored token.
+        '''
+        data = {'token': token, 'expire_at': token_expire_at(token)}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.token-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return data
+
+    def _is_fresh(self, data):
+        return bool(data.get('token')) and time.time() < data.get('expire_at', 0) - self.refresh_margin
+
+    def get_token(self, refresh):
+        '''
+        Return a valid token, calling 'refresh()' to obtain a new one if the stored token is missing or about to expire.
+
+        Parameters:
+            refresh (callable): A function returning a new JWT token. It runs under the cross-process lock.
+
+        Raises:
+            Exception: Any exception raised by 'refresh'. The stored token is left untouched.
+        '''
+        data = self.read()
+        if self._is_fresh(data):
+            return data['token']
+        with self._thread_lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                # another process may have refreshed the token while we waited for the lock
+                data = self.read()
+                if self._is_fresh(data):
+                    return data['token']
+                token = refresh()
+                self.refreshes += 1
+                return self.write(token)['token']
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def invalidate(self, token):
+        '''
+        Remove the stored token if it is still 'token', so the next get_token() of every process refreshes it.
+        A token another process already stored in its place is kept.
+        '''
+        with self._thread_lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                if self.read().get('token') == token:
+                    try:
+                        os.remove(self.path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+_token_store = None
+_token_store_lock = threading.Lock()
+
+
+def get_token_store():
+    '''
+    Return the process-wide TokenStore for the COREAPI_SERVER token, creating it on first use.
+    '''
+    global _token_store
+    if _token_store is None:
+        with _token_store_lock:
+            if _token_store is None:
+                _token_store = TokenStore()
+    return _token_store
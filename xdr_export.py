@@ -0,0 +1,254 @@
+import csv
+import datetime
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from config import config
+from coreapi_session import get_xdr_session
+from coreapi_transport import get_transport
+from coreapi_stream import iter_result
+from coreapi_scheduler import BULK, priority
+from timezones import xdr_filter_window
+from coreapi_records import project, compact_records
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+XDR_RETURN_FIELDS = ["src_party_id_ext", "dst_party_id_ext", "start_time", "stop_time", "volume", "subscriber_host", "subscriber_id"]
+
+
+def xdr_query_params(date_from, date_to, billed_clients_id=None, return_fields=None, origin='orig', limit: int = 0):
+    '''
+    Build the params of one 'reports.xdrs_list.query' (see 'query_xdrs'), for the sync and the async clients alike.
+    Aware datetimes are converted to XDR_FILTER_TIMEZONE wall-clock times.
+    '''
+    if date_from.tzinfo is not None or date_to.tzinfo is not None:
+        date = xdr_filter_window(date_from, date_to)
+    else:
+        date = [date_from.strftime(DATE_FORMAT), date_to.strftime(DATE_FORMAT)]
+    filters = {"origin": origin, "date": date}
+    if billed_clients_id is not None:
+        filters["billed_clients_id"] = billed_clients_id
+    return {
+        "return_fields": list(return_fields or XDR_RETURN_FIELDS),
+        "filters": filters,
+        "limit": limit or config.XDR_PAGE_LIMIT,
+    }
+
+
+def query_xdrs(date_from, date_to, billed_clients_id=None, return_fields=None, origin='orig', limit: int = 0, fields=None,
+               compact=None):
+    '''
+    Run one 'reports.xdrs_list.query' over the window [date_from, date_to] on XDR_COREAPI_SERVER, through the shared
+    transport and the XDR session (see coreapi_session.get_xdr_session).
+
+    Parameters:
+        date_from (datetime.datetime): The start of the window (inclusive). Naive values are wall-clock times of
+                                       XDR_FILTER_TIMEZONE, aware values are converted to it.
+        date_to (datetime.datetime): The end of the window (inclusive).
+        billed_clients_id (int, optional): Only return the XDRs billed to this client.
+        return_fields (list, optional): The XDR fields to return. Default is XDR_RETURN_FIELDS.
+        origin (str): The XDR origin filter. Default is 'orig'.
+        limit (int): The maximum number of XDRs to return. Default is 0, which means XDR_PAGE_LIMIT is used.
+        fields (list, optional): Projection of the XDRs: sent as 'return_fields' and applied to the received records,
+                                 in case the server returns more. Takes precedence over 'return_fields'.
+        compact (str, optional): 'columns' or 'slots' for a compact container (see coreAPI.coreapi_clients_search).
+
+    Returns:
+        list: A list of dictionaries, one per XDR, or the compact container selected by 'compact'.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If the server answers with a JSON-RPC error.
+    '''
+    params = xdr_query_params(date_from, date_to, billed_clients_id, fields or return_fields, origin, limit)
+    result = get_xdr_session().run(lambda token: get_transport().call(
+        config.XDR_COREAPI_SERVER, "reports.xdrs_list.query", params, token=token
+    ))
+    result = project(result or [], fields)
+    if compact:
+        return compact_records(result, fields or params["return_fields"], compact)
+    return result
+
+
+def iter_xdrs(date_from, date_to, billed_clients_id=None, return_fields=None, origin='orig', limit: int = 0,
+              fields=None):
+    '''
+    Run one 'reports.xdrs_list.query' like 'query_xdrs', but yield the XDRs one at a time while the gzip-compressed
+    response is received (see coreapi_stream.iter_result), so a large window does not have to fit in memory.
+
+    Yields:
+        dict: The information about each XDR.
+
+    Raises:
+        jsonrpc_requests.jsonrpc.TransportError: If there is a transport-related error while communicating with the coreAPI server.
+        jsonrpc_requests.jsonrpc.ProtocolError: If the server answers with a JSON-RPC error.
+    '''
+    params = xdr_query_params(date_from, date_to, billed_clients_id, fields or return_fields, origin, limit)
+    records = get_xdr_session().run_iter(
+        lambda token: iter_result(config.XDR_COREAPI_SERVER, "reports.xdrs_list.query", params, token=token)
+    )
+    if not fields:
+        yield from records
+        return
+    for record in records:
+        yield {field: record.get(field) for field in fields}
+
+
+class XDRExporter:
+    '''
+    Export every XDR of a date range to a JSONL or CSV file using concurrent, time-partitioned queries.
+
+    The date range (and optionally a list of billed client ids) is split into windows of 'window' length which are
+    queried concurrently by a pool of 'workers' threads. A window whose result reaches the page limit may be truncated,
+    so it is split in two halves which are queried again, until no window is truncated.
+    Finished windows are appended to a checkpoint file, so an interrupted export resumes where it stopped.
+
+    Parameters:
+        output_path (str): The path of the output file. Records are appended to it.
+        output_format (str): 'jsonl' or 'csv'. Default is 'jsonl'.
+        return_fields (list, optional): The XDR fields to export. Default is XDR_RETURN_FIELDS.
+        checkpoint_path (str, optional): The path of the checkpoint file. Default is '<output_path>.checkpoint'.
+        workers (int): The number of concurrent queries. Default is 0, which means XDR_EXPORT_WORKERS is used.
+        page_limit (int): The 'limit' sent with every query. Default is 0, which means XDR_PAGE_LIMIT is used.
+        window (datetime.timedelta): The length of the initial windows. Default is one day.
+        origin (str): The XDR origin filter. Default is 'orig'.
+        query (callable, optional): The function used to run one query. Default is 'query_xdrs'.
+    '''
+
+    def __init__(self, output_path, output_format='jsonl', return_fields=None, checkpoint_path=None, workers: int = 0,
+                 page_limit: int = 0, window=datetime.timedelta(days=1), origin='orig', query=None):
+        if output_format not in ('jsonl', 'csv'):
+            raise ValueError(f"Unsupported output format '{output_format}'")
+        self.output_path = output_path
+        self.output_format = output_format
+        self.return_fields = return_fields or XDR_RETURN_FIELDS
+        self.checkpoint_path = checkpoint_path or output_path + '.checkpoint'
+        self.workers = workers or config.XDR_EXPORT_WORKERS
+        self.page_limit = page_limit or config.XDR_PAGE_LIMIT
+        self.window = window
+        self.origin = origin
+        self.query = query or query_xdrs
+
+    @staticmethod
+    def _window_key(window):
+        client_id, date_from, date_to = window
+        return f"{client_id}|{date_from.strftime(DATE_FORMAT)}|{date_to.strftime(DATE_FORMAT)}"
+
+    def _load_checkpoint(self):
+        done, split, incomplete = set(), set(), set()
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    entry = json.loads(line)
+                    statuses = {'done': done, 'incomplete': incomplete}
+                    statuses.get(entry['status'], split).add(entry['window'])
+        return done, split, incomplete
+
+    def _initial_windows(self, date_from, date_to, client_ids):
+        windows = []
+        for client_id in client_ids:
+            start = date_from
+            while start <= date_to:
+                end = min(start + self.window - datetime.timedelta(seconds=1), date_to)
+                windows.append((client_id, start, end))
+                start = end + datetime.timedelta(seconds=1)
+        return windows
+
+    @staticmethod
+    def _split(window):
+        client_id, date_from, date_to = window
+        middle = date_from + datetime.timedelta(seconds=int((date_to - date_from).total_seconds()) // 2)
+        return [(client_id, date_from, middle), (client_id, middle + datetime.timedelta(seconds=1), date_to)]
+
+    def _fetch(self, window):
+        client_id, date_from, date_to = window
+        with priority(BULK):
+            return self.query(date_from, date_to, billed_clients_id=client_id, return_fields=self.return_fields,
+                              origin=self.origin, limit=self.page_limit)
+
+    def _write(self, output, csv_writer, checkpoint, window, records, status='done'):
+        if csv_writer is not None:
+            for record in records:
+                csv_writer.writerow({field: record.get(field) for field in self.return_fields})
+        else:
+            for record in records:
+                output.write(json.dumps({field: record.get(field) for field in self.return_fields}) + '\n')
+        output.flush()
+        # the window is only recorded once its records are on disk
+        checkpoint.write(json.dumps({'window': self._window_key(window), 'status': status}) + '\n')
+        checkpoint.flush()
+
+    def export(self, date_from, date_to, client_ids=None):
+        '''
+        Export the XDRs of [date_from, date_to], optionally for each billed client in 'client_ids'.
+
+        Parameters:
+            date_from (datetime.datetime): The start of the range (inclusive).
+            date_to (datetime.datetime): The end of the range (inclusive).
+            client_ids (list, optional): The billed client ids to export. Default is None, which exports all clients at once.
+
+        A one-second window which still reaches the page limit cannot be split any further: its records are written,
+        but it is recorded as 'incomplete' in the checkpoint and listed in the returned 'incomplete' windows, also when
+        an export resumes after it.
+
+        Returns:
+            dict: 'records' written, 'windows' finished, 'splits' made, 'skipped' windows already in the checkpoint and
+                  'incomplete', the keys ('<client>|<from>|<to>') of the windows which may miss XDRs.
+
+        Raises:
+            jsonrpc_requests.jsonrpc.JSONRPCError: If a query fails. Finished windows stay in the checkpoint.
+        '''
+        done, split, incomplete = self._load_checkpoint()
+        stats = {'records': 0, 'windows': 0, 'splits': 0, 'skipped': 0, 'incomplete': []}
+        write_header = self.output_format == 'csv' and (
+            not os.path.exists(self.output_path) or os.path.getsize(self.output_path) == 0
+        )
+
+        with open(self.output_path, 'a', newline='') as output, open(self.checkpoint_path, 'a') as checkpoint, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            csv_writer = None
+            if self.output_format == 'csv':
+                csv_writer = csv.DictWriter(output, fieldnames=self.return_fields)
+                if write_header:
+                    csv_writer.writeheader()
+
+            pending = {}
+            queue = list(self._initial_windows(date_from, date_to, client_ids or [None]))
+            while queue or pending:
+                while queue:
+                    window = queue.pop()
+                    key = self._window_key(window)
+                    if key in done:
+                        stats['skipped'] += 1
+                    elif key in incomplete:
+                        stats['skipped'] += 1
+                        stats['incomplete'].append(key)
+                    elif key in split:
+                        queue.extend(self._split(window))
+                    else:
+                        pending[executor.submit(self._fetch, window)] = window
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    window = pending.pop(future)
+                    records = future.result()
+                    status = 'done'
+                    if len(records) >= self.page_limit:
+                        if window[1] < window[2]:
+                            # the window may be truncated, query both halves again
+                            checkpoint.write(json.dumps({'window': self._window_key(window), 'status': 'split'}) + '\n')
+                            queue.extend(self._split(window))
+                            stats['splits'] += 1
+                            continue
+                        # a single second cannot be split, it is reported instead of being taken as complete
+                        status = 'incomplete'
+                        stats['incomplete'].append(self._window_key(window))
+                    self._write(output, csv_writer, checkpoint, window, records, status)
+                    stats['records'] += len(records)
+                    stats['windows'] += 1
+        return stats
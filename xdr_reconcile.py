@@ -0,0 +1,222 @@
+import collections
+import heapq
+import itertools
+import json
+import os
+import pickle
+import tempfile
+
+from config import config
+from cdr_parser import STATUS_START
+from timezones import cdr_times_to_utc
+
+MATCHED = 'matched'
+XDR_ONLY = 'xdr_only'
+CDR_ONLY = 'cdr_only'
+UNPARSED = 'unparsed'
+
+
+def normalize_number(value):
+    '''
+    Reduce a party number to its digits, so '+84 90-123' and '8490123' compare equal.
+    '''
+    return ''.join(c for c in str(value or '') if c.isdigit())
+
+
+def xdr_entries(xdrs, zone=None, chunk_size=10000):
+    '''
+    Turn XDR dictionaries into (key, utc_time, record) join entries.
+
+    The key is the normalized (src_party_id_ext, dst_party_id_ext) pair and the time is 'start_time', a wall-clock
+    time of 'zone' (default XDR_FILTER_TIMEZONE) converted to UTC in bulk, 'chunk_size' records at a time.
+    '''
+    zone = zone or config.XDR_FILTER_TIMEZONE
+    iterator = iter(xdrs)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if not chunk:
+            return
+        times = cdr_times_to_utc([xdr.get('start_time') for xdr in chunk], zone=zone)
+        for xdr, moment in zip(chunk, times):
+            key = (normalize_number(xdr.get('src_party_id_ext')), normalize_number(xdr.get('dst_party_id_ext')))
+            yield key, moment, xdr
+
+
+def cdr_entries(batches, zone=None):
+    '''
+    Turn the start records of CDRBatch objects into (key, utc_time, record) join entries.
+
+    The layout must decode 'calling_number' and 'called_number' (CDR_CALLING_NUMBER_FIELDS / CDR_CALLED_NUMBER_FIELDS).
+    The time is the connect time, converted from 'zone' (default CDR_TIMEZONE) to UTC in bulk per batch.
+    '''
+    for batch in batches:
+        names = batch.names
+        rows = [i for i, status in enumerate(batch.status) if status == STATUS_START]
+        if not rows:
+            continue
+        connect_times = batch.column('connect_time')
+        times = cdr_times_to_utc([connect_times[i] for i in rows], zone=zone)
+        calling, called = batch.column('calling_number'), batch.column('called_number')
+        for i, moment in zip(rows, times):
+            record = {name: column[i] for name, column in zip(names, batch.columns)}
+            record['path'] = batch.path
+            record['offset'] = batch.offset[i]
+            yield (normalize_number(calling[i]), normalize_number(called[i])), moment, record
+
+
+def _pickler(f):
+    pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+    # without the memo the unpickler does not keep a reference to every entry it read back
+    pickler.fast = True
+    return pickler
+
+
+def _write_run(entries, directory):
+    entries.sort(key=lambda entry: (entry[0], entry[1]))
+    f = tempfile.TemporaryFile(dir=directory)
+    pickler = _pickler(f)
+    for entry in entries:
+        pickler.dump(entry)
+    f.seek(0)
+    return f
+
+
+class _Spill:
+    # entries appended to a temporary file as they come, then read back once in the same order
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._file = None
+        self._pickler = None
+
+    def __call__(self, entry):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.directory)
+            self._pickler = _pickler(self._file)
+        self._pickler.dump(entry)
+
+    def read(self):
+        if self._file is None:
+            return iter(())
+        self._file.seek(0)
+        return _read_run(self._file)
+
+
+def _read_run(f):
+    unpickler = pickle.Unpickler(f)
+    try:
+        while True:
+            yield unpickler.load()
+    except EOFError:
+        f.close()
+
+
+def external_sort(entries, run_size=None, directory=None, unparsed=None):
+    '''
+    Sort (key, time, record) entries by key then time in bounded memory.
+
+    Entries are sorted in runs of 'run_size' which are spilled to temporary files and merged with heapq.merge, so at
+    most one run plus one entry per run is held in memory. Entries with an unparseable (NaN) time cannot be ordered:
+    they are passed to 'unparsed' (a callable) and left out of the sorted output.
+
+    Yields:
+        tuple: The entries in (key, time) order.
+    '''
+    run_size = run_size or config.RECONCILE_RUN_SIZE
+    runs = []
+    buffer = []
+    for entry in entries:
+        if entry[1] != entry[1]:
+            if unparsed is not None:
+                unparsed(entry)
+            continue
+        buffer.append(entry)
+        if len(buffer) >= run_size:
+            runs.append(_write_run(buffer, directory))
+            buffer = []
+    buffer.sort(key=lambda entry: (entry[0], entry[1]))
+    if not runs:
+        yield from buffer
+        return
+    if buffer:
+        runs.append(_write_run(buffer, directory))
+    yield from heapq.merge(*(_read_run(f) for f in runs), key=lambda entry: (entry[0], entry[1]))
+
+
+def reconcile(xdrs, cdrs, tolerance=None, run_size=None, directory=None):
+    '''
+    Reconcile XDR entries with CDR entries by party and time with a sort-merge join.
+
+    Both sides are externally sorted by (party key, UTC time), then walked once together. An XDR matches the earliest
+    unmatched CDR of the same party whose time is within 'tolerance' seconds of its own; CDRs that fall behind the
+    window are final CDR-only records. Only the CDRs inside the current tolerance window are kept in memory.
+    Entries whose time could not be parsed cannot be joined by time; they are spilled to a temporary file and yielded
+    last as UNPARSED, so every input record appears in exactly one result.
+
+    Parameters:
+        xdrs (iterable): (key, utc_time, record) entries, e.g. from xdr_entries().
+        cdrs (iterable): (key, utc_time, record) entries, e.g. from cdr_entries().
+        tolerance (float, optional): Seconds allowed between the two start times. Default is RECONCILE_TOLERANCE.
+        run_size (int, optional): Entries sorted in memory per run. Default is RECONCILE_RUN_SIZE.
+        directory (str, optional): Where sorted runs are spilled. Default is the system temporary directory.
+
+    Yields:
+        tuple: (MATCHED, xdr, cdr), (XDR_ONLY, xdr, None), (CDR_ONLY, None, cdr), (UNPARSED, xdr, None) or
+               (UNPARSED, None, cdr).
+    '''
+    tolerance = config.RECONCILE_TOLERANCE if tolerance is None else tolerance
+    unparsed_xdrs, unparsed_cdrs = _Spill(directory), _Spill(directory)
+    cdr_stream = external_sort(cdrs, run_size, directory, unparsed_cdrs)
+    window = collections.deque()
+    pending = next(cdr_stream, None)
+
+    for key, moment, xdr in external_sort(xdrs, run_size, directory, unparsed_xdrs):
+        # pull every CDR up to the end of this XDR's window
+        while pending is not None and (pending[0], pending[1]) <= (key, moment + tolerance):
+            if pending[0] == key and pending[1] >= moment - tolerance:
+                window.append(pending)
+            else:
+                yield CDR_ONLY, None, pending[2]
+            pending = next(cdr_stream, None)
+        # CDRs of an earlier party or too old for this XDR cannot match any later XDR
+        while window and (window[0][0] != key or window[0][1] < moment - tolerance):
+            yield CDR_ONLY, None, window.popleft()[2]
+        if window:
+            yield MATCHED, xdr, window.popleft()[2]
+        else:
+            yield XDR_ONLY, xdr, None
+
+    for entry in window:
+        yield CDR_ONLY, None, entry[2]
+    while pending is not None:
+        yield CDR_ONLY, None, pending[2]
+        pending = next(cdr_stream, None)
+    # both inputs are fully read by now
+    for entry in unparsed_xdrs.read():
+        yield UNPARSED, entry[2], None
+    for entry in unparsed_cdrs.read():
+        yield UNPARSED, None, entry[2]
+
+
+def reconcile_to_files(xdrs, cdrs, output_dir, tolerance=None, run_size=None):
+    '''
+    Run reconcile() and stream the results to 'matched.jsonl', 'xdr_only.jsonl', 'cdr_only.jsonl' and 'unparsed.jsonl'
+    (records whose time could not be parsed, as {'xdr': ..., 'cdr': ...} with one side null) in 'output_dir'.
+
+    Returns:
+        dict: The number of records written per output.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {MATCHED: 0, XDR_ONLY: 0, CDR_ONLY: 0, UNPARSED: 0}
+    files = {kind: open(os.path.join(output_dir, f'{kind}.jsonl'), 'w') for kind in counts}
+    try:
+        for kind, xdr, cdr in reconcile(xdrs, cdrs, tolerance, run_size, directory=output_dir):
+            if kind in (MATCHED, UNPARSED):
+                record = {'xdr': xdr, 'cdr': cdr}
+            else:
+                record = xdr if kind == XDR_ONLY else cdr
+            files[kind].write(json.dumps(record, default=str) + '\n')
+            counts[kind] += 1
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
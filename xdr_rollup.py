@@ -0,0 +1,240 @@
+import datetime
+import sqlite3
+import threading
+from array import array
+
+from config import config
+from coreapi_scheduler import BULK, priority
+from timezones import parse_timestamps
+from xdr_export import DATE_FORMAT, query_xdrs
+
+ROLLUP_FIELDS = ['billed_clients_id', 'start_time', 'stop_time', 'volume']
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollups (
+    clients_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    volume BLOB NOT NULL,
+    duration BLOB NOT NULL,
+    calls BLOB NOT NULL,
+    PRIMARY KEY (clients_id, day)
+) WITHOUT ROWID;
+'''
+
+
+def _hour(moment):
+    return int((moment - _EPOCH).total_seconds()) // 3600
+
+
+class _DayRollup:
+    # 24 hourly buckets of one client and day; volume and duration are float64 arrays, calls int64
+    __slots__ = ('volume', 'duration', 'calls')
+
+    def __init__(self, volume=None, duration=None, calls=None):
+        self.volume = array('d', bytes(8 * 24)) if volume is None else volume
+        self.duration = array('d', bytes(8 * 24)) if duration is None else duration
+        self.calls = array('q', bytes(8 * 24)) if calls is None else calls
+
+    @classmethod
+    def from_row(cls, volume, duration, calls):
+        rollup = cls(array('d'), array('d'), array('q'))
+        rollup.volume.frombytes(volume)
+        rollup.duration.frombytes(duration)
+        rollup.calls.frombytes(calls)
+        return rollup
+
+    def clear(self, first_hour, last_hour):
+        for hour in range(first_hour, last_hour + 1):
+            self.volume[hour] = 0.0
+            self.duration[hour] = 0.0
+            self.calls[hour] = 0
+
+
+class UsageRollup:
+    '''
+    Running per-client usage totals (volume, call duration, call count) by day and hour, built from XDRs.
+
+    Totals are kept per billed_clients_id and local day (XDR_FILTER_TIMEZONE wall clock, like the XDR 'start_time') as
+    three 24-slot columns, stored as packed arrays in one SQLite row per client and day. Updating a window only reads and
+    rewrites the rows of the days it touches; range queries are answered from the stored rows without any coreAPI call.
+
+    update() replaces the hours covered by a window with the totals of the XDRs fetched for it, so fetching the same
+    window again (e.g. after late XDRs arrived) corrects the totals instead of counting twice. Windows must therefore
+    cover whole hours: 'date_from' at HH:00:00 and 'date_to' at HH:59:59.
+
+    Parameters:
+        path (str, optional): The SQLite file. Default is XDR_ROLLUP_PATH.
+
+    Example:
+        rollup = UsageRollup()
+        rollup.refresh(datetime.datetime(2023, 11, 1), datetime.datetime(2023, 11, 1, 23, 59, 59))
+        rollup.totals(datetime.datetime(2023, 11, 1), datetime.datetime(2023, 11, 30, 23, 59, 59), by='day')
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or config.XDR_ROLLUP_PATH
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _load(self, clients_ids, days):
+        rollups = {}
+        for day in days:
+            rows = self._connection.execute(
+                'SELECT clients_id, volume, duration, calls FROM rollups WHERE day = ?', (day,))
+            for clients_id, volume, duration, calls in rows:
+                if clients_ids is None or clients_id in clients_ids:
+                    rollups[(clients_id, day)] = _DayRollup.from_row(volume, duration, calls)
+        return rollups
+
+    def update(self, date_from, date_to, xdrs, billed_clients_id=None):
+        '''
+        Replace the totals of the hours in [date_from, date_to] with the totals of 'xdrs'.
+
+        Parameters:
+            date_from (datetime.datetime): The start of the fetched window, on an hour boundary.
+            date_to (datetime.datetime): The inclusive end of the fetched window, one second before an hour boundary.
+            xdrs (iterable): The XDRs of the window, with 'billed_clients_id', 'start_time', 'stop_time' and 'volume'.
+            billed_clients_id (int, optional): The client the window was fetched for. Default is None, meaning the
+                                               window holds the XDRs of every client.
+
+        Returns:
+            int: The number of XDRs counted.
+
+        Raises:
+            ValueError: If the window does not cover whole hours.
+        '''
+        if date_from.minute or date_from.second or date_to.minute != 59 or date_to.second != 59:
+            raise ValueError('The rollup window must cover whole hours')
+        first_hour, last_hour = _hour(date_from), _hour(date_to)
+        xdrs = list(xdrs)
+        starts = parse_timestamps([xdr.get('start_time') for xdr in xdrs])
+        stops = parse_timestamps([xdr.get('stop_time') for xdr in xdrs])
+        days = range(first_hour // 24, last_hour // 24 + 1)
+        clients_ids = None if billed_clients_id is None else {int(billed_clients_id)}
+
+        with self._lock:
+            rollups = self._load(clients_ids, days)
+            # the window's hours are recomputed from scratch
+            for (clients_id, day), rollup in rollups.items():
+                rollup.clear(max(first_hour - day * 24, 0), min(last_hour - day * 24, 23))
+            counted = 0
+            for xdr, start, stop in zip(xdrs, starts, stops):
+                if start != start:
+                    continue
+                hour = int(start) // 3600
+                if not first_hour <= hour <= last_hour:
+                    continue
+                clients_id = int(xdr.get('billed_clients_id') or billed_clients_id or 0)
+                day = hour // 24
+                rollup = rollups.get((clients_id, day))
+                if rollup is None:
+                    rollup = rollups[(clients_id, day)] = _DayRollup()
+                slot = hour - day * 24
+                rollup.volume[slot] += float(xdr.get('volume') or 0)
+                rollup.duration[slot] += max(stop - start, 0.0) if stop == stop else 0.0
+                rollup.calls[slot] += 1
+                counted += 1
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO rollups (clients_id, day, volume, duration, calls) VALUES (?, ?, ?, ?, ?)',
+                    [(clients_id, day, r.volume.tobytes(), r.duration.tobytes(), r.calls.tobytes())
+                     for (clients_id, day), r in rollups.items()])
+        return counted
+
+    def _query_complete(self, query, date_from, date_to, billed_clients_id):
+        # the XDRs of [date_from, date_to], queried again in halves (like XDRExporter._split) while a result reaches the
+        # page limit and may be truncated
+        with priority(BULK):
+            xdrs = query(date_from, date_to, billed_clients_id=billed_clients_id, return_fields=ROLLUP_FIELDS)
+        if len(xdrs) < config.XDR_PAGE_LIMIT:
+            return xdrs
+        if date_from >= date_to:
+            raise ValueError('More than %d XDRs in the second %s, it cannot be queried completely'
+                             % (config.XDR_PAGE_LIMIT - 1, date_from.strftime(DATE_FORMAT)))
+        middle = date_from + datetime.timedelta(seconds=int((date_to - date_from).total_seconds()) // 2)
+        return (self._query_complete(query, date_from, middle, billed_clients_id)
+                + self._query_complete(query, middle + datetime.timedelta(seconds=1), date_to, billed_clients_id))
+
+    def refresh(self, date_from, date_to, billed_clients_id=None, window=datetime.timedelta(hours=1), query=None):
+        '''
+        Fetch the XDRs of [date_from, date_to] window by window and update the rollups of the affected hours.
+
+        A window whose result reaches the page limit may be truncated: a window of several hours is fetched again hour
+        by hour, and an hour is fetched in smaller sub-windows whose XDRs are added up before the hour is updated, so a
+        truncated result is never stored.
+
+        Returns:
+            int: The number of XDRs counted, or the exception if a query failed or a single second holds more XDRs
+                 than the page limit.
+        '''
+        query = query or query_xdrs
+        counted = 0
+        start = date_from
+        try:
+            while start <= date_to:
+                end = min(start + window - datetime.timedelta(seconds=1), date_to)
+                with priority(BULK):
+                    xdrs = query(start, end, billed_clients_id=billed_clients_id, return_fields=ROLLUP_FIELDS)
+                if len(xdrs) >= config.XDR_PAGE_LIMIT:
+                    if end - start >= datetime.timedelta(hours=1):
+                        result = self.refresh(start, end, billed_clients_id, datetime.timedelta(hours=1), query)
+                        if isinstance(result, Exception):
+                            return result
+                        counted += result
+                        start = end + datetime.timedelta(seconds=1)
+                        continue
+                    middle = start + datetime.timedelta(seconds=int((end - start).total_seconds()) // 2)
+                    xdrs = (self._query_complete(query, start, middle, billed_clients_id)
+                            + self._query_complete(query, middle + datetime.timedelta(seconds=1), end, billed_clients_id))
+                counted += self.update(start, end, xdrs, billed_clients_id)
+                start = end + datetime.timedelta(seconds=1)
+        except Exception as e:
+            return e
+        return counted
+
+    def totals(self, date_from, date_to, clients_ids=None, by='day'):
+        '''
+        Return the totals of the hours in [date_from, date_to] from the stored rollups.
+
+        Parameters:
+            date_from (datetime.datetime): The start of the range.
+            date_to (datetime.datetime): The inclusive end of the range.
+            clients_ids (list, optional): Only return these clients. Default is every client.
+            by (str, optional): 'day', 'hour', or None for one total per client. Default is 'day'.
+
+        Returns:
+            dict: {billed_clients_id: {bucket: {'volume', 'duration', 'calls'}}} with buckets labelled 'YYYY-MM-DD'
+                  or 'YYYY-MM-DD HH:00:00', or {billed_clients_id: {'volume', 'duration', 'calls'}} if 'by' is None.
+        '''
+        first_hour, last_hour = _hour(date_from), _hour(date_to)
+        wanted = None if clients_ids is None else {int(c) for c in clients_ids}
+        result = {}
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT clients_id, day, volume, duration, calls FROM rollups WHERE day BETWEEN ? AND ? ORDER BY day',
+                (first_hour // 24, last_hour // 24)).fetchall()
+        for clients_id, day, volume, duration, calls in rows:
+            if wanted is not None and clients_id not in wanted:
+                continue
+            rollup = _DayRollup.from_row(volume, duration, calls)
+            client = result.setdefault(clients_id, {})
+            for slot in range(max(first_hour - day * 24, 0), min(last_hour - day * 24, 23) + 1):
+                if not rollup.calls[slot]:
+                    continue
+                if by is None:
+                    bucket = client
+                else:
+                    moment = _EPOCH + datetime.timedelta(hours=day * 24 + slot)
+                    label = moment.strftime('%Y-%m-%d') if by == 'day' else moment.strftime(DATE_FORMAT)
+                    bucket = client.setdefault(label, {})
+                bucket['volume'] = bucket.get('volume', 0.0) + rollup.volume[slot]
+                bucket['duration'] = bucket.get('duration', 0.0) + rollup.duration[slot]
+                bucket['calls'] = bucket.get('calls', 0) + rollup.calls[slot]
+        return result